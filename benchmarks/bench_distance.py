@@ -0,0 +1,122 @@
+# Сравнение пакетного расчета расстояний с построчным циклом
+# Запуск: python benchmarks/bench_distance.py
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from matchmaking_index import WaitingIndex
+from utils import EARTH_RADIUS_KM, bounding_box_mask, calculate_distance, calculate_distances
+
+SIZES = (1_000, 10_000, 100_000)
+RADIUS_KM = 10
+REPEATS = 5
+
+
+# Кандидаты в том виде, в каком их хранит waiting_list: строки "lat, lon"
+def make_locations(count, center_lat, center_lon, spread_deg=2.0):
+    return [
+        f"{center_lat + random.uniform(-spread_deg, spread_deg)}, {center_lon + random.uniform(-spread_deg, spread_deg)}"
+        for _ in range(count)
+    ]
+
+
+# Текущий подход: split(',') и скалярная формула на каждого кандидата
+def per_row_loop(lat, lon, locations):
+    matches = 0
+    for location in locations:
+        match_lat, match_lon = map(float, location.split(','))
+        if calculate_distance(lat, lon, match_lat, match_lon) <= RADIUS_KM:
+            matches += 1
+    return matches
+
+
+def batched(lat, lon, coords):
+    mask = bounding_box_mask(lat, lon, RADIUS_KM, coords)
+    distances = calculate_distances(lat, lon, coords[mask])
+    return int(np.count_nonzero(distances <= RADIUS_KM))
+
+
+# Точка на расстоянии distance_km от (lat, lon) по азимуту bearing (градусы) на сфере гаверсинуса
+def point_at(lat, lon, bearing, distance_km):
+    lat1, lon1, bearing = math.radians(lat), math.radians(lon), math.radians(bearing)
+    angle = distance_km / EARTH_RADIUS_KM
+    lat2 = math.asin(math.sin(lat1) * math.cos(angle) + math.cos(lat1) * math.sin(angle) * math.cos(bearing))
+    lon2 = lon1 + math.atan2(
+        math.sin(bearing) * math.sin(angle) * math.cos(lat1), math.cos(angle) - math.sin(lat1) * math.sin(lat2)
+    )
+    return math.degrees(lat2), (math.degrees(lon2) + 540.0) % 360.0 - 180.0
+
+
+# Точки ровно на границе радиуса: индекс не должен терять ни одну, которую находит построчный расчет
+def check_radius_edge(trials=300, points=200):
+    for trial in range(trials):
+        rng = random.Random(trial)
+        lat, lon = rng.uniform(-80, 80), rng.uniform(-180, 180)
+        radius = rng.choice((5, 10, 50, 200))
+        index = WaitingIndex()
+        entries = []
+        for user_id in range(points):
+            point_lat, point_lon = point_at(lat, lon, rng.uniform(0, 360), radius)
+            entries.append({'user_id': user_id, 'lat': point_lat, 'lon': point_lon})
+            index.add(entries[-1])
+        found = {entry['user_id'] for entry, _ in index.nearby(lat, lon, radius)}
+        expected = {entry['user_id'] for entry in entries if calculate_distance(lat, lon, entry['lat'], entry['lon']) <= radius}
+        assert found == expected, (trial, lat, lon, radius, sorted(expected - found)[:5])
+
+
+# Пакетный отбор против построчного на точках в полосе ±1% от радиуса,
+# в том числе у 180-го меридиана, где прямоугольник переходит через линию перемены дат
+def check_batch_edge(trials=300, points=500):
+    centers = [(random.uniform(-80, 80), random.uniform(-180, 180)) for _ in range(trials // 2)]
+    centers += [(random.uniform(-80, 80), random.choice((-1, 1)) * random.uniform(179.0, 180.0)) for _ in range(trials - len(centers))]
+    for lat, lon in centers:
+        radius = random.choice((5, 10, 50, 200))
+        coords = np.array([
+            point_at(lat, lon, random.uniform(0, 360), radius * random.uniform(0.99, 1.01)) for _ in range(points)
+        ])
+        mask = bounding_box_mask(lat, lon, radius, coords)
+        batch = set(np.flatnonzero(mask)[calculate_distances(lat, lon, coords[mask]) <= radius])
+        loop = {i for i, (c_lat, c_lon) in enumerate(coords) if calculate_distance(lat, lon, c_lat, c_lon) <= radius}
+        assert batch == loop, (lat, lon, radius, sorted(loop - batch)[:5])
+
+
+def best_of(func, *args):
+    best, result = None, None
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    random.seed(42)
+    lat, lon = 43.238, 76.945  # Алматы
+    check_radius_edge()
+    check_batch_edge()
+
+    print(f"{'candidates':>10} {'loop, ms':>10} {'batch, ms':>10} {'speedup':>8}")
+    for size in SIZES:
+        locations = make_locations(size, lat, lon)
+        coords = np.array([tuple(map(float, location.split(','))) for location in locations])
+
+        # Проверяем совпадение с точностью до погрешности вычислений
+        scalar = np.array([calculate_distance(lat, lon, c_lat, c_lon) for c_lat, c_lon in coords])
+        assert np.allclose(calculate_distances(lat, lon, coords), scalar, rtol=1e-9, atol=1e-9)
+
+        loop_time, loop_matches = best_of(per_row_loop, lat, lon, locations)
+        batch_time, batch_matches = best_of(batched, lat, lon, coords)
+        assert loop_matches == batch_matches
+
+        print(f"{size:>10} {loop_time * 1000:>10.2f} {batch_time * 1000:>10.2f} {loop_time / batch_time:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
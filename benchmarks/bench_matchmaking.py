@@ -0,0 +1,206 @@
+# Бенчмарк поиска пары на синтетическом населении.
+# Отчет: p50/p99 задержки поиска, обращения к базе и просмотренные строки на поиск.
+#
+#   python benchmarks/bench_matchmaking.py                      # индекс процесса, без базы
+#   python benchmarks/bench_matchmaking.py --backend mysql \
+#       --sizes 1000,10000,100000                               # полный find_matches против MySQL
+#
+# Для --backend mysql нужна пустая тестовая база BENCH_DB_NAME (будет очищена). Перед замером
+# сверяются кандидаты индекса и SQL, включая добавленных на границу радиуса.
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+from benchmarks.bench_distance import point_at
+from benchmarks.common import execute
+from benchmarks.population import Population
+from matchmaking_index import WaitingIndex
+
+DEFAULT_SIZES = '1000,10000,100000,1000000'
+SEED_BATCH = 5000
+PARITY_SEARCHERS = 50
+PARITY_LIMIT = 1_000_000
+# Сдвиг граничных кандидатов от радиуса (км): больше расхождений округления MySQL и Python
+EDGE_OFFSET_KM = 1e-6
+EDGE_BEARINGS = (0, 45, 90, 135, 180, 225, 270, 315)
+
+
+def percentile(values, percent):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+def exclusions_for(population, user_ids):
+    wanted = set(user_ids)
+    exclusions = {user_id: database.ExclusionSet() for user_id in wanted}
+    for blocker_id, blocked_id in population.blocks:
+        if blocker_id in wanted:
+            exclusions[blocker_id].blocked_by_me.add(blocked_id)
+        if blocked_id in wanted:
+            exclusions[blocked_id].blocked_me.add(blocker_id)
+    for user_id, partner_id in population.finished:
+        if user_id in wanted:
+            exclusions[user_id].finished.add(partner_id)
+    return exclusions
+
+
+def report(size, mode, latencies, round_trips, scanned):
+    searches = len(latencies)
+    print(
+        f"{size:>9} {mode:>7} {percentile(latencies, 50) * 1000:>9.3f} {percentile(latencies, 99) * 1000:>9.3f}"
+        f" {round_trips / searches:>11.2f} {scanned / searches:>12.1f}"
+    )
+
+
+# Индекс процесса: ранжирование в памяти, исключения уже в кэше
+def bench_memory(population, searches):
+    index = WaitingIndex()
+    for user in population.users:
+        index.add(user)
+
+    searchers = population.sample(searches)
+    exclusions = exclusions_for(population, [user['user_id'] for user in searchers])
+    latencies = []
+    for user in searchers:
+        started = time.perf_counter()
+        index.rank(
+            user['user_id'], user['lat'], user['lon'], user['distance'], user['interests_mask'],
+            database._search_gender(user['gender'], user['orientation']), exclusions[user['user_id']], limit=5
+        )
+        latencies.append(time.perf_counter() - started)
+    report(len(population), 'memory', latencies, 0, index.stats['scanned'])
+
+
+# Кандидаты на границе радиуса искателей: чуть внутри должны найтись в обоих режимах, чуть снаружи - ни в одном
+def add_edge_users(population, searchers):
+    next_id = max(user['user_id'] for user in population.users) + 1
+    for searcher in searchers:
+        gender = database._search_gender(searcher['gender'], searcher['orientation']) or 'Female'
+        for bearing in EDGE_BEARINGS:
+            for offset in (-EDGE_OFFSET_KM, EDGE_OFFSET_KM):
+                lat, lon = point_at(searcher['lat'], searcher['lon'], bearing, searcher['distance'] + offset)
+                population.users.append({
+                    'user_id': next_id,
+                    'username': f"edge{next_id}",
+                    'gender': gender,
+                    'orientation': 'Bisexual',
+                    'interests': searcher['interests'],
+                    'interests_mask': searcher['interests_mask'],
+                    'lat': lat,
+                    'lon': lon,
+                    'distance': searcher['distance'],
+                    'queued_at': 0.0,
+                })
+                next_id += 1
+
+
+async def seed_mysql(population):
+    await database.run_migrations()
+    for table in ('users', 'waiting_list', 'active_chats', 'blocked_users', 'finished_chats'):
+        await execute(f"DELETE FROM {table}")
+
+    users = population.users
+    for start in range(0, len(users), SEED_BATCH):
+        batch = users[start:start + SEED_BATCH]
+        await execute(
+            "INSERT INTO users (user_id, username, gender, orientation, lat, lon, distance, interests_mask)"
+            " VALUES (%s, %s, %s, %s, %s, %s, %s, %s)",
+            [(u['user_id'], u['username'], u['gender'], u['orientation'], u['lat'], u['lon'], u['distance'], u['interests_mask'])
+             for u in batch], many=True
+        )
+        await execute(
+            "INSERT INTO waiting_list (user_id, username, gender, orientation, interests, interests_mask, lat, lon, request_time)"
+            " VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW())",
+            [(u['user_id'], u['username'], u['gender'], u['orientation'], u['interests'], u['interests_mask'], u['lat'], u['lon'])
+             for u in batch], many=True
+        )
+    for table, pairs in (('blocked_users (blocker_id, blocked_id)', population.blocks),
+                         ('finished_chats (user_id, partner_id)', population.finished)):
+        for start in range(0, len(pairs), SEED_BATCH):
+            await execute(f"INSERT INTO {table} VALUES (%s, %s)", pairs[start:start + SEED_BATCH], many=True)
+
+
+async def innodb_rows_read():
+    rows = await execute("SHOW GLOBAL STATUS LIKE 'Innodb_rows_read'")
+    return int(rows[0][1])
+
+
+async def match_ids(user):
+    matches = await database.find_matches(
+        user['user_id'], user['gender'], user['orientation'], user['interests'], user['lat'], user['lon'], limit=PARITY_LIMIT
+    )
+    return {match['user_id'] for match in matches}
+
+
+# Индекс и SQL должны находить одних и тех же кандидатов, в том числе на самой границе радиуса
+async def check_parity(searchers):
+    for user in searchers:
+        database.MATCH_MODE = 'index'
+        from_index = await match_ids(user)
+        database.MATCH_MODE = 'sql'
+        from_sql = await match_ids(user)
+        assert from_index == from_sql, (
+            f"user {user['user_id']}: только в индексе {sorted(from_index - from_sql)[:10]},"
+            f" только в SQL {sorted(from_sql - from_index)[:10]}"
+        )
+
+
+# Полный find_matches против MySQL в обоих режимах; кэш исключений холодный
+async def bench_mysql(population, searches):
+    searchers = population.sample(searches)
+    parity_searchers = searchers[:PARITY_SEARCHERS]
+    add_edge_users(population, parity_searchers)
+    await seed_mysql(population)
+    await database.load_waiting_index()
+    await check_parity(parity_searchers)
+
+    for mode in ('index', 'sql'):
+        database.MATCH_MODE = mode
+        database.exclusion_cache.clear()
+        round_trips = database.query_stats['round_trips']
+        rows_read = await innodb_rows_read()
+        latencies = []
+        for user in searchers:
+            started = time.perf_counter()
+            await database.find_matches(
+                user['user_id'], user['gender'], user['orientation'], user['interests'], user['lat'], user['lon'], limit=5
+            )
+            latencies.append(time.perf_counter() - started)
+        # Сам запрос статуса тоже читает строки, но на фоне поисков это шум
+        scanned = await innodb_rows_read() - rows_read
+        report(len(population), mode, latencies, database.query_stats['round_trips'] - round_trips, scanned)
+
+
+async def run_mysql(sizes, searches):
+    await database.init_db()
+    try:
+        for size in sizes:
+            await bench_mysql(Population(size), searches)
+    finally:
+        await database.close_db()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', choices=('memory', 'mysql'), default='memory')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES)
+    parser.add_argument('--searches', type=int, default=500)
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    print(f"{'users':>9} {'mode':>7} {'p50, ms':>9} {'p99, ms':>9} {'round trips':>11} {'rows scanned':>12}")
+    if args.backend == 'memory':
+        for size in sizes:
+            bench_memory(Population(size), args.searches)
+    else:
+        os.environ['DB_NAME'] = os.getenv('BENCH_DB_NAME', 'dating_bot_bench')
+        asyncio.run(run_mysql(sizes, args.searches))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+# Сравнение translate: загрузка .mo с диска на каждый вызов против каталогов в памяти
+# Запуск: python benchmarks/bench_translate.py
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from babel.support import Translations
+
+import localization
+
+# Ключи клавиатуры интересов: 28 вызовов translate на одну клавиатуру
+KEYBOARD_KEYS = (
+    'music', 'cinema', 'sport', 'technology', 'travel', 'food', 'fashion', 'reading', 'programming', 'games',
+    'photography', 'dancing', 'yoga', 'meditation', 'cooking', 'crossfit', 'art', 'drawing', 'music_playing',
+    'singing', 'psychology', 'science', 'cars', 'motorcycles', 'extreme_sports', 'outdoor_cooking', 'camping', 'movies',
+)
+LANGS = ('en', 'ru', 'kz')
+KEYBOARDS = 200
+
+
+# Прежний translate: Translations.load на каждый вызов
+def translate_from_disk(message_key, lang_code):
+    return Translations.load(localization.LOCALES_DIR, [lang_code]).gettext(message_key)
+
+
+def build_keyboards(translate_func):
+    start = time.perf_counter()
+    for i in range(KEYBOARDS):
+        lang_code = LANGS[i % len(LANGS)]
+        for key in KEYBOARD_KEYS:
+            translate_func(key, lang_code)
+    return time.perf_counter() - start
+
+
+def main():
+    localization.load_catalogs()
+    for lang_code in LANGS:
+        for key in KEYBOARD_KEYS:
+            assert translate_from_disk(key, lang_code) == localization.translate(key, lang_code), (lang_code, key)
+
+    calls = KEYBOARDS * len(KEYBOARD_KEYS)
+    print(f"{'variant':>8} {'per call, us':>13} {'per keyboard, ms':>17}")
+    results = {}
+    for name, func in (('disk', translate_from_disk), ('memory', localization.translate)):
+        elapsed = min(build_keyboards(func) for _ in range(3))
+        results[name] = elapsed
+        print(f"{name:>8} {elapsed / calls * 1e6:>13.2f} {elapsed / KEYBOARDS * 1000:>17.3f}")
+    print(f"speedup: {results['disk'] / results['memory']:.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,13 @@
+# Общие части бенчмарков: выполнение запросов через пул database.db.
+# Схему тестовой базы создают миграции database.run_migrations()
+import database
+
+
+async def execute(query, params=None, many=False):
+    async with database.db.acquire() as conn:
+        async with conn.cursor() as cursor:
+            if many:
+                await cursor.executemany(query, params)
+            else:
+                await cursor.execute(query, params)
+            return await cursor.fetchall()
@@ -0,0 +1,101 @@
+# Симулятор населения для бенчмарков поиска: реалистичные доли пола и ориентации,
+# интересы из каталога с перекосом популярности, координаты вокруг городов,
+# графы блокировок и завершенных чатов с тяжелым хвостом у "старожилов".
+import itertools
+import random
+
+from interests import INTEREST_BITS, interests_to_mask
+
+# (город, широта, долгота, доля пользователей)
+CITIES = (
+    ("Almaty", 43.238, 76.945, 0.30),
+    ("Astana", 51.169, 71.449, 0.20),
+    ("Shymkent", 42.341, 69.590, 0.12),
+    ("Karaganda", 49.806, 73.085, 0.06),
+    ("Bishkek", 42.874, 74.590, 0.08),
+    ("Moscow", 55.756, 37.617, 0.17),
+    ("Saint Petersburg", 59.939, 30.316, 0.07),
+)
+CITY_SPREAD_DEG = 0.08  # ~9 км стандартное отклонение вокруг центра
+
+GENDERS = (("Male", 0.49), ("Female", 0.47), ("Other", 0.04))
+ORIENTATIONS = {
+    'Male': (("Heterosexual", 0.82), ("Homosexual", 0.06), ("Bisexual", 0.08), ("Pansexual", 0.02), ("Asexual", 0.02)),
+    'Female': (("Heterosexual", 0.78), ("Lesbian", 0.06), ("Bisexual", 0.11), ("Pansexual", 0.03), ("Asexual", 0.02)),
+    'Other': (("Heterosexual", 0.2), ("Homosexual", 0.2), ("Lesbian", 0.1), ("Bisexual", 0.3), ("Pansexual", 0.1), ("Asexual", 0.1)),
+}
+SEARCH_RADII = (5, 10, 10, 10, 25, 50)
+
+# Популярность интересов убывает по закону, близкому к Ципфу
+INTEREST_KEYS = [key for key, _ in INTEREST_BITS]
+INTEREST_CUM_WEIGHTS = list(itertools.accumulate(1 / (rank + 1) ** 0.8 for rank in range(len(INTEREST_KEYS))))
+
+AVG_BLOCKS = 0.5
+AVG_FINISHED_CHATS = 3
+
+
+def _pick(options, rng):
+    values, weights = zip(*options)
+    return rng.choices(values, weights)[0]
+
+
+def _pick_interests(rng):
+    count = rng.randint(3, 7)
+    chosen = set()
+    while len(chosen) < count:
+        chosen.update(rng.choices(INTEREST_KEYS, cum_weights=INTEREST_CUM_WEIGHTS, k=count - len(chosen)))
+    return ', '.join(sorted(chosen))
+
+
+# Количество связей с тяжелым хвостом: большинство около среднего, единицы - сотни
+def _heavy_tail(average, rng):
+    return int(average * (rng.paretovariate(1.5) - 1) * 0.5)
+
+
+class Population:
+    def __init__(self, size, seed=42):
+        rng = random.Random(seed)
+        self.users = []
+        self.by_city = {name: [] for name, *_ in CITIES}
+        city_weights = [weight for *_, weight in CITIES]
+
+        for user_id in range(1, size + 1):
+            name, city_lat, city_lon, _ = rng.choices(CITIES, city_weights)[0]
+            gender = _pick(GENDERS, rng)
+            interests = _pick_interests(rng)
+            self.users.append({
+                'user_id': user_id,
+                'username': f"user{user_id}",
+                'gender': gender,
+                'orientation': _pick(ORIENTATIONS[gender], rng),
+                'interests': interests,
+                'interests_mask': interests_to_mask(interests),
+                'lat': rng.gauss(city_lat, CITY_SPREAD_DEG),
+                'lon': rng.gauss(city_lon, CITY_SPREAD_DEG),
+                'distance': rng.choice(SEARCH_RADII),
+                'queued_at': 0.0,
+            })
+            self.by_city[name].append(user_id)
+
+        # Блокировки и завершенные чаты в основном между жителями одного города
+        self.blocks = []
+        self.finished = []
+        for name, user_ids in self.by_city.items():
+            if len(user_ids) < 2:
+                continue
+            for user_id in user_ids:
+                for _ in range(_heavy_tail(AVG_BLOCKS, rng)):
+                    other = rng.choice(user_ids)
+                    if other != user_id:
+                        self.blocks.append((user_id, other))
+                for _ in range(_heavy_tail(AVG_FINISHED_CHATS, rng)):
+                    other = rng.choice(user_ids)
+                    if other != user_id:
+                        self.finished.append((user_id, other))
+                        self.finished.append((other, user_id))
+
+    def __len__(self):
+        return len(self.users)
+
+    def sample(self, count, seed=7):
+        return random.Random(seed).sample(self.users, min(count, len(self.users)))
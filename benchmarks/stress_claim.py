@@ -0,0 +1,115 @@
+# Стресс-проверка атомарного захвата пары (database.claim_match).
+# Сотни одновременных поисков в нескольких процессах против локального MySQL;
+# в конце проверяется, что ни один пользователь не попал в две пары.
+#
+# Запуск (нужна пустая тестовая база, она будет очищена):
+#   STRESS_DB_NAME=dating_bot_stress python benchmarks/stress_claim.py --users 400 --searches 600 --processes 4
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import sys
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+from benchmarks.common import execute
+from interests import INTEREST_BITS
+
+
+def make_user(user_id):
+    gender = random.choice(('Male', 'Female'))
+    interests = ', '.join(key for key, _ in random.sample(INTEREST_BITS, 4))
+    lat, lon = 43.2 + random.uniform(-0.05, 0.05), 76.9 + random.uniform(-0.05, 0.05)
+    return user_id, f"user{user_id}", gender, 'Bisexual', interests, lat, lon
+
+
+async def prepare(user_count):
+    await database.init_db()
+    await database.run_migrations()
+    for table in ('users', 'waiting_list', 'active_chats', 'blocked_users', 'finished_chats'):
+        await execute(f"DELETE FROM {table}")
+
+    users = [make_user(user_id) for user_id in range(1, user_count + 1)]
+    await execute(
+        "INSERT INTO users (user_id, username, gender, orientation, lat, lon, distance) VALUES (%s, %s, %s, %s, %s, %s, 50)",
+        [(u[0], u[1], u[2], u[3], u[5], u[6]) for u in users], many=True
+    )
+    for user in users:
+        await database.add_to_waiting_list(*user)
+    await database.close_db()
+    return users
+
+
+# Один процесс бота: собственный пул и индекс, поиски идут конкурентно
+async def run_searches(users, searches, seed):
+    random.seed(seed)
+    await database.init_db()
+    await database.load_waiting_index()
+
+    async def search(user):
+        user_id, _, gender, orientation, interests, lat, lon = user
+        matches = await database.find_matches(user_id, gender, orientation, interests, lat, lon, limit=5)
+        for match in matches:
+            if await database.claim_match(user_id, match['user_id']):
+                return 1
+        return 0
+
+    results = await asyncio.gather(*(search(random.choice(users)) for _ in range(searches)))
+    await database.close_db()
+    return sum(results)
+
+
+def worker(users, searches, seed, queue):
+    queue.put(asyncio.run(run_searches(users, searches, seed)))
+
+
+async def verify():
+    await database.init_db()
+    rows = await execute("SELECT user_id, partner_id FROM active_chats WHERE status != 'finished'")
+    waiting = {row[0] for row in await execute("SELECT user_id FROM waiting_list")}
+    await database.close_db()
+
+    appearances = Counter(user_id for user_id, _ in rows)
+    pairs = {(user_id, partner_id) for user_id, partner_id in rows}
+    problems = []
+    problems += [f"user {user_id} is in {count} active chats" for user_id, count in appearances.items() if count > 1]
+    problems += [f"pair {a}-{b} has no mirror row" for a, b in pairs if (b, a) not in pairs]
+    problems += [f"user {user_id} is paired but still waiting" for user_id in appearances if user_id in waiting]
+    return len(rows) // 2, problems
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=400)
+    parser.add_argument('--searches', type=int, default=600, help='поисков на процесс')
+    parser.add_argument('--processes', type=int, default=4)
+    args = parser.parse_args()
+
+    os.environ['DB_NAME'] = os.getenv('STRESS_DB_NAME', 'dating_bot_stress')
+    users = asyncio.run(prepare(args.users))
+
+    queue = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=worker, args=(users, args.searches, seed, queue))
+        for seed in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    claimed = sum(queue.get() for _ in processes)
+    for process in processes:
+        process.join()
+
+    pair_count, problems = asyncio.run(verify())
+    print(f"searches: {args.searches * args.processes}, successful claims: {claimed}, pairs in db: {pair_count}")
+    if claimed != pair_count:
+        problems.append(f"claims reported ({claimed}) != pairs stored ({pair_count})")
+    for problem in problems:
+        print(f"DOUBLE PAIRING: {problem}")
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,190 @@
+import asyncio
+import contextlib
 import logging
 import os
+import time
 import aiomysql
+from aiomysql.cursors import RE_INSERT_VALUES
 from dotenv import load_dotenv
+from pymysql.constants import CLIENT
+from pymysql.constants.ER import DUP_ENTRY as ER_DUP_ENTRY
 
-from utils import calculate_distance
+from global_vars import active_chats
+from interests import interests_to_mask
+from matchmaking_index import waiting_index
+from utils import BOX_EPSILON_DEG, EARTH_RADIUS_KM, KM_PER_DEG_LAT, Histogram, LRUCache, format_location, parse_location
 
 db = None  # Глобальная переменная для пула соединений
 
 # Загрузка переменных окружения
 load_dotenv()
 
+# Режим поиска: 'index' - индекс процесса, 'sql' - один ранжирующий запрос к базе.
+# Индекс каждого процесса видит очередь других процессов с задержкой до WAITING_INDEX_REFRESH_INTERVAL
+MATCH_MODE = os.getenv('MATCH_MODE', 'index')
+# Интервал догрузки изменений waiting_list из других процессов в индекс (сек), 0 - выключена
+WAITING_INDEX_REFRESH_INTERVAL = float(os.getenv('WAITING_INDEX_REFRESH_INTERVAL', 10))
+# Перекрытие окна догрузки (сек): строки, закоммиченные позже своего request_time, не теряются
+WAITING_INDEX_REFRESH_OVERLAP = 5
+
+# Пул соединений: размер ограничивайте с учетом max_connections MySQL на все процессы бота
+DB_PORT = int(os.getenv('DB_PORT', 3306))
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', 2))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', 10))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 3600))  # Меньше wait_timeout сервера
+DB_CONNECT_TIMEOUT = float(os.getenv('DB_CONNECT_TIMEOUT', 10))
+DB_POOL_PREWARM = int(os.getenv('DB_POOL_PREWARM', DB_POOL_MIN))  # Соединений, открываемых при старте
+DB_POOL_STATS_INTERVAL = float(os.getenv('DB_POOL_STATS_INTERVAL', 300))  # Вывод метрик в лог, 0 - выключен
+
+# Карта активных чатов своя у каждого процесса. Чаты, завершенные в других процессах (выход, блокировка),
+# снимаются с маршрута догрузкой по ended_at каждые ACTIVE_CHATS_SYNC_INTERVAL сек;
+# полная сверка карты с таблицей раз в ACTIVE_CHATS_CHECK_INTERVAL сек. 0 - выключено
+ACTIVE_CHATS_SYNC_INTERVAL = float(os.getenv('ACTIVE_CHATS_SYNC_INTERVAL', 1))
+ACTIVE_CHATS_CHECK_INTERVAL = float(os.getenv('ACTIVE_CHATS_CHECK_INTERVAL', 600))
+# Перекрытие окна догрузки завершенных чатов (сек)
+ACTIVE_CHATS_SYNC_OVERLAP = 5
+
+# Сколько живет предложение продолжить завершенный чат (сек)
+CHAT_PROPOSAL_TTL = int(os.getenv('CHAT_PROPOSAL_TTL', 86400))
+
+# Счетчик обращений к базе (round trips)
+query_stats = {'round_trips': 0}
+
+# Метрики пула: ожидание db.acquire() и время запросов (мс) по тексту запроса
+acquire_wait = Histogram()
+query_timings = {}
+QUERY_KEY_LENGTH = 80
+
+# Кэш исключений для поиска: кого пользователь заблокировал, кто заблокировал его, с кем чат завершен
+EXCLUSION_CACHE_SIZE = int(os.getenv('EXCLUSION_CACHE_SIZE', 10000))
+EXCLUSION_CACHE_TTL = int(os.getenv('EXCLUSION_CACHE_TTL', 600))  # Ограничивает рассинхронизацию между процессами
+exclusion_cache = LRUCache(maxsize=EXCLUSION_CACHE_SIZE, ttl=EXCLUSION_CACHE_TTL)
+
+# Кэш профилей (строки users) и интересов; update_user_* обновляют его сквозной записью
+PROFILE_CACHE_SIZE = int(os.getenv('PROFILE_CACHE_SIZE', 10000))
+PROFILE_CACHE_TTL = int(os.getenv('PROFILE_CACHE_TTL', 300))
+profile_cache = LRUCache(maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL)
+interests_cache = LRUCache(maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL)
+
+# Отложенная запись сообщений чата: очередь процесса сбрасывается многострочными INSERT
+# по размеру пачки или по интервалу. Очередь ограничена: при переполнении сохранение ждет запись
+MESSAGE_QUEUE_SIZE = int(os.getenv('MESSAGE_QUEUE_SIZE', 10000))
+MESSAGE_FLUSH_BATCH = int(os.getenv('MESSAGE_FLUSH_BATCH', 500))
+MESSAGE_FLUSH_INTERVAL = float(os.getenv('MESSAGE_FLUSH_INTERVAL', 1.0))
+MESSAGE_FLUSH_RETRIES = 3
+message_queue = None
+message_writer_task = None
+message_stats = {'queued': 0, 'written': 0, 'batches': 0, 'dropped': 0}
+
+# Попадания и промахи кэшей профиля
+def profile_cache_stats():
+    return {'profiles': profile_cache.stats(), 'interests': interests_cache.stats()}
+
+# Сквозная запись изменившихся полей в закэшированный профиль
+def _update_cached_profile(user_id, **fields):
+    profile = profile_cache.peek(user_id)
+    if profile is not None:
+        profile.update(fields)
+
+# Учет времени запроса; ключ - начало текста запроса без лишних пробелов
+def _observe_query(query, started):
+    key = ' '.join(query.split())[:QUERY_KEY_LENGTH]
+    histogram = query_timings.get(key)
+    if histogram is None:
+        histogram = query_timings[key] = Histogram()
+    histogram.observe((time.perf_counter() - started) * 1000)
+
+# Выполнение запроса с учетом обращения к базе и его времени
+async def _execute(cursor, query, params=None):
+    query_stats['round_trips'] += 1
+    started = time.perf_counter()
+    try:
+        return await cursor.execute(query, params)
+    finally:
+        _observe_query(query, started)
+
+# Пакетная вставка: aiomysql склеивает INSERT ... VALUES в один многострочный запрос.
+# Остальные запросы (UPDATE, DELETE) он выполняет по одному на строку - так они и считаются
+async def _executemany(cursor, query, rows):
+    query_stats['round_trips'] += 1 if RE_INSERT_VALUES.match(query) else len(rows)
+    started = time.perf_counter()
+    try:
+        return await cursor.executemany(query, rows)
+    finally:
+        _observe_query(query, started)
+
+# Пул aiomysql с замером ожидания свободного соединения; остальное проксируется как есть
+class InstrumentedPool:
+    def __init__(self, pool):
+        self._pool = pool
+        self.waiting = 0  # Сколько корутин сейчас ждут соединение
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        self.waiting += 1
+        started = time.perf_counter()
+        try:
+            conn = await self._pool.acquire()
+        finally:
+            self.waiting -= 1
+        acquire_wait.observe((time.perf_counter() - started) * 1000)
+        try:
+            yield conn
+        finally:
+            await self._pool.release(conn)
+
+# Снимок метрик пула: занятые и свободные соединения, ожидание acquire, самые долгие запросы
+def pool_stats(top=10):
+    stats = {'acquire_wait_ms': acquire_wait.snapshot(), 'round_trips': query_stats['round_trips']}
+    if db is not None:
+        stats.update(
+            size=db.size, in_use=db.size - db.freesize, idle=db.freesize,
+            waiting=db.waiting, minsize=db.minsize, maxsize=db.maxsize
+        )
+    slowest = sorted(query_timings.items(), key=lambda item: item[1].total, reverse=True)[:top]
+    stats['queries_ms'] = {key: histogram.snapshot() for key, histogram in slowest}
+    return stats
+
+# Открытие соединений заранее, чтобы первые апдейты не ждали подключения к MySQL
+async def prewarm_pool(count=None):
+    count = min(DB_POOL_PREWARM if count is None else count, DB_POOL_MAX)
+    # Берем соединения одновременно, иначе пул будет отдавать одно и то же
+    conns = await asyncio.gather(*(db._pool.acquire() for _ in range(count)))
+    try:
+        await asyncio.gather(*(conn.ping() for conn in conns))
+    finally:
+        for conn in conns:
+            await db._pool.release(conn)
+    logging.info(f"Пул прогрет: {db.size} соединений, свободно {db.freesize}")
+
+# Периодический вывод метрик пула и кэша профилей в лог
+async def log_pool_stats(interval):
+    while True:
+        await asyncio.sleep(interval)
+        logging.info(f"Метрики пула: {pool_stats(top=5)}")
+        logging.info(f"Метрики кэша профилей: {profile_cache_stats()}")
+
 # Инициализация базы данных
 async def init_db():
     global db
     if db is None:
-        db = await aiomysql.create_pool(
+        pool = await aiomysql.create_pool(
             host=os.getenv('DB_HOST'),
-            port=3306,
+            port=DB_PORT,
             user=os.getenv('DB_USER'),
             password=os.getenv('DB_PASSWORD'),
             db=os.getenv('DB_NAME'),
-            autocommit=True
+            autocommit=True,
+            minsize=DB_POOL_MIN,
+            maxsize=DB_POOL_MAX,
+            pool_recycle=DB_POOL_RECYCLE,
+            connect_timeout=DB_CONNECT_TIMEOUT,
+            client_flag=CLIENT.FOUND_ROWS  # rowcount UPDATE - найденные строки, а не измененные
         )
+        db = InstrumentedPool(pool)
         logging.info("Database connection successfully initialized")
     else:
         logging.warning("Database connection is already initialized")
@@ -29,6 +192,8 @@ async def init_db():
 # Закрытие базы данных
 async def close_db():
     global db
+    # Сначала дописываем буфер сообщений, пока пул еще открыт
+    await stop_message_writer()
     if db is not None:
         logging.info("Closing database connection...")
         db.close()  # Закрываем пул соединений
@@ -56,317 +221,1454 @@ async def check_db_connection():
     else:
         logging.info("Database connection is active")
 
-# Добавьте создание таблицы пользователей в отдельную функцию
-async def create_user_table():
-    global db
+# Таблицы первой версии схемы (миграция 1). Определения заморожены: свежая база проходит все миграции
+# по порядку, и каждая следующая добавляет свои колонки, индексы и таблицы собственным DDL
+SCHEMA_TABLES = (
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        username VARCHAR(255) NOT NULL,
+        gender VARCHAR(50),
+        orientation VARCHAR(50),
+        interests TEXT,
+        interests_mask BIGINT UNSIGNED NOT NULL DEFAULT 0,
+        location VARCHAR(255),
+        lat DOUBLE,
+        lon DOUBLE,
+        distance INT,
+        lang VARCHAR(10) DEFAULT 'en',
+        profile_photo VARCHAR(255),
+        age INT,
+        birth_year INT,
+        ban_until INT,
+        custom_gender VARCHAR(50),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE KEY uq_users_user_id (user_id),
+        KEY idx_users_username (username)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS user_interests (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        interest VARCHAR(100) NOT NULL,
+        KEY idx_user_interests_user (user_id, interest)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS waiting_list (
+        user_id BIGINT PRIMARY KEY,
+        username VARCHAR(255),
+        gender VARCHAR(50),
+        orientation VARCHAR(50),
+        interests TEXT,
+        interests_mask BIGINT UNSIGNED NOT NULL DEFAULT 0,
+        location VARCHAR(255),
+        lat DOUBLE,
+        lon DOUBLE,
+        request_time DATETIME,
+        KEY idx_waiting_list_lat_lon (lat, lon)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS active_chats (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        partner_id BIGINT NOT NULL,
+        status VARCHAR(20) NOT NULL DEFAULT 'active',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        KEY idx_active_chats_user (user_id),
+        KEY idx_active_chats_partner (partner_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS finished_chats (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        partner_id BIGINT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        KEY idx_finished_chats_pair (user_id, partner_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS blocked_users (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        blocker_id BIGINT NOT NULL,
+        blocked_id BIGINT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        KEY idx_blocked_users_pair (blocker_id, blocked_id),
+        KEY idx_blocked_users_blocked (blocked_id, blocker_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS chat_messages (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        sender_id BIGINT NOT NULL,
+        receiver_id BIGINT NOT NULL,
+        message_id BIGINT NOT NULL,
+        content TEXT,
+        type VARCHAR(20) NOT NULL DEFAULT 'text',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        KEY idx_chat_messages_pair (sender_id, receiver_id, message_id)
+    )
+    """,
+)
+
+# Таблицы, которые добавили миграции 7-10; у каждой миграции свое замороженное определение
+MEDIA_JOBS_TABLE = """
+    CREATE TABLE IF NOT EXISTS media_jobs (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        sender_id BIGINT NOT NULL,
+        receiver_id BIGINT NOT NULL,
+        message_id BIGINT NOT NULL,
+        file_id VARCHAR(255) NOT NULL,
+        type VARCHAR(20) NOT NULL,
+        status VARCHAR(20) NOT NULL DEFAULT 'pending',
+        local_path VARCHAR(255),
+        attempts INT NOT NULL DEFAULT 0,
+        last_error TEXT,
+        next_attempt_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        KEY idx_media_jobs_due (status, next_attempt_at)
+    )
+"""
+
+MEDIA_STORE_TABLES = (
+    """
+    CREATE TABLE IF NOT EXISTS media_blobs (
+        sha256 CHAR(64) PRIMARY KEY,
+        path VARCHAR(255) NOT NULL,
+        size BIGINT NOT NULL,
+        ref_count INT NOT NULL DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE KEY uq_media_blobs_path (path)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS media_aliases (
+        file_unique_id VARCHAR(64) PRIMARY KEY,
+        sha256 CHAR(64) NOT NULL,
+        KEY idx_media_aliases_sha256 (sha256)
+    )
+    """,
+)
+
+MEDIA_FILE_IDS_TABLE = """
+    CREATE TABLE IF NOT EXISTS media_file_ids (
+        path VARCHAR(255) PRIMARY KEY,
+        file_id VARCHAR(255) NOT NULL,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+    )
+"""
+
+CHAT_PROPOSALS_TABLE = """
+    CREATE TABLE IF NOT EXISTS chat_proposals (
+        proposer_id BIGINT NOT NULL,
+        target_id BIGINT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+        PRIMARY KEY (proposer_id, target_id)
+    )
+"""
+
+# Создание отсутствующих таблиц по списку CREATE TABLE IF NOT EXISTS
+async def create_tables(statements=SCHEMA_TABLES):
+    async with db.acquire() as conn:
+        async with conn.cursor() as cursor:
+            for statement in statements:
+                await _execute(cursor, statement)
+            await conn.commit()
+
+# Проверка наличия колонки в таблице текущей базы
+async def _column_exists(cursor, table, column):
+    await _execute(
+        cursor,
+        """
+        SELECT 1 FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s
+        """,
+        (table, column)
+    )
+    return await cursor.fetchone() is not None
+
+# Миграция: битовая маска интересов в users и waiting_list и заполнение из старых данных
+async def migrate_interests_mask():
+    async with db.acquire() as conn:
+        async with conn.cursor() as cursor:
+            for table in ('users', 'waiting_list'):
+                if not await _column_exists(cursor, table, 'interests_mask'):
+                    await _execute(
+                        cursor,
+                        f"ALTER TABLE {table} ADD COLUMN interests_mask BIGINT UNSIGNED NOT NULL DEFAULT 0"
+                    )
+                    logging.info(f"Добавлена колонка interests_mask в таблицу {table}")
+
+            # Профили: маска из строк user_interests
+            await _execute(cursor, "SELECT user_id, interest FROM user_interests")
+            user_masks = {}
+            for user_id, interest in await cursor.fetchall():
+                user_masks[user_id] = user_masks.get(user_id, 0) | interests_to_mask([interest])
+            if user_masks:
+                await _executemany(
+                    cursor,
+                    "UPDATE users SET interests_mask = %s WHERE user_id = %s",
+                    [(mask, user_id) for user_id, mask in user_masks.items()]
+                )
+
+            # Список ожидания: маска из строки interests
+            await _execute(cursor, "SELECT user_id, interests FROM waiting_list")
+            waiting_masks = [(interests_to_mask(interests), user_id) for user_id, interests in await cursor.fetchall()]
+            if waiting_masks:
+                await _executemany(
+                    cursor,
+                    "UPDATE waiting_list SET interests_mask = %s WHERE user_id = %s", waiting_masks
+                )
+            await conn.commit()
+    logging.info(f"Маски интересов заполнены: {len(user_masks)} профилей, {len(waiting_masks)} в списке ожидания")
+
+# Проверка наличия индекса в таблице текущей базы
+async def _index_exists(cursor, table, index_name):
+    await _execute(
+        cursor,
+        """
+        SELECT 1 FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s
+        """,
+        (table, index_name)
+    )
+    return await cursor.fetchone() is not None
+
+# Миграция: числовые lat/lon вместо строки "lat, lon", индекс для отсечения по прямоугольнику
+async def migrate_location_columns():
+    async with db.acquire() as conn:
+        async with conn.cursor() as cursor:
+            for table in ('users', 'waiting_list'):
+                for column in ('lat', 'lon'):
+                    if not await _column_exists(cursor, table, column):
+                        await _execute(cursor, f"ALTER TABLE {table} ADD COLUMN {column} DOUBLE NULL")
+                        logging.info(f"Добавлена колонка {column} в таблицу {table}")
+
+                # Переносим координаты из строк, которые еще не сконвертированы
+                await _execute(
+                    cursor,
+                    f"SELECT user_id, location FROM {table} WHERE lat IS NULL AND location IS NOT NULL"
+                )
+                converted = []
+                for user_id, location in await cursor.fetchall():
+                    try:
+                        converted.append((*parse_location(location), user_id))
+                    except ValueError:
+                        logging.warning(f"Некорректное местоположение '{location}' у пользователя {user_id} в {table}")
+                if converted:
+                    await _executemany(
+                        cursor,
+                        f"UPDATE {table} SET lat = %s, lon = %s WHERE user_id = %s", converted
+                    )
+                    logging.info(f"Координаты сконвертированы: {len(converted)} строк в {table}")
+
+            if not await _index_exists(cursor, 'waiting_list', 'idx_waiting_list_lat_lon'):
+                await _execute(cursor, "CREATE INDEX idx_waiting_list_lat_lon ON waiting_list (lat, lon)")
+            await conn.commit()
+
+# Миграция: уникальный user_id в users, нужен для UPSERT профиля в конце регистрации.
+# Дубликаты могли появиться при повторном /start посреди регистрации, оставляем самую раннюю строку
+async def migrate_users_unique_user_id():
+    async with db.acquire() as conn:
+        async with conn.cursor() as cursor:
+            if await _index_exists(cursor, 'users', 'uq_users_user_id'):
+                return
+            removed = await _execute(
+                cursor,
+                "DELETE newer FROM users newer JOIN users older ON newer.user_id = older.user_id AND newer.id > older.id"
+            )
+            if removed:
+                logging.warning(f"Удалены дубликаты профилей: {removed} строк")
+            await _execute(cursor, "CREATE UNIQUE INDEX uq_users_user_id ON users (user_id)")
+            await conn.commit()
+
+# Вторичные индексы горячих запросов на момент миграции 5: (таблица, индекс, колонки). Список заморожен,
+# индексы следующих версий создают их собственные миграции
+SCHEMA_INDEXES = (
+    ('users', 'idx_users_username', 'username'),
+    ('user_interests', 'idx_user_interests_user', 'user_id, interest'),
+    ('active_chats', 'idx_active_chats_user', 'user_id'),
+    ('active_chats', 'idx_active_chats_partner', 'partner_id'),
+    ('finished_chats', 'idx_finished_chats_pair', 'user_id, partner_id'),
+    ('blocked_users', 'idx_blocked_users_pair', 'blocker_id, blocked_id'),
+    ('blocked_users', 'idx_blocked_users_blocked', 'blocked_id, blocker_id'),
+    ('chat_messages', 'idx_chat_messages_pair', 'sender_id, receiver_id, message_id'),
+)
+
+# Миграция: индексы для существующих баз, созданных до SCHEMA_TABLES
+async def create_indexes(indexes=SCHEMA_INDEXES):
+    async with db.acquire() as conn:
+        async with conn.cursor() as cursor:
+            for table, index_name, columns in indexes:
+                if not await _index_exists(cursor, table, index_name):
+                    await _execute(cursor, f"CREATE INDEX {index_name} ON {table} ({columns})")
+                    logging.info(f"Создан индекс {index_name} на {table} ({columns})")
+            await conn.commit()
+
+# Миграция: ключ переписки, не зависящий от направления (меньший и больший id собеседников).
+# История читается одним диапазоном индекса вместо OR по двум направлениям
+async def migrate_chat_conversation_key():
+    async with db.acquire() as conn:
+        async with conn.cursor() as cursor:
+            for column, function in (('pair_low', 'LEAST'), ('pair_high', 'GREATEST')):
+                if not await _column_exists(cursor, 'chat_messages', column):
+                    await _execute(
+                        cursor,
+                        f"ALTER TABLE chat_messages ADD COLUMN {column} BIGINT AS ({function}(sender_id, receiver_id)) STORED"
+                    )
+                    logging.info(f"Добавлена колонка {column} в таблицу chat_messages")
+            if not await _index_exists(cursor, 'chat_messages', 'idx_chat_messages_conversation'):
+                await _execute(
+                    cursor,
+                    "CREATE INDEX idx_chat_messages_conversation ON chat_messages (pair_low, pair_high, message_id)"
+                )
+            await conn.commit()
+
+# Миграция: file_id медиа в chat_messages и постоянная очередь скачивания media_jobs
+async def migrate_media_jobs():
+    async with db.acquire() as conn:
+        async with conn.cursor() as cursor:
+            if not await _column_exists(cursor, 'chat_messages', 'file_id'):
+                await _execute(cursor, "ALTER TABLE chat_messages ADD COLUMN file_id VARCHAR(255) AFTER content")
+                logging.info("Добавлена колонка file_id в таблицу chat_messages")
+            await conn.commit()
+    await create_tables((MEDIA_JOBS_TABLE,))
+
+# Миграция: хранилище медиа по содержимому (media_blobs, media_aliases) и file_unique_id в заданиях
+async def migrate_media_store():
     async with db.acquire() as conn:
         async with conn.cursor() as cursor:
-            await cursor.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    user_id BIGINT NOT NULL,
-                    username VARCHAR(255) NOT NULL,
-                    gender VARCHAR(50),
-                    orientation VARCHAR(50),
-                    interests TEXT,
-                    location VARCHAR(255),
-                    lang VARCHAR(10) DEFAULT 'en',
-                    profile_photo VARCHAR(255),
-                    age INT,
-                    birth_year INT,
-                    ban_until INT,
-                    custom_gender VARCHAR(50),
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            if not await _column_exists(cursor, 'media_jobs', 'file_unique_id'):
+                await _execute(cursor, "ALTER TABLE media_jobs ADD COLUMN file_unique_id VARCHAR(64) AFTER file_id")
+            await conn.commit()
+    await create_tables(MEDIA_STORE_TABLES)
+
+# Миграция: file_id Telegram для локальных файлов, чтобы не загружать их повторно
+async def migrate_media_file_ids():
+    await create_tables((MEDIA_FILE_IDS_TABLE,))
+
+# Миграция: предложения продолжить завершенный чат хранятся в базе, а не в кнопке
+async def migrate_chat_proposals():
+    await create_tables((CHAT_PROPOSALS_TABLE,))
+
+# Миграция: индекс по request_time для догрузки очереди в индекс поиска
+async def migrate_waiting_list_request_time():
+    await create_indexes((('waiting_list', 'idx_waiting_list_request_time', 'request_time'),))
+
+# Миграция: время завершения чата, по нему другие процессы снимают маршрут
+async def migrate_active_chats_ended_at():
+    async with db.acquire() as conn:
+        async with conn.cursor() as cursor:
+            if not await _column_exists(cursor, 'active_chats', 'ended_at'):
+                await _execute(cursor, "ALTER TABLE active_chats ADD COLUMN ended_at TIMESTAMP NULL DEFAULT NULL")
+                logging.info("Добавлена колонка ended_at в таблицу active_chats")
+            if not await _index_exists(cursor, 'active_chats', 'idx_active_chats_ended_at'):
+                await _execute(cursor, "CREATE INDEX idx_active_chats_ended_at ON active_chats (ended_at)")
+            await conn.commit()
+
+# Миграция: аренда заданий архивирования, чтобы одно задание не брали несколько воркеров и процессов
+async def migrate_media_job_lease():
+    async with db.acquire() as conn:
+        async with conn.cursor() as cursor:
+            if not await _column_exists(cursor, 'media_jobs', 'locked_until'):
+                await _execute(cursor, "ALTER TABLE media_jobs ADD COLUMN locked_until DATETIME NULL DEFAULT NULL")
+                logging.info("Добавлена колонка locked_until в таблицу media_jobs")
+            if not await _index_exists(cursor, 'media_jobs', 'idx_media_jobs_lease'):
+                await _execute(cursor, "CREATE INDEX idx_media_jobs_lease ON media_jobs (status, locked_until)")
+            await conn.commit()
+
+# Миграция: история читается по id строки, а не по message_id отправителя
+async def migrate_chat_history_order():
+    async with db.acquire() as conn:
+        async with conn.cursor() as cursor:
+            if not await _index_exists(cursor, 'chat_messages', 'idx_chat_messages_history'):
+                await _execute(cursor, "CREATE INDEX idx_chat_messages_history ON chat_messages (pair_low, pair_high, id)")
+            if await _index_exists(cursor, 'chat_messages', 'idx_chat_messages_conversation'):
+                await _execute(cursor, "DROP INDEX idx_chat_messages_conversation ON chat_messages")
+            await conn.commit()
+
+# Миграция: уникальный никнейм. Две одновременные регистрации проходили проверку на шаге никнейма,
+# а строка users пишется только на шаге локации. Более поздние дубликаты получают суффикс _<user_id>
+async def migrate_users_unique_username():
+    async with db.acquire() as conn:
+        async with conn.cursor() as cursor:
+            if not await _index_exists(cursor, 'users', 'uq_users_username'):
+                renamed = await _execute(
+                    cursor,
+                    """
+                    UPDATE users newer JOIN users older ON newer.username = older.username AND newer.id > older.id
+                    SET newer.username = LEFT(CONCAT(newer.username, '_', newer.user_id), 255)
+                    """
                 )
-            """)
+                if renamed:
+                    logging.warning(f"Переименованы повторяющиеся никнеймы: {renamed} строк")
+                await _execute(cursor, "CREATE UNIQUE INDEX uq_users_username ON users (username)")
+            # Обычный индекс по username дублирует уникальный
+            if await _index_exists(cursor, 'users', 'idx_users_username'):
+                await _execute(cursor, "DROP INDEX idx_users_username ON users")
             await conn.commit()
 
+# Версионированные миграции: (версия, описание, шаг). Примененные версии записываются в schema_migrations.
+# DDL в MySQL не откатывается транзакцией, поэтому каждый шаг идемпотентен и может быть повторен
+# после сбоя. Выпущенные шаги не меняются, изменения схемы добавляются новой версией в конец
+MIGRATIONS = (
+    (1, 'create tables', create_tables),
+    (2, 'interests bitmask', migrate_interests_mask),
+    (3, 'numeric lat/lon', migrate_location_columns),
+    (4, 'unique users.user_id', migrate_users_unique_user_id),
+    (5, 'hot query indexes', create_indexes),
+    (6, 'chat conversation key', migrate_chat_conversation_key),
+    (7, 'media archive jobs', migrate_media_jobs),
+    (8, 'content-addressed media store', migrate_media_store),
+    (9, 'media file_id cache', migrate_media_file_ids),
+    (10, 'chat proposals', migrate_chat_proposals),
+    (11, 'waiting list request_time index', migrate_waiting_list_request_time),
+    (12, 'active chats ended_at', migrate_active_chats_ended_at),
+    (13, 'media job lease', migrate_media_job_lease),
+    (14, 'chat history order by id', migrate_chat_history_order),
+    (15, 'unique users.username', migrate_users_unique_username),
+)
+
+# Применение недостающих миграций. Именованная блокировка не дает двум процессам мигрировать одновременно
+async def run_migrations():
+    async with db.acquire() as conn:
+        async with conn.cursor() as cursor:
+            await _execute(cursor, "SELECT GET_LOCK('schema_migrations', 60)")
+            if (await cursor.fetchone())[0] != 1:
+                raise RuntimeError("Не удалось получить блокировку миграций schema_migrations")
+            try:
+                await _execute(cursor, """
+                    CREATE TABLE IF NOT EXISTS schema_migrations (
+                        version INT PRIMARY KEY,
+                        name VARCHAR(255) NOT NULL,
+                        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """)
+                await _execute(cursor, "SELECT version FROM schema_migrations")
+                applied = {row[0] for row in await cursor.fetchall()}
+                for version, name, step in MIGRATIONS:
+                    if version in applied:
+                        continue
+                    logging.info(f"Миграция {version}: {name}")
+                    await step()
+                    await _execute(
+                        cursor,
+                        "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name)
+                    )
+                    await conn.commit()
+            finally:
+                await _execute(cursor, "SELECT RELEASE_LOCK('schema_migrations')")
+
+# Запросы горячих путей. verify_indexes проверяет через EXPLAIN именно эти строки
+USER_BY_ID_QUERY = "SELECT * FROM users WHERE user_id = %s"
+NICKNAME_QUERY = "SELECT COUNT(*) FROM users WHERE username = %s"
+USER_INTERESTS_QUERY = "SELECT interest FROM user_interests WHERE user_id = %s"
+BLOCK_EXISTS_QUERY = "SELECT 1 FROM blocked_users WHERE blocker_id = %s AND blocked_id = %s"
+FINISHED_EXISTS_QUERY = "SELECT * FROM finished_chats WHERE user_id = %s AND partner_id = %s"
+ACTIVE_CHAT_QUERY = "SELECT partner_id FROM active_chats WHERE user_id = %s AND status != 'finished' ORDER BY id DESC LIMIT 1"
+# Никто из пары не должен уже состоять в активном чате
+BUSY_CHAT_QUERY = """
+    SELECT 1 FROM active_chats
+    WHERE status != 'finished'
+      AND (user_id IN (%s, %s) OR partner_id IN (%s, %s))
+    LIMIT 1
+"""
+ENDED_CHATS_QUERY = """
+    SELECT a.user_id, a.partner_id FROM active_chats a
+    WHERE a.ended_at >= %s - INTERVAL %s SECOND
+      AND NOT EXISTS (
+            SELECT 1 FROM active_chats n
+            WHERE n.user_id = a.user_id AND n.status != 'finished' AND n.id > a.id
+        )
+"""
+WAITING_LIST_FIELDS = "user_id, username, gender, orientation, interests, interests_mask, lat, lon, request_time"
+WAITING_LIST_CHANGES_QUERY = f"SELECT {WAITING_LIST_FIELDS} FROM waiting_list WHERE request_time >= %s - INTERVAL %s SECOND"
+MEDIA_JOB_FIELDS = "id, sender_id, receiver_id, message_id, file_id, file_unique_id, type, status, local_path, attempts"
+MEDIA_JOBS_DUE_QUERY = f"""
+    SELECT {MEDIA_JOB_FIELDS} FROM media_jobs
+    WHERE status IN ('pending', 'linked') AND next_attempt_at <= NOW()
+    ORDER BY next_attempt_at
+    LIMIT %s
+    FOR UPDATE SKIP LOCKED
+"""
+MEDIA_JOBS_EXPIRED_QUERY = f"""
+    SELECT {MEDIA_JOB_FIELDS} FROM media_jobs
+    WHERE status = 'running' AND locked_until <= NOW()
+    LIMIT %s
+    FOR UPDATE SKIP LOCKED
+"""
+
+# Индексы, которые должны быть в актуальной схеме: (таблица, индекс).
+# idx_users_username заменен уникальным uq_users_username в миграции 15
+REQUIRED_INDEXES = (
+    *((table, index_name) for table, index_name, _ in SCHEMA_INDEXES if index_name != 'idx_users_username'),
+    ('users', 'uq_users_user_id'),
+    ('users', 'uq_users_username'),
+    ('waiting_list', 'idx_waiting_list_lat_lon'),
+    ('waiting_list', 'idx_waiting_list_request_time'),
+    ('active_chats', 'idx_active_chats_ended_at'),
+    ('chat_messages', 'idx_chat_messages_history'),
+    ('media_jobs', 'idx_media_jobs_due'),
+    ('media_jobs', 'idx_media_jobs_lease'),
+)
+
+# Ниже этого числа строк (по оценке EXPLAIN) оптимизатор вправе читать таблицу целиком:
+# отказ от индекса на такой таблице - предупреждение, а не ошибка запуска
+INDEX_CHECK_MIN_ROWS = int(os.getenv('INDEX_CHECK_MIN_ROWS', 1000))
+
+# Горячие запросы с примерами параметров и индексы, которые план должен выбрать:
+# (запрос, параметры, {таблица или псевдоним в EXPLAIN: допустимые индексы})
+def hot_queries():
+    match_params = {'user_id': 0, 'search_gender': 'Female', 'interests_mask': 0, 'lat': 43.2, 'lon': 76.9, 'limit': 5}
+    return (
+        (USER_BY_ID_QUERY, (0,), {'users': ('uq_users_user_id',)}),
+        (NICKNAME_QUERY, ('',), {'users': ('uq_users_username',)}),
+        (USER_INTERESTS_QUERY, (0,), {'user_interests': ('idx_user_interests_user',)}),
+        (BLOCK_EXISTS_QUERY, (0, 0), {'blocked_users': ('idx_blocked_users_pair',)}),
+        (FINISHED_EXISTS_QUERY, (0, 0), {'finished_chats': ('idx_finished_chats_pair',)}),
+        (ACTIVE_CHAT_QUERY, (0,), {'active_chats': ('idx_active_chats_user',)}),
+        (BUSY_CHAT_QUERY, (0, 0, 0, 0), {'active_chats': ('idx_active_chats_user', 'idx_active_chats_partner')}),
+        (ENDED_CHATS_QUERY, ('2000-01-01', ACTIVE_CHATS_SYNC_OVERLAP),
+         {'a': ('idx_active_chats_ended_at',), 'n': ('idx_active_chats_user',)}),
+        (CHAT_HISTORY_CHECK, {'a': 0, 'b': 0}, {
+            'finished_chats': ('idx_finished_chats_pair',),
+            'active_chats': ('idx_active_chats_user',),
+            'blocked_users': ('idx_blocked_users_pair',),
+        }),
+        (SEARCH_CONTEXT_QUERY, (0, 0, 0, 0), {
+            'users': ('uq_users_user_id',),
+            'blocked_users': ('idx_blocked_users_pair', 'idx_blocked_users_blocked'),
+            'finished_chats': ('idx_finished_chats_pair',),
+        }),
+        (MATCH_QUERY, match_params, {
+            'users': ('uq_users_user_id',),
+            'wl': ('idx_waiting_list_lat_lon',),
+            'b': ('idx_blocked_users_pair', 'idx_blocked_users_blocked'),
+            'f': ('idx_finished_chats_pair',),
+        }),
+        (HISTORY_PAGE_QUERY.format(condition="", order="DESC"), (0, 0, 51),
+         {'chat_messages': ('idx_chat_messages_history',)}),
+        (HISTORY_PAGE_QUERY.format(condition="AND id < %s", order="DESC"), (0, 0, 0, 51),
+         {'chat_messages': ('idx_chat_messages_history',)}),
+        (WAITING_LIST_CHANGES_QUERY, ('2000-01-01', WAITING_INDEX_REFRESH_OVERLAP),
+         {'waiting_list': ('idx_waiting_list_request_time',)}),
+        (MEDIA_JOBS_DUE_QUERY, (10,), {'media_jobs': ('idx_media_jobs_due',)}),
+        (MEDIA_JOBS_EXPIRED_QUERY, (10,), {'media_jobs': ('idx_media_jobs_lease',)}),
+    )
+
+# Проверка при старте: все индексы схемы существуют, а EXPLAIN горячих запросов выбирает их (колонка key;
+# possible_keys только перечисляет кандидатов). Любое расхождение на заполненной таблице - ошибка запуска
+# с перечнем запросов и индексов, а не тихий полный просмотр таблицы
+async def verify_indexes():
+    problems = []
+    warnings = []
+    queries = hot_queries()
+    async with db.acquire() as conn:
+        async with conn.cursor(aiomysql.DictCursor) as cursor:
+            for table, index_name in REQUIRED_INDEXES:
+                if not await _index_exists(cursor, table, index_name):
+                    problems.append(f"нет индекса {index_name} на {table}")
+
+            for query, params, expected in queries:
+                await _execute(cursor, f"EXPLAIN {query}", params)
+                for row in await cursor.fetchall():
+                    indexes = expected.get(row['table'])
+                    if indexes is None:
+                        continue
+                    # На пустой таблице оптимизатор может не дойти до выбора индекса
+                    extra = row.get('Extra') or ''
+                    if 'no matching row' in extra or 'Impossible' in extra:
+                        continue
+                    used = set((row.get('key') or '').split(','))
+                    # Диапазон по индексу выбирается для каждой строки соединения (прямоугольник поиска)
+                    if 'Range checked for each record' in extra:
+                        used |= set((row.get('possible_keys') or '').split(','))
+                    if used & set(indexes):
+                        continue
+                    message = (
+                        f"запрос {' '.join(query.split())[:120]!r}: таблица {row['table']} читается через "
+                        f"{row.get('key') or 'полный просмотр'} вместо {' или '.join(indexes)}"
+                    )
+                    if (row.get('rows') or 0) < INDEX_CHECK_MIN_ROWS:
+                        warnings.append(message)
+                    else:
+                        problems.append(message)
+    for message in warnings:
+        logging.warning(f"Проверка индексов (таблица мала, план может смениться с ростом): {message}")
+    if problems:
+        for message in problems:
+            logging.critical(f"Проверка индексов: {message}")
+        raise RuntimeError("Проверка индексов не пройдена:\n" + "\n".join(problems))
+    logging.info(f"Проверка индексов пройдена: {len(queries)} горячих запросов")
 
 # Функция создания пользователя
 async def create_user(user_id, username):
     async with db.acquire() as conn:
         async with conn.cursor() as cursor:
-            await cursor.execute(
+            await _execute(
+                cursor,
                 "INSERT INTO users (user_id, username) VALUES (%s, %s)", 
                 (user_id, username)
             )
             await conn.commit()
+    profile_cache.pop(user_id)
+    interests_cache.pop(user_id)
 
 # Получение пользователя по его ID
 async def get_user_by_id(user_id):
-    async with db.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute("SELECT * FROM users WHERE user_id = %s", (user_id,))
-            return await cursor.fetchone()
+    profile = profile_cache.get(user_id)
+    if profile is None:
+        async with db.acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cursor:
+                await _execute(cursor, USER_BY_ID_QUERY, (user_id,))
+                profile = await cursor.fetchone()
+        if profile is None:
+            return None
+        profile_cache.set(user_id, profile)
+    return dict(profile)  # Копия, чтобы вызывающий код не менял кэш
 
 # Обновление языка пользователя
 async def update_user_language(user_id, lang_code):
     async with db.acquire() as conn:
         async with conn.cursor() as cursor:
-            await cursor.execute("UPDATE users SET lang = %s WHERE user_id = %s", (lang_code, user_id))
+            await _execute(cursor, "UPDATE users SET lang = %s WHERE user_id = %s", (lang_code, user_id))
             await conn.commit()
+    _update_cached_profile(user_id, lang=lang_code)
 
 # Обновление пола пользователя
 async def update_user_gender(user_id, gender):
     async with db.acquire() as conn:
         async with conn.cursor() as cursor:
-            await cursor.execute("UPDATE users SET gender = %s WHERE user_id = %s", (gender, user_id))
+            await _execute(cursor, "UPDATE users SET gender = %s WHERE user_id = %s", (gender, user_id))
             await conn.commit()
+    _update_cached_profile(user_id, gender=gender)
 
 # Обновление ориентации пользователя
 async def update_user_orientation(user_id: int, orientation: str):
     async with db.acquire() as conn:
         async with conn.cursor() as cursor:
-            await cursor.execute(
+            await _execute(
+                cursor,
                 "UPDATE users SET orientation = %s WHERE user_id = %s",
                 (orientation, user_id)
             )
             await conn.commit()
+    _update_cached_profile(user_id, orientation=orientation)
 
 # Функция для получения интересов пользователя из новой таблицы
 async def get_user_interests(user_id):
-    async with db.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute("SELECT interest FROM user_interests WHERE user_id = %s", (user_id,))
-            interests = await cursor.fetchall()
-            return [row['interest'] for row in interests]  # Возвращаем список интересов
+    interests = interests_cache.get(user_id)
+    if interests is None:
+        async with db.acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cursor:
+                await _execute(cursor, USER_INTERESTS_QUERY, (user_id,))
+                interests = [row['interest'] for row in await cursor.fetchall()]
+        interests_cache.set(user_id, interests)
+    return list(interests)  # Возвращаем список интересов
 
 
-# Обновление интересов пользователя (добавление новых интересов)
-async def update_user_interests(user_id, interests):
+# Запись интересов нескольких пользователей по разнице с текущими строками user_interests:
+# одна выборка, один DELETE убранных, одна многострочная вставка добавленных и один UPDATE масок.
+# Коммит - на вызывающем
+async def _write_interests(cursor, interests_by_user):
+    user_ids = list(interests_by_user)
+    placeholders = ', '.join(['%s'] * len(user_ids))
+    await _execute(
+        cursor,
+        f"SELECT user_id, interest FROM user_interests WHERE user_id IN ({placeholders}) FOR UPDATE",
+        user_ids
+    )
+    current = {user_id: set() for user_id in user_ids}
+    for user_id, interest in await cursor.fetchall():
+        current[user_id].add(interest)
+
+    removed, added = [], []
+    for user_id, interests in interests_by_user.items():
+        wanted = set(interests)
+        removed.extend((user_id, interest) for interest in current[user_id] - wanted)
+        added.extend((user_id, interest) for interest in interests if interest not in current[user_id])
+
+    if removed:
+        pairs = ', '.join(['(%s, %s)'] * len(removed))
+        await _execute(
+            cursor,
+            f"DELETE FROM user_interests WHERE (user_id, interest) IN ({pairs})",
+            [value for pair in removed for value in pair]
+        )
+    if added:
+        await _executemany(cursor, "INSERT INTO user_interests (user_id, interest) VALUES (%s, %s)", added)
+    masks = [(user_id, interests_to_mask(interests)) for user_id, interests in interests_by_user.items()]
+    await _execute(
+        cursor,
+        f"UPDATE users SET interests_mask = CASE user_id {' '.join(['WHEN %s THEN %s'] * len(masks))} END"
+        f" WHERE user_id IN ({placeholders})",
+        [value for pair in masks for value in pair] + user_ids
+    )
+
+# Пакетное обновление интересов: {user_id: [интересы]} одной транзакцией (импорт, миграции)
+async def update_users_interests(interests_by_user):
+    interests_by_user = {
+        user_id: list(dict.fromkeys(interests))  # Без повторов, порядок сохраняется
+        for user_id, interests in interests_by_user.items()
+    }
+    if not interests_by_user:
+        return
     async with db.acquire() as conn:
         async with conn.cursor() as cursor:
-            # Сначала удаляем старые интересы пользователя
-            await cursor.execute("DELETE FROM user_interests WHERE user_id = %s", (user_id,))
-            await conn.commit()
+            await conn.begin()
+            try:
+                await _write_interests(cursor, interests_by_user)
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+    for user_id, interests in interests_by_user.items():
+        interests_cache.set(user_id, interests)
+        _update_cached_profile(user_id, interests_mask=interests_to_mask(interests))
 
-            # Затем добавляем новые интересы
-            for interest in interests:
-                await cursor.execute(
-                    "INSERT INTO user_interests (user_id, interest) VALUES (%s, %s)", 
-                    (user_id, interest)
-                )
-            await conn.commit()
+# Обновление интересов пользователя: меняются только добавленные и убранные строки
+async def update_user_interests(user_id, interests):
+    await update_users_interests({user_id: interests})
 
 # Обновление возраста пользователя
 async def update_user_age(user_id, age):
     async with db.acquire() as conn:
         async with conn.cursor() as cursor:
-            await cursor.execute("UPDATE users SET age = %s WHERE user_id = %s", (age, user_id))
+            await _execute(cursor, "UPDATE users SET age = %s WHERE user_id = %s", (age, user_id))
             await conn.commit()
+    _update_cached_profile(user_id, age=age)
 
 # Обновление года рождения пользователя
 async def update_user_birth_year(user_id, birth_year):
     async with db.acquire() as conn:
         async with conn.cursor() as cursor:
-            await cursor.execute("UPDATE users SET birth_year = %s WHERE user_id = %s", (birth_year, user_id))
+            await _execute(cursor, "UPDATE users SET birth_year = %s WHERE user_id = %s", (birth_year, user_id))
             await conn.commit()
+    _update_cached_profile(user_id, birth_year=birth_year)
 
 # Обновление срока блокировки пользователя
 async def update_user_ban_until(user_id, ban_until):
     async with db.acquire() as conn:
         async with conn.cursor() as cursor:
-            await cursor.execute("UPDATE users SET ban_until = %s WHERE user_id = %s", (ban_until, user_id))
+            await _execute(cursor, "UPDATE users SET ban_until = %s WHERE user_id = %s", (ban_until, user_id))
             await conn.commit()
+    _update_cached_profile(user_id, ban_until=ban_until)
 
 # Обновление фотографии профиля пользователя
 async def update_user_photo(user_id, photo_path):
     async with db.acquire() as conn:
         async with conn.cursor() as cursor:
-            await cursor.execute("UPDATE users SET profile_photo = %s WHERE user_id = %s", (photo_path, user_id))
+            await _execute(cursor, "UPDATE users SET profile_photo = %s WHERE user_id = %s", (photo_path, user_id))
             await conn.commit()
+    _update_cached_profile(user_id, profile_photo=photo_path)
 
 # Обновление местоположения пользователя
-async def update_user_location(user_id, location):
+async def update_user_location(user_id, latitude, longitude):
     async with db.acquire() as conn:
         async with conn.cursor() as cursor:
-            await cursor.execute("UPDATE users SET location = %s WHERE user_id = %s", (location, user_id))
+            await _execute(
+                cursor,
+                "UPDATE users SET lat = %s, lon = %s, location = %s WHERE user_id = %s",
+                (latitude, longitude, format_location(latitude, longitude), user_id)
+            )
             await conn.commit()
+    _update_cached_profile(user_id, lat=latitude, lon=longitude, location=format_location(latitude, longitude))
 
 # Обновление никнейма пользователя
 async def update_user_nickname(user_id, nickname):
     async with db.acquire() as conn:
         async with conn.cursor() as cursor:
-            await cursor.execute("UPDATE users SET username = %s WHERE user_id = %s", (nickname, user_id))
+            await _execute(cursor, "UPDATE users SET username = %s WHERE user_id = %s", (nickname, user_id))
             await conn.commit()
+    _update_cached_profile(user_id, username=nickname)
 
 # Обновление кастомного пола пользователя
 async def update_user_custom_gender(user_id, custom_gender):
     async with db.acquire() as conn:
         async with conn.cursor() as cursor:
-            await cursor.execute("UPDATE users SET gender = 'Other', custom_gender = %s WHERE user_id = %s", (custom_gender, user_id))
+            await _execute(cursor, "UPDATE users SET gender = 'Other', custom_gender = %s WHERE user_id = %s", (custom_gender, user_id))
             await conn.commit()
+    _update_cached_profile(user_id, gender='Other', custom_gender=custom_gender)
+
+# Колонки users, которые регистрация собирает в состоянии FSM
+REGISTRATION_FIELDS = (
+    'username', 'lang', 'age', 'birth_year', 'ban_until', 'gender', 'custom_gender',
+    'orientation', 'profile_photo', 'lat', 'lon'
+)
+
+# Сохранение профиля, собранного при регистрации: запись users и пакетная вставка интересов
+# в одной транзакции вместо отдельного коммита на каждом шаге. False - никнейм уже занят
+async def save_registration(user_id, profile, interests=None):
+    fields = {key: profile[key] for key in REGISTRATION_FIELDS if profile.get(key) is not None}
+    if 'lat' in fields and 'lon' in fields:
+        fields['location'] = format_location(fields['lat'], fields['lon'])
+    columns = ('user_id', *fields)
+    # Не INSERT ... ON DUPLICATE KEY UPDATE: при двух уникальных ключах совпавший никнейм
+    # обновил бы чужую строку. Уникальный ключ никнейма проверяется здесь, а не на шаге ввода
+    insert_query = f"INSERT INTO users ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))})"
+    update_query = f"UPDATE users SET {', '.join(f'{column} = %s' for column in fields)} WHERE user_id = %s"
+
+    async with db.acquire() as conn:
+        async with conn.cursor() as cursor:
+            await conn.begin()
+            try:
+                await _execute(cursor, "SELECT id FROM users WHERE user_id = %s FOR UPDATE", (user_id,))
+                if await cursor.fetchone() is None:
+                    await _execute(cursor, insert_query, (user_id, *fields.values()))
+                elif fields:
+                    await _execute(cursor, update_query, (*fields.values(), user_id))
+                if interests is not None:
+                    await _write_interests(cursor, {user_id: interests})
+                await conn.commit()
+            except aiomysql.IntegrityError as e:
+                await conn.rollback()
+                # Никнейм успели занять после проверки на шаге ввода
+                if e.args[0] == ER_DUP_ENTRY and 'uq_users_username' in str(e):
+                    return False
+                raise
+            except Exception:
+                await conn.rollback()
+                raise
+    profile_cache.pop(user_id)
+    if interests is not None:
+        interests_cache.set(user_id, list(interests))
+    return True
 
 # Добавление в список ожидания
-async def add_to_waiting_list(user_id, username, gender, orientation, interests, location):
+async def add_to_waiting_list(user_id, username, gender, orientation, interests, lat, lon):
     async with db.acquire() as conn:
         async with conn.cursor() as cursor:
             query = """
-                INSERT INTO waiting_list (user_id, username, gender, orientation, interests, location, request_time)
-                VALUES (%s, %s, %s, %s, %s, %s, NOW()) AS new_data
+                INSERT INTO waiting_list (user_id, username, gender, orientation, interests, interests_mask, lat, lon, location, request_time)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, NOW()) AS new_data
                 ON DUPLICATE KEY UPDATE
                     username = new_data.username,
                     gender = new_data.gender,
                     orientation = new_data.orientation,
                     interests = new_data.interests,
+                    interests_mask = new_data.interests_mask,
+                    lat = new_data.lat,
+                    lon = new_data.lon,
                     location = new_data.location,
                     request_time = NOW()
             """
-            await cursor.execute(query, (user_id, username, gender, orientation, interests, location))
+            interests_mask = interests_to_mask(interests)
+            location = format_location(lat, lon)  # Строка сохраняется для совместимости
+            await _execute(cursor, query, (user_id, username, gender, orientation, interests, interests_mask, lat, lon, location))
             await conn.commit()
 
+    _index_waiting_user({
+        'user_id': user_id,
+        'username': username,
+        'gender': gender,
+        'orientation': orientation,
+        'interests': interests,
+        'interests_mask': interests_mask,
+        'lat': lat,
+        'lon': lon,
+    })
+
+# Добавление строки списка ожидания в индекс процесса
+def _index_waiting_user(row):
+    if row.get('lat') is None or row.get('lon') is None:
+        logging.warning(f"Нет координат у пользователя {row['user_id']} в списке ожидания")
+        waiting_index.remove(row['user_id'])
+        return
+    entry = dict(row)
+    if entry.get('interests_mask') is None:
+        entry['interests_mask'] = interests_to_mask(row['interests'])
+    # Момент постановки в очередь нужен для метрик времени ожидания
+    request_time = entry.pop('request_time', None)
+    entry['queued_at'] = request_time.timestamp() if request_time else time.time()
+    waiting_index.add(entry)
+
+waiting_index_synced_at = None  # Время базы на начало последней загрузки списка ожидания
+
+async def _database_now(cursor):
+    await _execute(cursor, "SELECT NOW() AS now")
+    return (await cursor.fetchone())['now']
+
+# Загрузка списка ожидания в индекс при старте
+async def load_waiting_index():
+    global waiting_index_synced_at
+    waiting_index.clear()
+    async with db.acquire() as conn:
+        async with conn.cursor(aiomysql.DictCursor) as cursor:
+            synced_at = await _database_now(cursor)
+            await _execute(cursor, f"SELECT {WAITING_LIST_FIELDS} FROM waiting_list")
+            rows = await cursor.fetchall()
+    for row in rows:
+        _index_waiting_user(row)
+    waiting_index_synced_at = synced_at
+    logging.info(f"Индекс списка ожидания загружен: {len(waiting_index)} пользователей")
+
+# Догрузка изменений очереди от других процессов: новые и обновленные строки по request_time,
+# ушедшие из очереди - по списку id. Пользователь, которого этот процесс изменил во время запросов,
+# не трогается; устаревшую запись, если она все же попадет в индекс, уберет неудачный claim_match
+async def refresh_waiting_index():
+    global waiting_index_synced_at
+    if waiting_index_synced_at is None:
+        await load_waiting_index()
+        return
+    before = {user_id: waiting_index.get(user_id) for user_id in waiting_index.user_ids()}
+    async with db.acquire() as conn:
+        async with conn.cursor(aiomysql.DictCursor) as cursor:
+            synced_at = await _database_now(cursor)
+            await _execute(
+                cursor,
+                WAITING_LIST_CHANGES_QUERY,
+                (waiting_index_synced_at, WAITING_INDEX_REFRESH_OVERLAP)
+            )
+            changed = await cursor.fetchall()
+            await _execute(cursor, "SELECT user_id FROM waiting_list")
+            queued = {row['user_id'] for row in await cursor.fetchall()}
+
+    added = removed = 0
+    for row in changed:
+        user_id = row['user_id']
+        if user_id in queued and waiting_index.get(user_id) is before.get(user_id):
+            _index_waiting_user(row)
+            added += user_id not in before
+    for user_id, entry in before.items():
+        if user_id not in queued and waiting_index.get(user_id) is entry:
+            waiting_index.remove(user_id)
+            removed += 1
+    waiting_index_synced_at = synced_at
+    if added or removed:
+        logging.info(f"Индекс списка ожидания обновлен: +{added} -{removed}, всего {len(waiting_index)}")
+
+# Периодическая догрузка очереди в индекс процесса
+async def run_waiting_index_refresh(interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await refresh_waiting_index()
+        except Exception as e:
+            logging.error(f"Ошибка обновления индекса списка ожидания: {e}")
+
+# Множество исключенных для поиска партнеров одного пользователя
+class ExclusionSet:
+    def __init__(self):
+        self.blocked_by_me = set()
+        self.blocked_me = set()
+        self.finished = set()
+
+    def __contains__(self, user_id):
+        return user_id in self.blocked_by_me or user_id in self.blocked_me or user_id in self.finished
+
+    def __len__(self):
+        return len(self.blocked_by_me | self.blocked_me | self.finished)
+
+# Исключения из строк (вид, id), которые возвращает SEARCH_CONTEXT_QUERY
+def _build_exclusions(rows):
+    exclusions = ExclusionSet()
+    for kind, excluded_id in rows:
+        getattr(exclusions, kind).add(excluded_id)
+    return exclusions
+
+# Обновление кэша исключений (только для уже загруженных пользователей)
+def _update_exclusions(user_id, kind, other_id, add=True):
+    exclusions = exclusion_cache.peek(user_id)
+    if exclusions is not None:
+        target = getattr(exclusions, kind)
+        if add:
+            target.add(other_id)
+        else:
+            target.discard(other_id)
+
 # Функция для блокировки пользователя
 async def block_user(blocker_id, blocked_id):
     async with db.acquire() as conn:
         async with conn.cursor() as cursor:
             # Проверяем, если пользователь уже заблокирован
-            query = "SELECT 1 FROM blocked_users WHERE blocker_id = %s AND blocked_id = %s"
-            await cursor.execute(query, (blocker_id, blocked_id))
+            query = BLOCK_EXISTS_QUERY
+            await _execute(cursor, query, (blocker_id, blocked_id))
             result = await cursor.fetchone()
 
             if not result:
                 # Если пользователь не заблокирован, добавляем в таблицу
                 query = "INSERT INTO blocked_users (blocker_id, blocked_id) VALUES (%s, %s)"
-                await cursor.execute(query, (blocker_id, blocked_id))
+                await _execute(cursor, query, (blocker_id, blocked_id))
                 await conn.commit()
             else:
                 logging.info(f"Пользователь {blocked_id} уже заблокирован пользователем {blocker_id}.")
 
+    _update_exclusions(blocker_id, 'blocked_by_me', blocked_id)
+    _update_exclusions(blocked_id, 'blocked_me', blocker_id)
+
 # Функция добавления завершенного чата
 async def add_finished_chat(user_id, partner_id):
     async with db.acquire() as conn:
         async with conn.cursor(aiomysql.DictCursor) as cursor:
             # Проверяем, существует ли уже завершённый чат
-            await cursor.execute(
-                "SELECT * FROM finished_chats WHERE user_id = %s AND partner_id = %s",
+            await _execute(
+                cursor,
+                FINISHED_EXISTS_QUERY,
                 (user_id, partner_id)
             )
             result = await cursor.fetchone()
             if result:
                 logging.info("Запись уже существует, не нужно добавлять снова.")
-                return
+            else:
+                # Если записи нет, добавляем её
+                query = "INSERT INTO finished_chats (user_id, partner_id) VALUES (%s, %s)"
+                await _execute(cursor, query, (user_id, partner_id))
+
+    _update_exclusions(user_id, 'finished', partner_id)
+
+
+# Определение пола для поиска по полу и ориентации
+def _search_gender(gender, orientation):
+    if orientation == 'Heterosexual':
+        return 'Female' if gender == 'Male' else 'Male'
+    elif orientation in ['Homosexual', 'Lesbian']:
+        return gender  # Ищем тот же пол
+    return None  # Bisexual or any other: открытый поиск без учета пола
 
-            # Если записи нет, добавляем её
-            query = "INSERT INTO finished_chats (user_id, partner_id) VALUES (%s, %s)"
-            await cursor.execute(query, (user_id, partner_id))
+# Поля кандидата, которые возвращает поиск
+MATCH_FIELDS = ('user_id', 'username', 'lat', 'lon', 'gender', 'orientation', 'interests', 'common_interests', 'distance')
 
+# Один запрос: радиус поиска пользователя и все его исключения
+SEARCH_CONTEXT_QUERY = """
+    SELECT distance, NULL AS kind, NULL AS excluded_id FROM users WHERE user_id = %s
+    UNION ALL
+    SELECT NULL, 'blocked_by_me', blocked_id FROM blocked_users WHERE blocker_id = %s
+    UNION ALL
+    SELECT NULL, 'blocked_me', blocker_id FROM blocked_users WHERE blocked_id = %s
+    UNION ALL
+    SELECT NULL, 'finished', partner_id FROM finished_chats WHERE user_id = %s
+"""
+
+# Один запрос: отбор, исключения и ранжирование кандидатов на стороне базы.
+# Прямоугольник вокруг пользователя (по его радиусу) отсекается по индексу (lat, lon)
+# еще до расчета расстояний; у линии перемены дат фильтр по долготе не применяется.
+MATCH_QUERY = f"""
+    SELECT wl.user_id, wl.username, wl.lat, wl.lon, wl.gender, wl.orientation, wl.interests,
+           BIT_COUNT(wl.interests_mask & %(interests_mask)s) AS common_interests,
+           {EARTH_RADIUS_KM} * 2 * ASIN(SQRT(
+               POW(SIN(RADIANS(wl.lat - %(lat)s) / 2), 2)
+               + COS(RADIANS(%(lat)s)) * COS(RADIANS(wl.lat)) * POW(SIN(RADIANS(wl.lon - %(lon)s) / 2), 2)
+           )) AS distance,
+           box.max_distance
+    FROM (
+        SELECT r.max_distance,
+               r.max_distance / {KM_PER_DEG_LAT} + {BOX_EPSILON_DEG} AS dlat,
+               r.max_distance / ({KM_PER_DEG_LAT} * COS(RADIANS(LEAST(ABS(%(lat)s) + r.max_distance / {KM_PER_DEG_LAT}, 89.9)))) + {BOX_EPSILON_DEG} AS dlon
+        FROM (SELECT COALESCE(distance, 10) AS max_distance FROM users WHERE user_id = %(user_id)s LIMIT 1) r
+    ) box
+    JOIN waiting_list wl
+      ON wl.lat BETWEEN %(lat)s - box.dlat AND %(lat)s + box.dlat
+     AND (%(lon)s - box.dlon < -180 OR %(lon)s + box.dlon > 180
+          OR wl.lon BETWEEN %(lon)s - box.dlon AND %(lon)s + box.dlon)
+    WHERE wl.user_id != %(user_id)s
+      AND (%(search_gender)s IS NULL OR wl.gender = %(search_gender)s)
+      AND NOT EXISTS (
+            SELECT 1 FROM blocked_users b
+            WHERE (b.blocker_id = %(user_id)s AND b.blocked_id = wl.user_id)
+               OR (b.blocker_id = wl.user_id AND b.blocked_id = %(user_id)s)
+        )
+      AND NOT EXISTS (
+            SELECT 1 FROM finished_chats f
+            WHERE f.user_id = %(user_id)s AND f.partner_id = wl.user_id
+        )
+    HAVING distance <= max_distance
+    ORDER BY common_interests DESC, distance ASC
+    LIMIT %(limit)s
+"""
 
 # Функция поиска совпадений с учетом завершенных чатов
-async def find_match(user_id, gender, orientation, interests, location):
-    async with db.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cursor:
-            # Получаем данные пользователя, включая расстояние поиска
-            await cursor.execute("SELECT distance FROM users WHERE user_id = %s", (user_id,))
-            user_data = await cursor.fetchone()
-            max_distance = user_data.get('distance', 10)  # Используем расстояние пользователя или значение по умолчанию 10 км
-
-            user_lat, user_lon = map(float, location.split(','))
-
-            # Определение гендера для поиска
-            if orientation == 'Heterosexual':
-                search_gender = 'Female' if gender == 'Male' else 'Male'
-            elif orientation in ['Homosexual', 'Lesbian']:
-                search_gender = gender  # Ищем тот же пол
-            else:  # Bisexual or any other
-                search_gender = None  # Открытый поиск без учета пола
-
-            # Преобразуем интересы в список
-            interests_list = interests.split(',')
-
-            # Запрос для проверки заблокированных пользователей
-            blocked_users_query = """
-                SELECT blocked_id FROM blocked_users WHERE blocker_id = %s
-                UNION
-                SELECT blocker_id FROM blocked_users WHERE blocked_id = %s
-            """
-            await cursor.execute(blocked_users_query, (user_id, user_id))
-            blocked_users = [row['blocked_id'] for row in await cursor.fetchall()]
+async def find_match(user_id, gender, orientation, interests, lat, lon):
+    matches = await find_matches(user_id, gender, orientation, interests, lat, lon, limit=1)
+    return matches[0] if matches else None
 
-            # Проверка завершенных чатов
-            finished_chats_query = """
-                SELECT partner_id FROM finished_chats WHERE user_id = %s
-            """
-            await cursor.execute(finished_chats_query, (user_id,))
-            finished_chats = [row['partner_id'] for row in await cursor.fetchall()]
-
-            # Основной цикл для поиска совпадений
-            for interests_count in range(len(interests_list), -1, -1):
-                if interests_count > 0:
-                    # Динамическое создание условий для поиска по интересам
-                    interests_conditions = " OR ".join([f"wl.interests LIKE %s" for _ in range(interests_count)])
-                    interests_values = [f"%{interest.strip()}%" for interest in interests_list[:interests_count]]
-                else:
-                    interests_conditions = "1 = 1"
-                    interests_values = []
-
-                blocked_users_filter = ""
-                if blocked_users:
-                    blocked_users_filter = f"AND wl.user_id NOT IN ({','.join(['%s'] * len(blocked_users))})"
-
-                finished_chats_filter = ""
-                if finished_chats:
-                    finished_chats_filter = f"AND wl.user_id NOT IN ({','.join(['%s'] * len(finished_chats))})"
-
-                # Запрос на поиск пользователя с учетом блокировок и завершенных чатов
-                query = f"""
-                    SELECT wl.user_id, wl.username, wl.location, wl.gender, wl.orientation, wl.interests
-                    FROM waiting_list wl
-                    WHERE wl.user_id != %s
-                    {blocked_users_filter}  -- исключаем заблокированных
-                    {finished_chats_filter}  -- исключаем пользователей с завершенными чатами
-                    {"AND wl.gender = %s" if search_gender else ""}
-                    AND ({interests_conditions})
-                """
+# Лучшие limit кандидатов: больше общих интересов, затем ближе. Не больше одного обращения к базе
+async def find_matches(user_id, gender, orientation, interests, user_lat, user_lon, limit=1):
+    search_gender = _search_gender(gender, orientation)
+    interests_mask = interests_to_mask(interests)
 
-                # Составляем параметры для запроса
-                params = [user_id] + blocked_users + finished_chats + interests_values
-                if search_gender:
-                    params.append(search_gender)
+    if MATCH_MODE == 'sql':
+        return await _find_matches_sql(user_id, search_gender, interests_mask, user_lat, user_lon, limit)
 
-                await cursor.execute(query, params)
-                matches = await cursor.fetchall()
+    # Исключения и радиус берем из кэшей; при промахе исключений загружаем их тем же запросом, что и радиус
+    exclusions = exclusion_cache.get(user_id)
+    if exclusions is None:
+        async with db.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await _execute(cursor, SEARCH_CONTEXT_QUERY, (user_id, user_id, user_id, user_id))
+                rows = await cursor.fetchall()
+        exclusions = _build_exclusions(row[1:] for row in rows if row[1] is not None)
+        exclusion_cache.set(user_id, exclusions)
+        radius = next((row[0] for row in rows if row[1] is None), None)
+    else:
+        profile = await get_user_by_id(user_id)
+        radius = profile.get('distance') if profile else None
 
-                # Проверяем каждого найденного пользователя по расстоянию
-                for match in matches:
-                    match_lat, match_lon = map(float, match['location'].split(','))
-                    distance = calculate_distance(user_lat, user_lon, match_lat, match_lon)
+    max_distance = float(radius) if radius else 10  # Расстояние по умолчанию, если у пользователя оно не задано
 
-                    if distance <= max_distance:
-                        return match
+    ranked = waiting_index.rank(
+        user_id, user_lat, user_lon, max_distance, interests_mask, search_gender, exclusions, limit
+    )
+    return [
+        dict({field: entry.get(field) for field in MATCH_FIELDS}, common_interests=common, distance=distance)
+        for entry, common, distance in ranked
+    ]
 
-            return None
+async def _find_matches_sql(user_id, search_gender, interests_mask, user_lat, user_lon, limit):
+    params = {
+        'user_id': user_id,
+        'search_gender': search_gender,
+        'interests_mask': interests_mask,
+        'lat': user_lat,
+        'lon': user_lon,
+        'limit': limit,
+    }
+    async with db.acquire() as conn:
+        async with conn.cursor(aiomysql.DictCursor) as cursor:
+            await _execute(cursor, MATCH_QUERY, params)
+            rows = await cursor.fetchall()
+    return [{field: row[field] for field in MATCH_FIELDS} for row in rows]
 
 # Удаление пользователя из списка ожидания
 async def remove_from_waiting_list(user_id):
     async with db.acquire() as conn:
         async with conn.cursor() as cursor:
             query = "DELETE FROM waiting_list WHERE user_id = %s"
-            await cursor.execute(query, (user_id,))
+            await _execute(cursor, query, (user_id,))
             await conn.commit()
+    waiting_index.remove(user_id)
 
 # Функция для сохранения сообщений чата в базу данных
-async def save_chat_message_to_db(sender_id, receiver_id, message_id, content, msg_type='text'):
+async def save_chat_message_to_db(sender_id, receiver_id, message_id, content, msg_type='text', file_id=None):
+    row = (sender_id, receiver_id, message_id, content, file_id, msg_type)
+    if message_writer_task is None:
+        await _write_messages([row])
+        return
+    await message_queue.put(row)
+    message_stats['queued'] += 1
+
+async def _write_messages(rows):
     async with db.acquire() as conn:
         async with conn.cursor() as cursor:
-            await cursor.execute(
-                "INSERT INTO chat_messages (sender_id, receiver_id, message_id, content, type) VALUES (%s, %s, %s, %s, %s)",
-                (sender_id, receiver_id, message_id, content, msg_type)
+            await _executemany(
+                cursor,
+                "INSERT INTO chat_messages (sender_id, receiver_id, message_id, content, file_id, type)"
+                " VALUES (%s, %s, %s, %s, %s, %s)",
+                rows
             )
             await conn.commit()
 
+# Запись пачки с повторами; после MESSAGE_FLUSH_RETRIES неудач пачка теряется с записью в лог
+async def _flush_messages(rows):
+    for attempt in range(1, MESSAGE_FLUSH_RETRIES + 1):
+        try:
+            await _write_messages(rows)
+            message_stats['written'] += len(rows)
+            message_stats['batches'] += 1
+            return
+        except Exception as e:
+            logging.error(f"Ошибка записи {len(rows)} сообщений чата (попытка {attempt}): {e}")
+            if attempt < MESSAGE_FLUSH_RETRIES:
+                await asyncio.sleep(attempt)
+    message_stats['dropped'] += len(rows)
 
-# Получение языка пользователя
-async def get_user_language(user_id):
+# Фоновая запись: ждет первое сообщение, добирает пачку до MESSAGE_FLUSH_BATCH или до истечения интервала.
+# None в очереди - сигнал остановки, после него пишется все, что осталось
+async def _message_writer():
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        row = await message_queue.get()
+        if row is None:
+            break
+        batch = [row]
+        deadline = loop.time() + MESSAGE_FLUSH_INTERVAL
+        while len(batch) < MESSAGE_FLUSH_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                row = await asyncio.wait_for(message_queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if row is None:
+                stopping = True
+                break
+            batch.append(row)
+        await _flush_messages(batch)
+
+def start_message_writer():
+    global message_queue, message_writer_task
+    if message_writer_task is None:
+        message_queue = asyncio.Queue(maxsize=MESSAGE_QUEUE_SIZE)
+        message_writer_task = asyncio.create_task(_message_writer())
+
+# Остановка с записью всего буфера; вызывается из close_db
+async def stop_message_writer():
+    global message_writer_task
+    if message_writer_task is None:
+        return
+    task, message_writer_task = message_writer_task, None
+    # Новые сообщения с этого момента пишутся напрямую, очередь дописывает уже поставленные
+    await message_queue.put(None)
+    await task
+    # Сообщения, успевшие встать в очередь после сигнала остановки. Освободившееся место будит
+    # сохранения, ждавшие в put() на полной очереди: отдаем им цикл и дописываем, пока очередь не опустеет
+    while True:
+        rest = []
+        while not message_queue.empty():
+            rest.append(message_queue.get_nowait())
+        rest = [row for row in rest if row is not None]
+        if rest:
+            await _flush_messages(rest)
+        await asyncio.sleep(0)
+        if message_queue.empty():
+            break
+    logging.info(f"Буфер сообщений чата записан: {message_stats}")
+
+
+# Очередь архивирования медиа: задания хранятся в media_jobs и переживают перезапуск.
+# pending - ждет скачивания, linked - файл скачан, но строки сообщения еще нет (буфер не записан),
+# running - арендовано воркером до locked_until, done - путь записан в chat_messages.content,
+# failed - попытки исчерпаны. Скачанный путь (local_path) записывается вместе со ссылкой на файл.
+
+# Задание создается сразу арендованным (status='running'): его выполняет процесс, который его создал.
+# Аренда истекает через lease секунд, после этого задание может забрать любой процесс
+async def add_media_job(sender_id, receiver_id, message_id, file_id, file_unique_id, file_type, lease):
+    async with db.acquire() as conn:
+        async with conn.cursor() as cursor:
+            await _execute(
+                cursor,
+                "INSERT INTO media_jobs (sender_id, receiver_id, message_id, file_id, file_unique_id, type, status, locked_until)"
+                " VALUES (%s, %s, %s, %s, %s, %s, 'running', NOW() + INTERVAL %s SECOND)",
+                (sender_id, receiver_id, message_id, file_id, file_unique_id, file_type, lease)
+            )
+            await conn.commit()
+            return {
+                'id': cursor.lastrowid, 'sender_id': sender_id, 'receiver_id': receiver_id,
+                'message_id': message_id, 'file_id': file_id, 'file_unique_id': file_unique_id, 'type': file_type,
+                'status': 'running', 'local_path': None, 'attempts': 0,
+            }
+
+# Аренда заданий, которые пора выполнить (скачивание или повторная привязка пути к сообщению), и заданий
+# с истекшей арендой. Строки берутся FOR UPDATE SKIP LOCKED и переводятся в running до коммита,
+# поэтому одно задание не достанется двум воркерам ни в этом, ни в другом процессе
+async def lease_media_jobs(limit, lease):
     async with db.acquire() as conn:
         async with conn.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute("SELECT lang FROM users WHERE user_id = %s", (user_id,))
-            result = await cursor.fetchone()
-            if result:
-                return result['lang']
-            return 'en'  # Язык по умолчанию, если язык не установлен
+            await conn.begin()
+            try:
+                await _execute(cursor, MEDIA_JOBS_DUE_QUERY, (limit,))
+                jobs = list(await cursor.fetchall())
+                if len(jobs) < limit:
+                    await _execute(cursor, MEDIA_JOBS_EXPIRED_QUERY, (limit - len(jobs),))
+                    jobs.extend(await cursor.fetchall())
+                if jobs:
+                    placeholders = ', '.join(['%s'] * len(jobs))
+                    await _execute(
+                        cursor,
+                        f"UPDATE media_jobs SET status = 'running', locked_until = NOW() + INTERVAL %s SECOND"
+                        f" WHERE id IN ({placeholders})",
+                        [lease] + [job['id'] for job in jobs]
+                    )
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+    return jobs
+
+# Запись пути скачанного файла в сообщение. False - строки сообщения еще нет (не записан буфер),
+# задание ждет повтора, а после max_attempts таких повторов помечается failed
+async def complete_media_job(job, local_path, retry_delay, max_attempts):
+    async with db.acquire() as conn:
+        async with conn.cursor() as cursor:
+            linked = await _execute(
+                cursor,
+                "UPDATE chat_messages SET content = %s WHERE sender_id = %s AND receiver_id = %s AND message_id = %s",
+                (local_path, job['sender_id'], job['receiver_id'], job['message_id'])
+            )
+            if linked:
+                await _execute(
+                    cursor, "UPDATE media_jobs SET status = 'done', local_path = %s WHERE id = %s", (local_path, job['id'])
+                )
+            else:
+                attempts = job['attempts'] + 1
+                await _execute(
+                    cursor,
+                    """
+                    UPDATE media_jobs SET status = %s, local_path = %s, attempts = %s,
+                        next_attempt_at = NOW() + INTERVAL %s SECOND
+                    WHERE id = %s
+                    """,
+                    ('failed' if attempts >= max_attempts else 'linked', local_path, attempts, retry_delay, job['id'])
+                )
+            await conn.commit()
+    return bool(linked)
+
+# Неудачная попытка: повтор через retry_delay секунд или failed после max_attempts
+async def fail_media_job(job, error, retry_delay, max_attempts):
+    attempts = job['attempts'] + 1
+    status = 'failed' if attempts >= max_attempts else 'pending'
+    async with db.acquire() as conn:
+        async with conn.cursor() as cursor:
+            await _execute(
+                cursor,
+                """
+                UPDATE media_jobs SET status = %s, attempts = %s, last_error = %s,
+                    next_attempt_at = NOW() + INTERVAL %s SECOND
+                WHERE id = %s
+                """,
+                (status, attempts, str(error)[:1000], retry_delay, job['id'])
+            )
+            await conn.commit()
+    return status
+
+# Хранилище медиа: media_blobs - файл на диске по sha256 содержимого со счетчиком ссылок,
+# media_aliases - file_unique_id Telegram, уже скачанные в этот файл
+async def get_media_by_unique_id(file_unique_id):
+    async with db.acquire() as conn:
+        async with conn.cursor(aiomysql.DictCursor) as cursor:
+            await _execute(
+                cursor,
+                """
+                SELECT b.sha256, b.path, b.size, b.ref_count
+                FROM media_aliases a JOIN media_blobs b ON b.sha256 = a.sha256
+                WHERE a.file_unique_id = %s
+                """,
+                (file_unique_id,)
+            )
+            return await cursor.fetchone()
+
+# Новая ссылка на файл: счетчик +1 (строка создается при первой ссылке) и псевдоним file_unique_id.
+# Строка блоба блокируется FOR UPDATE, и под этой блокировкой place_file(путь) проверяет файл на диске
+# или кладет его на место; False - файла нет, ссылка не добавляется. Снятие последней ссылки ждет
+# эту транзакцию, поэтому файл не удалится между проверкой и увеличением счетчика.
+# Возвращает путь файла в хранилище или None
+async def add_media_reference(sha256, path, size, file_unique_id=None, place_file=None, job_id=None):
+    async with db.acquire() as conn:
+        async with conn.cursor() as cursor:
+            await conn.begin()
+            try:
+                # Ссылку задания архивирования считаем один раз: путь записывается в задание той же транзакцией
+                if job_id is not None:
+                    await _execute(cursor, "SELECT local_path FROM media_jobs WHERE id = %s FOR UPDATE", (job_id,))
+                    job_row = await cursor.fetchone()
+                    if job_row is not None and job_row[0]:
+                        await conn.rollback()
+                        return job_row[0]
+                await _execute(cursor, "SELECT path FROM media_blobs WHERE sha256 = %s FOR UPDATE", (sha256,))
+                row = await cursor.fetchone()
+                if row is not None:
+                    path = row[0]
+                if place_file is not None and not place_file(path):
+                    await conn.rollback()
+                    return None
+                if row is not None:
+                    await _execute(cursor, "UPDATE media_blobs SET ref_count = ref_count + 1 WHERE sha256 = %s", (sha256,))
+                else:
+                    # Одновременная первая ссылка из другого процесса превращается в +1
+                    await _execute(
+                        cursor,
+                        "INSERT INTO media_blobs (sha256, path, size, ref_count) VALUES (%s, %s, %s, 1)"
+                        " ON DUPLICATE KEY UPDATE ref_count = ref_count + 1",
+                        (sha256, path, size)
+                    )
+                if file_unique_id:
+                    await _execute(
+                        cursor,
+                        "INSERT IGNORE INTO media_aliases (file_unique_id, sha256) VALUES (%s, %s)",
+                        (file_unique_id, sha256)
+                    )
+                if job_id is not None:
+                    await _execute(cursor, "UPDATE media_jobs SET local_path = %s WHERE id = %s", (path, job_id))
+                await conn.commit()
+                return path
+            except Exception:
+                await conn.rollback()
+                raise
+
+# Снятие ссылки по пути файла. Возвращает оставшееся число ссылок или None, если файл не из хранилища.
+# При нуле строки удаляются, и только после того как удаление строки подтверждено, remove_file(путь)
+# удаляет файл - до коммита, пока удаленная строка заблокирована и новая ссылка на тот же файл ждет
+async def release_media_reference(path, remove_file=None):
+    async with db.acquire() as conn:
+        async with conn.cursor() as cursor:
+            await conn.begin()
+            try:
+                await _execute(cursor, "SELECT sha256, ref_count FROM media_blobs WHERE path = %s FOR UPDATE", (path,))
+                row = await cursor.fetchone()
+                if row is None:
+                    await conn.rollback()
+                    return None
+                sha256, ref_count = row[0], max(row[1] - 1, 0)
+                if ref_count:
+                    await _execute(cursor, "UPDATE media_blobs SET ref_count = %s WHERE sha256 = %s", (ref_count, sha256))
+                else:
+                    await _execute(cursor, "DELETE FROM media_aliases WHERE sha256 = %s", (sha256,))
+                    deleted = await _execute(cursor, "DELETE FROM media_blobs WHERE sha256 = %s", (sha256,))
+                    if deleted == 1 and remove_file is not None:
+                        remove_file(path)
+                await conn.commit()
+                return ref_count
+            except Exception:
+                await conn.rollback()
+                raise
+
+# Итоги хранилища: файлы, байты на диске и байты, которые заняли бы копии без дедупликации
+async def get_media_store_totals():
+    async with db.acquire() as conn:
+        async with conn.cursor() as cursor:
+            await _execute(
+                cursor,
+                "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(size * ref_count), 0) FROM media_blobs"
+            )
+            files, stored_bytes, referenced_bytes = await cursor.fetchone()
+    return {
+        'files': int(files),
+        'stored_bytes': int(stored_bytes),
+        'referenced_bytes': int(referenced_bytes),
+        'saved_bytes': int(referenced_bytes) - int(stored_bytes),
+    }
+
+# file_id Telegram, под которым локальный файл уже есть у Telegram
+async def get_media_file_id(path):
+    async with db.acquire() as conn:
+        async with conn.cursor() as cursor:
+            await _execute(cursor, "SELECT file_id FROM media_file_ids WHERE path = %s", (path,))
+            row = await cursor.fetchone()
+            return row[0] if row else None
+
+async def set_media_file_id(path, file_id):
+    async with db.acquire() as conn:
+        async with conn.cursor() as cursor:
+            await _execute(
+                cursor,
+                "INSERT INTO media_file_ids (path, file_id) VALUES (%s, %s) AS new_data"
+                " ON DUPLICATE KEY UPDATE file_id = new_data.file_id",
+                (path, file_id)
+            )
+
+async def delete_media_file_id(path):
+    async with db.acquire() as conn:
+        async with conn.cursor() as cursor:
+            await _execute(cursor, "DELETE FROM media_file_ids WHERE path = %s", (path,))
+
+# Получение языка пользователя
+async def get_user_language(user_id):
+    user = await get_user_by_id(user_id)
+    if user:
+        return user['lang']
+    return 'en'  # Язык по умолчанию, если язык не установлен
 
 # Получение завершённых чатов пользователя
-async def get_finished_chats(user_id):
+# Размер страницы списка завершенных чатов
+FINISHED_CHATS_PAGE_SIZE = int(os.getenv('FINISHED_CHATS_PAGE_SIZE', 10))
+
+# Страница завершенных чатов, последние сверху. Возвращает (чаты, есть_следующая_страница)
+async def get_finished_chats(user_id, page=0, limit=FINISHED_CHATS_PAGE_SIZE):
     async with db.acquire() as conn:
         async with conn.cursor(aiomysql.DictCursor) as cursor:
             query = """
@@ -374,81 +1676,350 @@ async def get_finished_chats(user_id):
                 FROM finished_chats fc
                 JOIN users u ON fc.partner_id = u.user_id
                 WHERE fc.user_id = %s
+                ORDER BY fc.id DESC
+                LIMIT %s OFFSET %s
             """
-            await cursor.execute(query, (user_id,))
-            return await cursor.fetchall()
+            # Лишняя строка показывает, есть ли следующая страница
+            await _execute(cursor, query, (user_id, limit + 1, page * limit))
+            rows = await cursor.fetchall()
+            return rows[:limit], len(rows) > limit
+
 
+# Размер страницы истории переписки
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', 50))
+
+# Страница истории переписки двух пользователей, keyset по id строки (порядок записи). message_id
+# для порядка не годится: Telegram нумерует сообщения в каждом личном чате отдельно, и номера двух
+# отправителей несравнимы. before - id для более старых сообщений, after - для более новых,
+# без курсора - последние сообщения. Возвращает (сообщения по возрастанию, есть_старше, есть_новее);
+# стоимость страницы не зависит от длины переписки
+HISTORY_PAGE_QUERY = """
+    SELECT id, sender_id, receiver_id, message_id, content, file_id, type FROM chat_messages
+    WHERE pair_low = %s AND pair_high = %s {condition}
+    ORDER BY id {order}
+    LIMIT %s
+"""
+
+async def get_chat_history_page(user_id, partner_id, before=None, after=None, limit=HISTORY_PAGE_SIZE):
+    params = [min(user_id, partner_id), max(user_id, partner_id)]
+    condition = ""
+    order = "DESC"
+    if after is not None:
+        condition = "AND id > %s"
+        params.append(after)
+        order = "ASC"
+    elif before is not None:
+        condition = "AND id < %s"
+        params.append(before)
 
-# Получение истории чатов между двумя пользователями
-async def get_chat_history(user_id, partner_id):
     async with db.acquire() as conn:
         async with conn.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute("""
-                SELECT * FROM chat_messages 
-                WHERE (sender_id = %s AND receiver_id = %s) 
-                OR (sender_id = %s AND receiver_id = %s)
-                ORDER BY message_id ASC
-            """, (user_id, partner_id, partner_id, user_id))
-            return await cursor.fetchall()
-        
-async def add_active_chat(user_id: int, partner_id: int):
-    existing_chat = await get_active_chat(user_id)
+            await _execute(cursor, HISTORY_PAGE_QUERY.format(condition=condition, order=order), (*params, limit + 1))
+            rows = await cursor.fetchall()
+
+    more = len(rows) > limit
+    rows = list(rows[:limit])
+    if after is not None:
+        return rows, True, more
+    rows.reverse()
+    return rows, more, before is not None
+
+# Атомарный захват пары: оба пользователя выходят из очереди и получают активный чат в одной транзакции.
+# Строки waiting_list блокируются через FOR UPDATE SKIP LOCKED, поэтому конкурирующий поиск
+# (в этом или другом процессе бота) не может забрать того же партнера второй раз.
+async def claim_match(user_id: int, partner_id: int) -> bool:
+    if user_id == partner_id:
+        return False
     async with db.acquire() as conn:
         async with conn.cursor() as cursor:
-            if not existing_chat:
-                # Если нет активного чата, добавляем его
-                await cursor.execute(
-                    "INSERT INTO active_chats (user_id, partner_id) VALUES (%s, %s)",
+            await conn.begin()
+            try:
+                await _execute(
+                    cursor,
+                    "SELECT user_id FROM waiting_list WHERE user_id IN (%s, %s) FOR UPDATE SKIP LOCKED",
                     (user_id, partner_id)
                 )
+                claimed = len(await cursor.fetchall()) == 2
+                if claimed:
+                    # Никто из пары не должен уже состоять в активном чате
+                    await _execute(cursor, BUSY_CHAT_QUERY, (user_id, partner_id, user_id, partner_id))
+                    claimed = await cursor.fetchone() is None
+                if not claimed:
+                    await conn.rollback()
+                else:
+                    await _execute(cursor, "DELETE FROM waiting_list WHERE user_id IN (%s, %s)", (user_id, partner_id))
+                    await _execute(
+                        cursor,
+                        "INSERT INTO active_chats (user_id, partner_id) VALUES (%s, %s), (%s, %s)",
+                        (user_id, partner_id, partner_id, user_id)
+                    )
+                    await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+
+            if not claimed:
+                # Убираем из индекса тех, кого в очереди уже нет (например, забрал другой процесс)
+                await _execute(cursor, "SELECT user_id FROM waiting_list WHERE user_id IN (%s, %s)", (user_id, partner_id))
+                still_waiting = {row[0] for row in await cursor.fetchall()}
+                for stale_id in {user_id, partner_id} - still_waiting:
+                    waiting_index.remove(stale_id)
+                return False
+
+    waiting_index.remove(user_id)
+    waiting_index.remove(partner_id)
+    _route_chat(user_id, partner_id)
+    return True
+
+# Проверки пары для продолжения чата: был чат между ними и никто никого не заблокировал
+CHAT_HISTORY_CHECK = """
+    SELECT EXISTS (
+               SELECT 1 FROM finished_chats WHERE user_id = %(a)s AND partner_id = %(b)s
+               UNION ALL SELECT 1 FROM finished_chats WHERE user_id = %(b)s AND partner_id = %(a)s
+               UNION ALL SELECT 1 FROM active_chats WHERE user_id = %(a)s AND partner_id = %(b)s
+               UNION ALL SELECT 1 FROM active_chats WHERE user_id = %(b)s AND partner_id = %(a)s
+           ) AS had_chat,
+           EXISTS (
+               SELECT 1 FROM blocked_users WHERE blocker_id = %(a)s AND blocked_id = %(b)s
+               UNION ALL SELECT 1 FROM blocked_users WHERE blocker_id = %(b)s AND blocked_id = %(a)s
+           ) AS blocked
+"""
+
+async def _can_continue_chat(cursor, user_id, partner_id):
+    await _execute(cursor, CHAT_HISTORY_CHECK, {'a': user_id, 'b': partner_id})
+    had_chat, blocked = await cursor.fetchone()
+    return bool(had_chat) and not blocked
+
+# Предложение продолжить чат: записывается, только если у пары была переписка и нет блокировок.
+# Повторное предложение продлевает срок действия
+async def propose_chat(proposer_id: int, target_id: int) -> bool:
+    if proposer_id == target_id:
+        return False
+    async with db.acquire() as conn:
+        async with conn.cursor() as cursor:
+            if not await _can_continue_chat(cursor, proposer_id, target_id):
+                return False
+            await _execute(
+                cursor,
+                "INSERT INTO chat_proposals (proposer_id, target_id) VALUES (%s, %s)"
+                " ON DUPLICATE KEY UPDATE created_at = CURRENT_TIMESTAMP",
+                (proposer_id, target_id)
+            )
             await conn.commit()
+    return True
 
-async def remove_active_chat(user_id: int):
+async def decline_chat_proposal(proposer_id: int, target_id: int):
     async with db.acquire() as conn:
         async with conn.cursor() as cursor:
-            # Обновляем статус чата вместо удаления
-            await cursor.execute(
-                "UPDATE active_chats SET status = 'finished' WHERE user_id = %s OR partner_id = %s",
-                (user_id, user_id)
+            await _execute(
+                cursor, "DELETE FROM chat_proposals WHERE proposer_id = %s AND target_id = %s", (proposer_id, target_id)
             )
             await conn.commit()
 
-async def get_active_chat(user_id: int):
+# Принятие предложения в одной транзакции, как claim_match: предложение погашается, строки users обоих
+# блокируются (параллельные принятия с тем же пользователем ждут), строки очереди забираются FOR UPDATE,
+# и только если оба свободны, создаются строки active_chats
+async def accept_chat_proposal(user_id: int, proposer_id: int) -> bool:
+    if user_id == proposer_id:
+        return False
     async with db.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cursor:
-            await cursor.execute(
-                "SELECT * FROM active_chats WHERE user_id = %s OR partner_id = %s",
+        async with conn.cursor() as cursor:
+            await conn.begin()
+            try:
+                await _execute(
+                    cursor,
+                    "DELETE FROM chat_proposals WHERE proposer_id = %s AND target_id = %s"
+                    " AND created_at >= NOW() - INTERVAL %s SECOND",
+                    (proposer_id, user_id, CHAT_PROPOSAL_TTL)
+                )
+                accepted = cursor.rowcount == 1
+                if accepted:
+                    await _execute(
+                        cursor, "SELECT user_id FROM users WHERE user_id IN (%s, %s) FOR UPDATE", (user_id, proposer_id)
+                    )
+                    await cursor.fetchall()
+                    accepted = await _can_continue_chat(cursor, user_id, proposer_id)
+                if accepted:
+                    await _execute(
+                        cursor, f"{BUSY_CHAT_QUERY} FOR UPDATE", (user_id, proposer_id, user_id, proposer_id)
+                    )
+                    accepted = await cursor.fetchone() is None
+                if accepted:
+                    # Из очереди поиска оба выходят вместе с началом чата
+                    await _execute(
+                        cursor, "SELECT user_id FROM waiting_list WHERE user_id IN (%s, %s) FOR UPDATE", (user_id, proposer_id)
+                    )
+                    await cursor.fetchall()
+                    await _execute(cursor, "DELETE FROM waiting_list WHERE user_id IN (%s, %s)", (user_id, proposer_id))
+                    await _execute(
+                        cursor,
+                        "INSERT INTO active_chats (user_id, partner_id) VALUES (%s, %s), (%s, %s)",
+                        (user_id, proposer_id, proposer_id, user_id)
+                    )
+                    await conn.commit()
+                else:
+                    # Предложение остается в силе: его можно принять, когда оба освободятся
+                    await conn.rollback()
+            except Exception:
+                await conn.rollback()
+                raise
+
+    if not accepted:
+        return False
+    waiting_index.remove(user_id)
+    waiting_index.remove(proposer_id)
+    _route_chat(user_id, proposer_id)
+    return True
+
+# Маршрутизация чатов: global_vars.active_chats (user_id -> partner_id) повторяет незавершенные строки
+# active_chats и меняется только вместе с таблицей. Счетчик версий отличает изменения во время сверки
+active_chats_version = 0
+
+def _route_chat(user_id, partner_id):
+    global active_chats_version
+    active_chats[user_id] = partner_id
+    active_chats[partner_id] = user_id
+    active_chats_version += 1
+
+def _unroute_chat(user_id):
+    global active_chats_version
+    partner_id = active_chats.pop(user_id, None)
+    if partner_id is not None and active_chats.get(partner_id) == user_id:
+        del active_chats[partner_id]
+    active_chats_version += 1
+
+# Карта маршрутов по таблице: незавершенные чаты, более поздняя строка важнее
+async def _fetch_active_routes():
+    async with db.acquire() as conn:
+        async with conn.cursor() as cursor:
+            await _execute(
+                cursor, "SELECT user_id, partner_id FROM active_chats WHERE status != 'finished' ORDER BY id"
+            )
+            rows = await cursor.fetchall()
+    routes = {}
+    for user_id, partner_id in rows:
+        routes[user_id] = partner_id
+        routes[partner_id] = user_id
+    return routes
+
+async def load_active_chats():
+    global active_chats_version
+    routes = await _fetch_active_routes()
+    active_chats.clear()
+    active_chats.update(routes)
+    active_chats_version += 1
+    logging.info(f"Маршруты чатов загружены: {len(active_chats) // 2} активных чатов")
+
+# Сверка карты маршрутов с таблицей; расхождения пишутся в лог и исправляются по таблице.
+# Если карта изменилась во время запроса, сверка пропускается до следующего раза
+async def check_active_chats():
+    global active_chats_version
+    version = active_chats_version
+    routes = await _fetch_active_routes()
+    if version != active_chats_version:
+        return None
+    mismatched = {
+        user_id for user_id in routes.keys() | active_chats.keys()
+        if routes.get(user_id) != active_chats.get(user_id)
+    }
+    if mismatched:
+        logging.warning(
+            f"Карта маршрутов чатов расходится с таблицей у {len(mismatched)} пользователей: {sorted(mismatched)[:20]}"
+        )
+        active_chats.clear()
+        active_chats.update(routes)
+        active_chats_version += 1
+    return mismatched
+
+active_chats_synced_at = None  # Время базы на начало последней догрузки завершенных чатов
+
+# Чаты, завершенные с прошлой догрузки (в любом процессе): снимаем их маршруты из карты этого процесса.
+# Строка пропускается, если у пары уже есть более новый незавершенный чат
+async def sync_ended_chats():
+    global active_chats_synced_at
+    async with db.acquire() as conn:
+        async with conn.cursor() as cursor:
+            await _execute(cursor, "SELECT NOW()")
+            synced_at = (await cursor.fetchone())[0]
+            await _execute(cursor, ENDED_CHATS_QUERY, (active_chats_synced_at or synced_at, ACTIVE_CHATS_SYNC_OVERLAP))
+            rows = await cursor.fetchall()
+    for user_id, partner_id in rows:
+        if active_chats.get(user_id) == partner_id:
+            _unroute_chat(user_id)
+    active_chats_synced_at = synced_at
+
+async def run_active_chats_sync(interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await sync_ended_chats()
+        except Exception as e:
+            logging.error(f"Ошибка догрузки завершенных чатов: {e}")
+
+# Периодическая сверка карты маршрутов
+async def run_active_chats_check(interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await check_active_chats()
+        except Exception as e:
+            logging.error(f"Ошибка сверки активных чатов: {e}")
+
+async def remove_active_chat(user_id: int):
+    async with db.acquire() as conn:
+        async with conn.cursor() as cursor:
+            # Обновляем статус чата вместо удаления; ended_at видят остальные процессы
+            await _execute(
+                cursor,
+                "UPDATE active_chats SET status = 'finished', ended_at = NOW()"
+                " WHERE (user_id = %s OR partner_id = %s) AND status != 'finished'",
                 (user_id, user_id)
             )
-            result = await cursor.fetchone()
-            
-            # Проверяем, чтобы partner_id был другим пользователем
-            if result:
-                if result['user_id'] == user_id:
-                    return {'partner_id': result['partner_id']}
-                else:
-                    return {'partner_id': result['user_id']}
+            await conn.commit()
+    _unroute_chat(user_id)
+
+# Собеседник в незавершенном чате по карте маршрутов. Если в карте записи нет, чат мог начаться
+# в другом процессе: проверяем таблицу одним запросом по индексу и запоминаем найденный маршрут
+async def get_active_chat(user_id: int):
+    partner_id = active_chats.get(user_id)
+    if partner_id is None:
+        async with db.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await _execute(
+                    cursor,
+                    ACTIVE_CHAT_QUERY,
+                    (user_id,)
+                )
+                row = await cursor.fetchone()
+        if row is None:
+            return None
+        partner_id = row[0]
+        _route_chat(user_id, partner_id)
+    return {'partner_id': partner_id}
 
 async def is_nickname_taken(nickname: str) -> bool:
     async with db.acquire() as conn:
         async with conn.cursor() as cursor:
-            await cursor.execute("SELECT COUNT(*) FROM users WHERE username = %s", (nickname,))
+            await _execute(cursor, NICKNAME_QUERY, (nickname,))
             result = await cursor.fetchone()
             return result[0] > 0
         
 async def update_search_radius(user_id: int, distance: float):
     async with db.acquire() as conn:
         async with conn.cursor() as cursor:
-            await cursor.execute(
+            await _execute(
+                cursor,
                 "UPDATE users SET distance = %s WHERE user_id = %s",
                 (distance, user_id)
             )
             await conn.commit()
+    _update_cached_profile(user_id, distance=distance)
 
 async def get_blocked_users(user_id: int):
     async with db.acquire() as conn:
         async with conn.cursor() as cursor:
-            await cursor.execute(
+            await _execute(
+                cursor,
                 """
                 SELECT blocked_users.blocked_id, users.username 
                 FROM blocked_users 
@@ -464,9 +2035,13 @@ async def get_blocked_users(user_id: int):
 async def unblock_user(blocker_id: int, blocked_id: int):
     async with db.acquire() as conn:
         async with conn.cursor() as cursor:
-            await cursor.execute(
+            await _execute(
+                cursor,
                 "DELETE FROM blocked_users WHERE blocker_id = %s AND blocked_id = %s", 
                 (blocker_id, blocked_id)
             )
             await conn.commit()
 
+    _update_exclusions(blocker_id, 'blocked_by_me', blocked_id, add=False)
+    _update_exclusions(blocked_id, 'blocked_me', blocker_id, add=False)
+
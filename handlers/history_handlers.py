@@ -1,61 +1,210 @@
 import logging
 import os
 from aiogram import F, Bot, Router, types
-from database import block_user, get_active_chat, add_active_chat, get_user_by_id, remove_active_chat, get_chat_history, get_finished_chats  # Обновление для работы с активными чатами в БД
+from database import block_user, get_active_chat, get_user_by_id, remove_active_chat, get_chat_history_page, get_finished_chats, propose_chat, accept_chat_proposal, decline_chat_proposal  # Обновление для работы с активными чатами в БД
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
-from aiogram.types import FSInputFile
+from aiogram.types import FSInputFile, InputMediaAudio, InputMediaPhoto, InputMediaVideo
 
 from keyboards import initial_keyboard, match_keyboard
+from media_store import cached_file_id, remember_file_id, send_media, sent_file_id
+from outbound import PRIORITY_BULK, send_priority
 
 history_router = Router()
 logging.basicConfig(level=logging.INFO)
 
-# Путь для сохранения медиафайлов
-MEDIA_PATH = 'media_files/'
-if not os.path.exists(MEDIA_PATH):
-    os.makedirs(MEDIA_PATH)
-
-# Функция для сохранения медиафайлов
-async def save_media_file(file_id: str, file_type: str, message_id: int, user_id: int, bot: Bot):
-    file_info = await bot.get_file(file_id)
-    extension = file_type if file_type != "voice" else "ogg"
-    file_name = f"{message_id}_{user_id}.{extension}"
-    file_path = os.path.join(MEDIA_PATH, file_name)
-    await bot.download_file(file_info.file_path, file_path)
-    return file_path
+# Список завершенных чатов одним сообщением: кнопка на чат и листание страниц (finished_page_<номер>)
+def finished_chats_keyboard(chats, page, has_next):
+    buttons = [
+        [InlineKeyboardButton(text=f"Открыть чат с {chat['username']}", callback_data=f"open_chat_{chat['partner_id']}")]
+        for chat in chats
+    ]
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"finished_page_{page - 1}"))
+    if has_next:
+        navigation.append(InlineKeyboardButton(text="Далее ➡️", callback_data=f"finished_page_{page + 1}"))
+    if navigation:
+        buttons.append(navigation)
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 # Обработка кнопки "История"
 @history_router.message(F.text == '📜 История')
 async def handle_history_button(message: types.Message):
     user_id = message.from_user.id
-    finished_chats = await get_finished_chats(user_id)
+    finished_chats, has_next = await get_finished_chats(user_id)
     
     if finished_chats:
-        for chat in finished_chats:
-            partner_username = chat['username']
-            partner_id = chat['partner_id']
-            
-            # Кнопка открытия чата
-            open_chat_button = InlineKeyboardButton(text=f"Открыть чат с {partner_username}", callback_data=f"open_chat_{partner_id}")
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[[open_chat_button]])
-            
-            await message.answer(f"Завершённый чат с {partner_username}", reply_markup=keyboard)
+        await message.answer("Завершённые чаты:", reply_markup=finished_chats_keyboard(finished_chats, 0, has_next))
     else:
         await message.answer("У вас нет завершённых чатов.")
 
-# Клавиатура с предложением продолжить чат
-def accept_or_decline_keyboard():
-    accept_button = InlineKeyboardButton(text="Принять", callback_data="accept_chat")
-    decline_button = InlineKeyboardButton(text="Отклонить", callback_data="decline_chat")
+# Листание списка завершенных чатов: меняется только клавиатура того же сообщения
+@history_router.callback_query(F.data.startswith('finished_page_'))
+async def handle_finished_page(callback_query: types.CallbackQuery):
+    page = int(callback_query.data.split('_')[2])
+    finished_chats, has_next = await get_finished_chats(callback_query.from_user.id, page)
+    if finished_chats:
+        await callback_query.message.edit_reply_markup(reply_markup=finished_chats_keyboard(finished_chats, page, has_next))
+    await callback_query.answer()
+
+# Клавиатура с предложением продолжить чат; в callback_data - id предложившего
+def accept_or_decline_keyboard(proposer_id):
+    accept_button = InlineKeyboardButton(text="Принять", callback_data=f"accept_chat_{proposer_id}")
+    decline_button = InlineKeyboardButton(text="Отклонить", callback_data=f"decline_chat_{proposer_id}")
     
     # Добавляем кнопки в inline_keyboard
     keyboard = InlineKeyboardMarkup(inline_keyboard=[[accept_button, decline_button]])
     return keyboard
 
-@history_router.callback_query(F.data.startswith('open_chat_'))
-async def handle_open_chat(callback_query: types.CallbackQuery, bot: Bot):
-    partner_id = int(callback_query.data.split('_')[2])
+# Подписи и методы отправки медиа из истории по типу сообщения
+HISTORY_MEDIA = {
+    'photo': ("Фото", 'answer_photo'),
+    'video': ("Видео", 'answer_video'),
+    'audio': ("Аудио", 'answer_audio'),
+    'voice': ("Голосовое сообщение", 'answer_voice'),
+    'animation': ("Анимация", 'answer_animation'),
+    'video_note': ("Видео-заметка", 'answer_video_note'),
+}
+
+# Лимиты Telegram: длина текста сообщения и число элементов альбома
+MESSAGE_TEXT_LIMIT = 4096
+MEDIA_GROUP_LIMIT = 10
+
+# Медиа, которые собираются в альбомы: фото и видео вместе, аудио только с аудио.
+# Голосовые, анимации и видео-заметки в альбом не входят и отправляются по одному
+ALBUM_MEDIA = {
+    'photo': ('visual', InputMediaPhoto),
+    'video': ('visual', InputMediaVideo),
+    'audio': ('audio', InputMediaAudio),
+}
+
+# Путь к файлу в архиве (если он уже скачан) и file_id из переписки
+def history_media(message):
+    path = message['content'] if message['content'] and os.path.exists(message['content']) else None
+    return path, message.get('file_id')
+
+# Разбиение страницы истории на отправки с сохранением порядка: подряд идущие тексты склеиваются
+# в сообщения до 4096 символов, фото/видео и аудио - в альбомы до 10 элементов.
+# Результат - список ('text', текст), ('album', [медиа]) и ('single', медиа), медиа - (тип, путь, file_id, подпись)
+def render_history(messages, names):
+    parts = []
+    lines = []
+    album = []
+    album_kind = None
+
+    def flush_text():
+        if lines:
+            parts.append(('text', '\n'.join(lines)))
+            lines.clear()
+
+    def flush_album():
+        nonlocal album_kind
+        if len(album) == 1:
+            parts.append(('single', album[0]))
+        elif album:
+            parts.append(('album', list(album)))
+        album.clear()
+        album_kind = None
+
+    def add_line(line):
+        flush_album()
+        # Слишком длинная строка режется на куски по лимиту
+        for start in range(0, len(line), MESSAGE_TEXT_LIMIT):
+            chunk = line[start:start + MESSAGE_TEXT_LIMIT]
+            if lines and sum(len(text) + 1 for text in lines) + len(chunk) > MESSAGE_TEXT_LIMIT:
+                flush_text()
+            lines.append(chunk)
+
+    for message in messages:
+        sender_name = names.get(message['sender_id'], "Собеседник")
+        if message['type'] == 'text':
+            add_line(f"{sender_name}: {message['content']}")
+            continue
+        if message['type'] not in HISTORY_MEDIA:
+            continue
+        label = HISTORY_MEDIA[message['type']][0]
+        path, file_id = history_media(message)
+        if not path and not file_id:
+            add_line(f"{sender_name}: {label} (файл отсутствует)")
+            continue
+
+        flush_text()
+        item = (message['type'], path, file_id, f"{sender_name}: {label}")
+        kind = ALBUM_MEDIA.get(message['type'], (None,))[0]
+        if kind is None:
+            flush_album()
+            parts.append(('single', item))
+            continue
+        if kind != album_kind or len(album) == MEDIA_GROUP_LIMIT:
+            flush_album()
+        album.append(item)
+        album_kind = kind
+
+    flush_text()
+    flush_album()
+    return parts
+
+# Отправка одного медиа из истории: по file_id, файл из архива загружается, только если file_id неизвестен
+async def send_history_media(target: types.Message, item):
+    media_type, path, file_id, caption = item
+    try:
+        if media_type == 'video_note':
+            send = lambda media: target.answer_video_note(media)  # У видео-заметок нет подписи
+        else:
+            method = getattr(target, HISTORY_MEDIA[media_type][1])
+            send = lambda media: method(media, caption=caption, parse_mode=None)
+        await send_media(send, path, media_type, file_id)
+    except Exception as e:
+        logging.error(f"Ошибка при отправке медиафайла: {e}")
+        await target.answer(f"{caption} недоступен", parse_mode=None)
+
+# Отправка страницы истории пакетами; текст без разметки, чтобы символы из переписки не ломали HTML
+async def send_history(target: types.Message, messages, names):
+    for kind, payload in render_history(messages, names):
+        if kind == 'text':
+            await target.answer(payload, parse_mode=None)
+        elif kind == 'album':
+            try:
+                sources = [file_id or await cached_file_id(path) for _, path, file_id, _ in payload]
+                sent = await target.answer_media_group([
+                    ALBUM_MEDIA[media_type][1](media=source or FSInputFile(path), caption=caption, parse_mode=None)
+                    for (media_type, path, _, caption), source in zip(payload, sources)
+                ])
+                # Загруженные файлы получили file_id - следующий показ обойдется без загрузки
+                for (media_type, path, _, _), source, message in zip(payload, sources, sent):
+                    if not source:
+                        await remember_file_id(path, sent_file_id(message, media_type))
+            except Exception as e:
+                # Один недоступный файл не должен терять весь альбом
+                logging.error(f"Ошибка при отправке альбома из истории: {e}")
+                for item in payload:
+                    await send_history_media(target, item)
+        else:
+            await send_history_media(target, payload)
+
+# Клавиатура под страницей истории: листание и действия с собеседником.
+# Курсор страницы в callback_data: history_<partner_id>_<o|n>_<id строки>
+def history_keyboard(partner_id, messages, has_older, has_newer):
+    navigation = []
+    if has_older:
+        navigation.append(InlineKeyboardButton(
+            text="⬅️ Раньше", callback_data=f"history_{partner_id}_o_{messages[0]['id']}"
+        ))
+    if has_newer:
+        navigation.append(InlineKeyboardButton(
+            text="Позже ➡️", callback_data=f"history_{partner_id}_n_{messages[-1]['id']}"
+        ))
+    buttons = [navigation] if navigation else []
+    buttons += [
+        [InlineKeyboardButton(text="Продолжить чат", callback_data=f"continue_chat_{partner_id}")],
+        [InlineKeyboardButton(text="Заблокировать", callback_data=f"block_user_{partner_id}")],
+        [InlineKeyboardButton(text="Вернуться в меню", callback_data="back_to_menu")]
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+# Показ одной страницы истории; без курсора - последние сообщения
+async def show_history_page(callback_query: types.CallbackQuery, partner_id, before=None, after=None):
     user_id = callback_query.from_user.id
 
     user_data = await get_user_by_id(user_id)
@@ -64,58 +213,36 @@ async def handle_open_chat(callback_query: types.CallbackQuery, bot: Bot):
     user_name = user_data['username'] if user_data else "Вы"
     partner_name = partner_data['username'] if partner_data else "Собеседник"
 
-    chat_history = await get_chat_history(user_id, partner_id)
+    messages, has_older, has_newer = await get_chat_history_page(user_id, partner_id, before=before, after=after)
 
-    if chat_history:
-        for message in chat_history:
-            sender_name = user_name if message['sender_id'] == user_id else partner_name
-            try:
-                if message['type'] == 'text':
-                    await callback_query.message.answer(f"{sender_name}: {message['content']}")
-                elif message['type'] == 'photo':
-                    if message['content']:
-                        await callback_query.message.answer_photo(FSInputFile(message['content']), caption=f"{sender_name}: Фото")
-                    else:
-                        await callback_query.message.answer(f"{sender_name}: Фото (файл отсутствует)")
-                elif message['type'] == 'video':
-                    if os.path.exists(message['content']):
-                        await callback_query.message.answer_video(FSInputFile(message['content']), caption=f"{sender_name}: Видео")
-                    else:
-                        await callback_query.message.answer(f"{sender_name}: Видео (файл отсутствует)")
-                elif message['type'] == 'audio':
-                    if os.path.exists(message['content']):
-                        await callback_query.message.answer_audio(FSInputFile(message['content']), caption=f"{sender_name}: Аудио")
-                    else:
-                        await callback_query.message.answer(f"{sender_name}: Аудио (файл отсутствует)")
-                elif message['type'] == 'voice':
-                    if os.path.exists(message['content']):
-                        await callback_query.message.answer_voice(FSInputFile(message['content']), caption=f"{sender_name}: Голосовое сообщение")
-                    else:
-                        await callback_query.message.answer(f"{sender_name}: Голосовое сообщение (файл отсутствует)")
-                elif message['type'] == 'animation':
-                    if os.path.exists(message['content']):
-                        await callback_query.message.answer_animation(FSInputFile(message['content']), caption=f"{sender_name}: Анимация")
-                    else:
-                        await callback_query.message.answer(f"{sender_name}: Анимация (файл отсутствует)")
-                elif message['type'] == 'video_note':
-                    if os.path.exists(message['content']):
-                        await callback_query.message.answer_video_note(FSInputFile(message['content']), caption=f"{sender_name}: Видео-заметка")
-                    else:
-                        await callback_query.message.answer(f"{sender_name}: Видео-заметка (файл отсутствует)")
-            except Exception as e:
-                logging.error(f"Ошибка при отправке медиафайла: {e}")
-                await callback_query.message.answer(f"{sender_name}: Медиафайл недоступен")
-
-        # Кнопки: продолжить чат, заблокировать и вернуться
-        buttons = [
-            [InlineKeyboardButton(text="Продолжить чат", callback_data=f"continue_chat_{partner_id}")],
-            [InlineKeyboardButton(text="Заблокировать", callback_data=f"block_user_{partner_id}")],
-            [InlineKeyboardButton(text="Вернуться в меню", callback_data="back_to_menu")]
-        ]
-        keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
+    if messages:
+        # Повтор истории уступает живой переписке в очереди отправки
+        with send_priority(PRIORITY_BULK):
+            await send_history(callback_query.message, messages, {user_id: user_name, partner_id: partner_name})
+
+        keyboard = history_keyboard(partner_id, messages, has_older, has_newer)
         await callback_query.message.answer("Что вы хотите сделать?", reply_markup=keyboard)
-    else:
+    elif before is None and after is None:
         await callback_query.message.answer("История чата пуста.")
+    else:
+        await callback_query.message.answer("Больше сообщений нет.")
+
+@history_router.callback_query(F.data.startswith('open_chat_'))
+async def handle_open_chat(callback_query: types.CallbackQuery, bot: Bot):
+    partner_id = int(callback_query.data.split('_')[2])
+    await show_history_page(callback_query, partner_id)
+
+# Листание истории по курсору из кнопки
+@history_router.callback_query(F.data.startswith('history_'))
+async def handle_history_page(callback_query: types.CallbackQuery):
+    # В кнопках, отправленных до перехода на курсор по id, перед id стоит message_id
+    _, partner_id, direction, *_, row_id = callback_query.data.split('_')
+    cursor = int(row_id)
+    if direction == 'o':
+        await show_history_page(callback_query, int(partner_id), before=cursor)
+    else:
+        await show_history_page(callback_query, int(partner_id), after=cursor)
+    await callback_query.answer()
 
 
 # Обработка предложения продолжить чат
@@ -126,12 +253,16 @@ async def handle_continue_chat(callback_query: types.CallbackQuery, bot: Bot):
 
     logging.info(f"User {user_id} is attempting to continue chat with partner {partner_id}")
 
-    # Проверяем, есть ли активный чат для пользователя
+    # Продолжить можно только завершённый чат: пользователь не должен уже состоять в активном
     active_chat = await get_active_chat(user_id)
     user_data = await get_user_by_id(user_id)
     user_name = user_data['username'] if user_data else "Собеседник"
     
-    if active_chat:
+    if not active_chat:
+        # id собеседника пришел из кнопки: предложение записывается, только если чат с ним действительно был
+        if not await propose_chat(user_id, partner_id):
+            await callback_query.message.answer("Продолжить этот чат нельзя.")
+            return
         try:
             logging.info(f"Sending message to partner_id {partner_id}")
 
@@ -139,7 +270,7 @@ async def handle_continue_chat(callback_query: types.CallbackQuery, bot: Bot):
             await bot.send_message(
                 partner_id, 
                 f"{user_name} предложил продолжить чат.", 
-                reply_markup=accept_or_decline_keyboard()
+                reply_markup=accept_or_decline_keyboard(user_id)
             )
             
             # Сообщаем пользователю, что запрос отправлен
@@ -148,45 +279,38 @@ async def handle_continue_chat(callback_query: types.CallbackQuery, bot: Bot):
             logging.error(f"Ошибка при отправке сообщения о продолжении чата: {e}")
             await callback_query.message.answer("Произошла ошибка при отправке запроса.")
     else:
-        await callback_query.message.answer("Чат с этим пользователем не найден.")
+        await callback_query.message.answer("Сначала завершите текущий чат.")
 
 
 
-@history_router.callback_query(F.data == "accept_chat")
+@history_router.callback_query(F.data.startswith("accept_chat_"))
 async def accept_chat(callback_query: types.CallbackQuery, bot: Bot):
     user_id = callback_query.from_user.id
-    active_chat = await get_active_chat(user_id)
-
-    if active_chat:
-        partner_id = active_chat['partner_id']
-        
-        # Логируем для отладки
-        logging.info(f"User ID: {user_id}, Partner ID: {partner_id}")
+    partner_id = int(callback_query.data.split('_')[2])
 
-        if user_id == partner_id:
-            logging.error("User and partner IDs are identical, check your chat logic.")
-            await callback_query.message.answer("Произошла ошибка, попробуйте позже.")
-            return
+    # Логируем для отладки
+    logging.info(f"User ID: {user_id}, Partner ID: {partner_id}")
 
-        # Подтверждаем продолжение чата
-        await add_active_chat(user_id, partner_id)
-        await add_active_chat(partner_id, user_id)
+    if user_id == partner_id:
+        logging.error("User and partner IDs are identical, check your chat logic.")
+        await callback_query.message.answer("Произошла ошибка, попробуйте позже.")
+        return
 
+    # Предложение проверяется по базе, пара создается атомарно, только если оба свободны
+    if await accept_chat_proposal(user_id, partner_id):
         # Отправляем уведомления
         await callback_query.message.answer("Вы приняли продолжение чата. Теперь можете отправлять сообщения.", reply_markup=match_keyboard())
         await bot.send_message(partner_id, "Ваш собеседник принял продолжение чата. Теперь можете отправлять сообщения.", reply_markup=match_keyboard())
     else:
-        logging.error("Не удалось найти активный чат.")
+        await callback_query.message.answer("Продолжить чат не получится: предложение устарело или один из собеседников уже в другом чате.")
 
 
 
 
-@history_router.callback_query(F.data == "decline_chat")
+@history_router.callback_query(F.data.startswith("decline_chat_"))
 async def decline_chat(callback_query: types.CallbackQuery):
-    user_id = callback_query.from_user.id
-
-    # Удаляем активный чат, если пользователь отклоняет
-    await remove_active_chat(user_id)
+    # Завершённый чат уже не активен, отклонение только погашает предложение
+    await decline_chat_proposal(int(callback_query.data.split('_')[2]), callback_query.from_user.id)
     await callback_query.message.answer("Вы отклонили продолжение чата.")
     # Завершаем процесс
 
@@ -1,57 +1,80 @@
 import logging
-import os
-from math import radians, sin, cos, sqrt, atan2
 from aiogram import F
 from aiogram.types import FSInputFile
 from aiogram import Router, types, Bot
 from aiogram.fsm.context import FSMContext
 from database import (
-    add_active_chat,
     add_finished_chat,
     block_user,
     get_active_chat,
     get_user_by_id, 
     add_to_waiting_list, 
-    find_match,
+    claim_match,
+    find_matches,
     get_user_interests,
     remove_active_chat,
     remove_from_waiting_list,
     save_chat_message_to_db  # Добавляем функцию для сохранения сообщений в БД
 )
 from keyboards import initial_keyboard, search_keyboard, match_keyboard
-from localization import translate  # Импорт функции для перевода интересов
+from media_archive import archive_media
+from outbound import PRIORITY_LIVE, set_send_priority
 from aiogram.filters import Command
 from utils import calculate_distance
+from interests import interest_key
+from vocabulary import interest_label
 from global_vars import active_chats
 
-# Путь для сохранения медиафайлов
-MEDIA_PATH = 'media_files/'
-if not os.path.exists(MEDIA_PATH):
-    os.makedirs(MEDIA_PATH)
-
 matchmaking_router = Router()
 
-# Функция для получения общих интересов
+# Функция для получения общих интересов (сравниваются канонические ключи)
 def get_common_interests(user_interests, match_interests):
-    return list(set(user_interests) & set(match_interests))
+    match_keys = {interest_key(interest) or interest for interest in match_interests}
+    return [key for key in dict.fromkeys(interest_key(interest) or interest for interest in user_interests) if key in match_keys]
 
 # Функция для перевода интересов на нужный язык
 def translate_interests(interests, lang_code):
-    return [translate(interest.lower(), lang_code) for interest in interests]
-
-# Модификация функции для запуска поиска партнера с проверкой на активные чаты
-async def start_matchmaking(user_id, username, gender, orientation, interests, location):
-    await add_to_waiting_list(user_id, username, gender, orientation, interests, location)
-
-    # Пытаемся найти совпадение
-    match = await find_match(user_id, gender, orientation, interests, location)
-    
-    # Проверка, занят ли пользователь в активном чате
-    active_chat = await get_active_chat(user_id)
-    if match and not active_chat:
-        return match['user_id'], match['username']
-    else:
-        return None, None
+    return [interest_label(interest, lang_code) for interest in interests]
+
+# Сколько лучших кандидатов пробовать захватить за один поиск
+MATCH_CANDIDATES = 5
+
+# Запуск поиска партнера: пользователь встает в очередь и пытается атомарно захватить лучшего кандидата
+async def start_matchmaking(user_id, username, gender, orientation, interests, lat, lon):
+    await add_to_waiting_list(user_id, username, gender, orientation, interests, lat, lon)
+    return await claim_best_match(user_id, gender, orientation, interests, lat, lon)
+
+# Захват первого свободного из лучших кандидатов; кандидат, занятый параллельным поиском, пропускается
+async def claim_best_match(user_id, gender, orientation, interests, lat, lon):
+    matches = await find_matches(user_id, gender, orientation, interests, lat, lon, limit=MATCH_CANDIDATES)
+    for match in matches:
+        if await claim_match(user_id, match['user_id']):
+            return match['user_id'], match['username']
+    return None, None
+
+# Уведомление обоих собеседников о созданной паре
+async def notify_match(bot: Bot, user, match_user):
+    user_id, match_user_id = user['user_id'], match_user['user_id']
+    user_interests = await get_user_interests(user_id)
+    match_interests = await get_user_interests(match_user_id)
+
+    # Определение общих интересов
+    common_interests = get_common_interests(user_interests, match_interests)
+
+    distance = calculate_distance(user['lat'], user['lon'], match_user['lat'], match_user['lon'])
+
+    translated_common_interests = translate_interests(common_interests, user['lang'])
+    match_info = (
+        f"Найдено совпадение с пользователем: {match_user['username']}.\n"
+        f"Общие интересы: {', '.join(translated_common_interests) if common_interests else 'Нет общих интересов'}.\n"
+        f"Расстояние между вами: {distance:.2f} км.\n"
+        f"Вы можете начать общение."
+    )
+    await bot.send_message(user_id, match_info, reply_markup=match_keyboard())
+    await bot.send_message(match_user_id, f"У вас есть совпадение с пользователем: {user['username']}.\n"
+                                          f"Общие интересы: {', '.join(translate_interests(common_interests, match_user['lang'])) if common_interests else 'Нет общих интересов'}.\n"
+                                          f"Расстояние между вами: {distance:.2f} км.\n"
+                                          f"Вы можете начать общение.", reply_markup=match_keyboard())
 
 @matchmaking_router.message(F.text == '🔍 Поиск')
 async def handle_find_match_button(message: types.Message, bot: Bot):
@@ -60,45 +83,18 @@ async def handle_find_match_button(message: types.Message, bot: Bot):
         gender = user['gender']
         orientation = user['orientation']
         user_interests = await get_user_interests(user['user_id'])
-        location = user['location']
         username = user['username']
-        lang_code = user['lang']
 
         await message.answer("Поиск начат, пожалуйста, подождите...", reply_markup=search_keyboard())
 
-        match_user_id, match_username = await start_matchmaking(user['user_id'], username, gender, orientation, ', '.join(user_interests), location)
+        match_user_id, match_username = await start_matchmaking(user['user_id'], username, gender, orientation, ', '.join(user_interests), user['lat'], user['lon'])
 
         if match_user_id and match_username:
             match_user = await get_user_by_id(match_user_id)
-            match_interests = await get_user_interests(match_user_id)
-            match_location = match_user['location']
-            match_lang_code = match_user['lang']
-
-            # Определение общих интересов
-            common_interests = get_common_interests(user_interests, match_interests)
-            translated_common_interests = translate_interests(common_interests, lang_code)
-
-            user_lat, user_lon = map(float, location.split(','))
-            match_lat, match_lon = map(float, match_location.split(','))
-            distance = calculate_distance(user_lat, user_lon, match_lat, match_lon)
-
-            # Сохраняем активный чат в базе данных
-            await add_active_chat(user['user_id'], match_user_id)
-            await add_active_chat(match_user_id, user['user_id'])
-
-            match_info = (
-                f"Найдено совпадение с пользователем: {match_username}.\n"
-                f"Общие интересы: {', '.join(translated_common_interests) if common_interests else 'Нет общих интересов'}.\n"
-                f"Расстояние между вами: {distance:.2f} км.\n"
-                f"Вы можете начать общение."
-            )
-            await message.answer(match_info, reply_markup=match_keyboard())
-            await bot.send_message(match_user_id, f"У вас есть совпадение с пользователем: {user['username']}.\n"
-                                                  f"Общие интересы: {', '.join(translate_interests(common_interests, match_lang_code)) if common_interests else 'Нет общих интересов'}.\n"
-                                                  f"Расстояние между вами: {distance:.2f} км.\n"
-                                                  f"Вы можете начать общение.", reply_markup=match_keyboard())
+            await notify_match(bot, user, match_user)
         else:
-            await message.answer("Извините, не удалось найти совпадение.", reply_markup=initial_keyboard())
+            # Пользователь остается в списке ожидания, фоновый подбор сообщит о паре
+            await message.answer("Подходящих собеседников пока нет. Поиск продолжается, мы сообщим, когда найдём пару.", reply_markup=search_keyboard())
     else:
         await message.answer("Пользователь не найден. Попробуйте зарегистрироваться заново.")
 
@@ -158,20 +154,12 @@ async def handle_block_user_button(message: types.Message, bot: Bot):
         await message.answer("Вы не находитесь в активном чате.")
 
         
-# Функция для сохранения медиафайлов
-async def save_media_file(file_id: str, file_type: str, message_id: int, user_id: int, bot: Bot):
-    file_info = await bot.get_file(file_id)
-    extension = file_type if file_type != "voice" else "ogg"  # Голосовые сохраняем как .ogg
-    file_name = f"{message_id}_{user_id}.{extension}"
-    file_path = os.path.join(MEDIA_PATH, file_name)
-
-    # Сохраняем файл на диск
-    await bot.download_file(file_info.file_path, file_path)
-    return file_path
-
-# Обработка сообщений и медиафайлов между пользователями в чате
+# Обработка сообщений и медиафайлов между пользователями в чате.
+# Медиа пересылается по file_id сразу, скачивание в архив идет в фоне (media_archive)
 @matchmaking_router.message(F.text | F.photo | F.video | F.audio | F.voice | F.animation | F.video_note)
 async def relay_message(message: types.Message, bot: Bot):
+    # Пересылка собеседнику идет впереди остальных отправок
+    set_send_priority(PRIORITY_LIVE)
     user_id = message.from_user.id
     active_chat = await get_active_chat(user_id)
 
@@ -183,48 +171,48 @@ async def relay_message(message: types.Message, bot: Bot):
             if message.text:
                 await save_chat_message_to_db(user_id, partner_id, message.message_id, message.text, 'text')
                 await bot.send_message(partner_id, message.text)
-        
+
             elif message.photo:
-                file_id = message.photo[-1].file_id
-                file_path = await save_media_file(file_id, "jpg", message.message_id, user_id, bot)
-                await save_chat_message_to_db(user_id, partner_id, message.message_id, file_path, 'photo')
+                media = message.photo[-1]
+                file_id = media.file_id
                 await bot.send_photo(partner_id, file_id, caption=message.caption)
+                await archive_media(user_id, partner_id, message.message_id, file_id, media.file_unique_id, 'photo')
 
-            # Сохраняем и пересылаем видео
+            # Пересылаем и архивируем видео
             elif message.video:
-                file_id = message.video.file_id
-                file_path = await save_media_file(file_id, "mp4", message.message_id, user_id, bot)
-                await save_chat_message_to_db(user_id, partner_id, message.message_id, file_path, 'video')
+                media = message.video
+                file_id = media.file_id
                 await bot.send_video(partner_id, file_id, caption=message.caption)
+                await archive_media(user_id, partner_id, message.message_id, file_id, media.file_unique_id, 'video')
 
-            # Сохраняем и пересылаем аудио
+            # Пересылаем и архивируем аудио
             elif message.audio:
-                file_id = message.audio.file_id
-                file_path = await save_media_file(file_id, "mp3", message.message_id, user_id, bot)
-                await save_chat_message_to_db(user_id, partner_id, message.message_id, file_path, 'audio')
+                media = message.audio
+                file_id = media.file_id
                 await bot.send_audio(partner_id, file_id, caption=message.caption)
+                await archive_media(user_id, partner_id, message.message_id, file_id, media.file_unique_id, 'audio')
 
-            # Сохраняем и пересылаем голосовые сообщения
+            # Пересылаем и архивируем голосовые сообщения
             elif message.voice:
-                file_id = message.voice.file_id
-                file_path = await save_media_file(file_id, "ogg", message.message_id, user_id, bot)
-                await save_chat_message_to_db(user_id, partner_id, message.message_id, file_path, 'voice')
+                media = message.voice
+                file_id = media.file_id
                 await bot.send_voice(partner_id, file_id)
+                await archive_media(user_id, partner_id, message.message_id, file_id, media.file_unique_id, 'voice')
 
-            # Сохраняем и пересылаем анимацию (GIF)
+            # Пересылаем и архивируем анимацию (GIF)
             elif message.animation:
-                file_id = message.animation.file_id
-                file_path = await save_media_file(file_id, "gif", message.message_id, user_id, bot)
-                await save_chat_message_to_db(user_id, partner_id, message.message_id, file_path, 'animation')
+                media = message.animation
+                file_id = media.file_id
                 await bot.send_animation(partner_id, file_id, caption=message.caption)
+                await archive_media(user_id, partner_id, message.message_id, file_id, media.file_unique_id, 'animation')
 
-            # Сохраняем и пересылаем видео-заметки (кружки)
+            # Пересылаем и архивируем видео-заметки (кружки)
             elif message.video_note:
-                file_id = message.video_note.file_id
-                file_path = await save_media_file(file_id, "mp4", message.message_id, user_id, bot)
-                await save_chat_message_to_db(user_id, partner_id, message.message_id, file_path, 'video_note')
+                media = message.video_note
+                file_id = media.file_id
                 await bot.send_video_note(partner_id, file_id)
+                await archive_media(user_id, partner_id, message.message_id, file_id, media.file_unique_id, 'video_note')
         else:
             await message.answer("Ошибка: неверный идентификатор собеседника.")
     else:
-        await message.answer("Вы не находитесь в активном чате.")
\ No newline at end of file
+        await message.answer("Вы не находитесь в активном чате.")
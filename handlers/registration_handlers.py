@@ -1,21 +1,17 @@
 import logging
-import os
 from aiogram import Router, types, Bot
 from aiogram import F
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.filters import Command
-from database import (
-    get_user_by_id, create_user, get_user_interests, get_user_language, is_nickname_taken, update_user_photo, update_user_age,
-    update_user_language, update_user_gender, update_user_orientation,
-    update_user_interests, update_user_nickname, update_user_location,
-    update_user_custom_gender, update_user_ban_until, update_user_birth_year
-)
+from database import get_user_by_id, get_user_interests, get_user_language, is_nickname_taken, save_registration
 from localization import set_language, translate
+from media_store import send_profile_media, store_media
+from interests import INTEREST_MESSAGE_KEYS
+from vocabulary import gender_label, interest_label, lookup_gender, lookup_interest, lookup_orientation, orientation_label
 from aiogram.filters import StateFilter
-from aiogram.types import FSInputFile
 from datetime import datetime
-from keyboards import initial_keyboard
+from keyboards import cached_keyboard, initial_keyboard
 
 registration_router = Router()
 
@@ -32,59 +28,6 @@ class Registration(StatesGroup):
     profile_photo = State()
     location = State()
 
-# Убедитесь, что папка для фото существует
-PHOTO_PATH = 'photos/'
-if not os.path.exists(PHOTO_PATH):
-    os.makedirs(PHOTO_PATH)
-
-# Маппинг для перевода пола и ориентации
-GENDER_MAP = {
-    'Male': 'gender_male',
-    'Female': 'gender_female',
-    'Other': 'gender_other'
-}
-
-ORIENTATION_MAP = {
-    'Heterosexual': 'orientation_heterosexual',
-    'Homosexual': 'orientation_homosexual',
-    'Bisexual': 'orientation_bisexual',
-    'Pansexual': 'orientation_pansexual',
-    'Asexual': 'orientation_asexual',
-    'Lesbian': 'orientation_lesbian'
-}
-
-
-INTERESTS_MAP = {
-    "Music": {"en": "Music", "ru": "Музыка", "kz": "Музыка"},
-    "Cinema": {"en": "Cinema", "ru": "Кино", "kz": "Кино"},
-    "Sport": {"en": "Sport", "ru": "Спорт", "kz": "Спорт"},
-    "Technology": {"en": "Technology", "ru": "Технологии", "kz": "Технологиялар"},
-    "Travel": {"en": "Travel", "ru": "Путешествия", "kz": "Саяхат"},
-    "Food": {"en": "Food", "ru": "Еда", "kz": "Тамақ"},
-    "Fashion": {"en": "Fashion", "ru": "Мода", "kz": "Сән"},
-    "Reading": {"en": "Reading", "ru": "Чтение", "kz": "Оқу"},
-    "Programming": {"en": "Programming", "ru": "Программирование", "kz": "Бағдарламалау"},
-    "Games": {"en": "Games", "ru": "Игры", "kz": "Ойындар"},
-    "Photography": {"en": "Photography", "ru": "Фотография", "kz": "Фотосурет"},
-    "Dancing": {"en": "Dancing", "ru": "Танцы", "kz": "Би"},
-    "Yoga": {"en": "Yoga", "ru": "Йога", "kz": "Йога"},
-    "Meditation": {"en": "Meditation", "ru": "Медитация", "kz": "Медитация"},
-    "Cooking": {"en": "Cooking", "ru": "Кулинария", "kz": "Аспаздық"},
-    "Crossfit": {"en": "Crossfit", "ru": "Кроссфит", "kz": "Кроссфит"},
-    "Art": {"en": "Art", "ru": "Искусство", "kz": "Өнер"},
-    "Drawing": {"en": "Drawing", "ru": "Рисование", "kz": "Сурет салу"},
-    "Playing Music": {"en": "Playing Music", "ru": "Игра на музыкальных инструментах", "kz": "Музыкалық аспаптарда ойнау"},
-    "Singing": {"en": "Singing", "ru": "Пение", "kz": "Ән айту"},
-    "Psychology": {"en": "Psychology", "ru": "Психология", "kz": "Психология"},
-    "Science": {"en": "Science", "ru": "Наука", "kz": "Ғылым"},
-    "Cars": {"en": "Cars", "ru": "Автомобили", "kz": "Көліктер"},
-    "Motorcycles": {"en": "Motorcycles", "ru": "Мотоциклы", "kz": "Мотоциклдер"},
-    "Extreme Sports": {"en": "Extreme Sports", "ru": "Экстремальные виды спорта", "kz": "Экстремалды спорт түрлері"},
-    "Outdoor Cooking": {"en": "Outdoor Cooking", "ru": "Готовка на открытом воздухе", "kz": "Ашық аспан астындағы аспаздық"},
-    "Camping": {"en": "Camping", "ru": "Кемпинг", "kz": "Кемпинг"},
-    "Movies": {"en": "Movies", "ru": "Фильмы", "kz": "Фильмдер"}
-}
-
 # Функция для сохранения и удаления сообщений
 async def safe_send_message(message, text, state, reply_markup=None):
     msg = await message.answer(text, reply_markup=reply_markup)
@@ -118,27 +61,25 @@ async def delete_registration_messages(message: types.Message, state: FSMContext
 
     await state.update_data(bot_messages=[], user_messages=[])
 
-# Функция для сохранения фото профиля
-async def save_profile_photo(bot: Bot, photo: types.PhotoSize, user_id: int):
-    file_info = await bot.get_file(photo.file_id)
-    file_extension = file_info.file_path.split('.')[-1]
-    file_name = f"{user_id}.{file_extension}"
-    photo_path = os.path.join(PHOTO_PATH, file_name)
-    await bot.download_file(file_info.file_path, photo_path)
-    return photo_path
-
-# Функция для сохранения видео или GIF
-async def save_profile_video_or_gif(bot: Bot, media: types.Video | types.Animation, user_id: int, media_type: str):
-    file_info = await bot.get_file(media.file_id)
-    file_extension = 'mp4' if media_type == 'video' else 'gif'
-    file_name = f"{user_id}.{file_extension}"
-    media_path = os.path.join(PHOTO_PATH, file_name)
-    await bot.download_file(file_info.file_path, media_path)
-    return media_path
+# Поля профиля копятся в состоянии FSM (ключ 'profile') и пишутся в базу одной транзакцией в конце
+async def get_registration_profile(state: FSMContext):
+    data = await state.get_data()
+    return data.get('profile', {})
+
+async def update_registration_profile(state: FSMContext, **fields):
+    profile = await get_registration_profile(state)
+    profile.update(fields)
+    await state.update_data(profile=profile)
+    return profile
+
+# Язык, выбранный на первом шаге регистрации
+async def get_registration_lang(state: FSMContext):
+    profile = await get_registration_profile(state)
+    return profile.get('lang', 'en')
 
 # Начало регистрации
 async def start_registration(message: types.Message, state: FSMContext, bot: Bot):
-    await create_user(message.from_user.id, message.from_user.username)
+    await state.set_data({'profile': {'username': message.from_user.username or ''}})
     lang_code = 'en'
     await safe_send_message(message, translate('choose_language', lang_code), state, reply_markup=set_language())
     await state.set_state(Registration.language)
@@ -152,59 +93,73 @@ async def set_user_language(message: types.Message, state: FSMContext, bot: Bot)
         "Русский": "ru"
     }
     lang_code = language_map.get(message.text, 'en')
-    await update_user_language(message.from_user.id, lang_code)
+    await update_registration_profile(state, lang=lang_code)
     await safe_send_message(message, translate('enter_nickname', lang_code), state, reply_markup=types.ReplyKeyboardRemove())
     await state.set_state(Registration.nickname)
 
 
-# Ввод никнейма
+NICKNAME_TAKEN_TEXT = "Этот никнейм уже занят. Пожалуйста, выберите другой."
+
+# Никнейм заняли, пока шла регистрация: возвращаем к его вводу. Остальные ответы лежат в состоянии,
+# поэтому после нового никнейма с шага локации регистрация продолжается с него же
+async def ask_nickname_again(message, state, resume_location=False):
+    await state.update_data(resume_location=resume_location)
+    await safe_send_message(message, NICKNAME_TAKEN_TEXT, state, reply_markup=types.ReplyKeyboardRemove())
+    await state.set_state(Registration.nickname)
 
+# Ввод никнейма
 @registration_router.message(StateFilter(Registration.nickname))
 async def set_nickname(message: types.Message, state: FSMContext, bot: Bot):
     await safe_send_user_message(message, state)
 
-    # Проверяем, занят ли никнейм
+    # Проверяем, занят ли никнейм; окончательно его проверяет уникальный ключ при сохранении
     if await is_nickname_taken(message.text):
-        await message.answer("Этот никнейм уже занят. Пожалуйста, выберите другой.")
+        await message.answer(NICKNAME_TAKEN_TEXT)
         return
     
-    user = await get_user_by_id(message.from_user.id)
-    if user:
-        await update_user_nickname(message.from_user.id, message.text)
-        lang_code = user['lang']
-        await safe_send_message(message, translate('enter_birth_year', lang_code), state)
-        await state.set_state(Registration.birth_year)
+    profile = await update_registration_profile(state, username=message.text)
+    lang_code = profile.get('lang', 'en')
+    if (await state.get_data()).get('resume_location'):
+        await state.update_data(resume_location=False)
+        await safe_send_message(message, translate('share_location_prompt', lang_code), state, reply_markup=request_location_keyboard(lang_code))
+        await state.set_state(Registration.location)
+        return
+    await safe_send_message(message, translate('enter_birth_year', lang_code), state)
+    await state.set_state(Registration.birth_year)
 
 # Ввод года рождения
 @registration_router.message(StateFilter(Registration.birth_year))
 async def set_birth_year(message: types.Message, state: FSMContext):
     await safe_send_user_message(message, state)
-    user = await get_user_by_id(message.from_user.id)
-    if user:
-        lang_code = user['lang']
-        if not message.text.isdigit():
-            await safe_send_message(message, translate('invalid_birth_year', lang_code), state)
-            return
+    lang_code = await get_registration_lang(state)
+    if not message.text.isdigit():
+        await safe_send_message(message, translate('invalid_birth_year', lang_code), state)
+        return
 
-        birth_year = int(message.text)
-        current_year = datetime.now().year
-        age = current_year - birth_year
-        if age < 19:
-            ban_duration = 19 - age
-            unban_year = current_year + ban_duration
-            await update_user_ban_until(message.from_user.id, unban_year)
-            await safe_send_message(message, translate('underage_ban', lang_code).format(unban_year=unban_year), state)
-            return
-        elif birth_year > current_year or birth_year < 1990:
-            await safe_send_message(message, translate('invalid_birth_year', lang_code), state)
+    birth_year = int(message.text)
+    current_year = datetime.now().year
+    age = current_year - birth_year
+    if age < 19:
+        ban_duration = 19 - age
+        unban_year = current_year + ban_duration
+        # Блокировку сохраняем сразу, не дожидаясь конца регистрации
+        profile = await update_registration_profile(state, ban_until=unban_year)
+        if not await save_registration(message.from_user.id, profile):
+            await ask_nickname_again(message, state)
             return
+        await safe_send_message(message, translate('underage_ban', lang_code).format(unban_year=unban_year), state)
+        return
+    elif birth_year > current_year or birth_year < 1990:
+        await safe_send_message(message, translate('invalid_birth_year', lang_code), state)
+        return
 
-        await update_user_age(message.from_user.id, age)
-        await safe_send_message(message, translate('age_saved', lang_code), state)
-        await safe_send_message(message, translate('start_registration', lang_code), state, reply_markup=get_gender_keyboard(lang_code))
-        await state.set_state(Registration.gender)
+    await update_registration_profile(state, age=age)
+    await safe_send_message(message, translate('age_saved', lang_code), state)
+    await safe_send_message(message, translate('start_registration', lang_code), state, reply_markup=get_gender_keyboard(lang_code))
+    await state.set_state(Registration.gender)
 
 # Клавиатура для выбора пола
+@cached_keyboard
 def get_gender_keyboard(lang_code):
     gender_buttons = [
         [types.KeyboardButton(text=translate('gender_male', lang_code))],
@@ -218,45 +173,36 @@ def get_gender_keyboard(lang_code):
 @registration_router.message(StateFilter(Registration.gender))
 async def set_gender(message: types.Message, state: FSMContext, bot: Bot):
     await safe_send_user_message(message, state)
-    user = await get_user_by_id(message.from_user.id)
-    if user:
-        lang_code = user['lang']
-        gender_map = {
-            translate('gender_male', lang_code): 'Male',
-            translate('gender_female', lang_code): 'Female',
-            translate('gender_other', lang_code): 'Other'
-        }
-        gender = gender_map.get(message.text)
-        if not gender:
-            await safe_send_message(message, translate('invalid_gender', lang_code), state)
-            return
+    lang_code = await get_registration_lang(state)
+    gender = lookup_gender(message.text, lang_code)
+    if not gender:
+        await safe_send_message(message, translate('invalid_gender', lang_code), state)
+        return
 
-        if gender == 'Other':
-            await safe_send_message(message, translate('enter_custom_gender', lang_code), state)
-            await state.set_state(Registration.custom_gender)
-        else:
-            await update_user_gender(message.from_user.id, gender)
-            await safe_send_message(message, translate('gender_saved', lang_code), state, reply_markup=types.ReplyKeyboardRemove())
-            await safe_send_message(message, translate('choose_orientation', lang_code), state, reply_markup=get_orientation_keyboard(gender, lang_code))
-            await state.set_state(Registration.orientation)
+    if gender == 'Other':
+        await safe_send_message(message, translate('enter_custom_gender', lang_code), state)
+        await state.set_state(Registration.custom_gender)
+    else:
+        await update_registration_profile(state, gender=gender)
+        await safe_send_message(message, translate('gender_saved', lang_code), state, reply_markup=types.ReplyKeyboardRemove())
+        await safe_send_message(message, translate('choose_orientation', lang_code), state, reply_markup=get_orientation_keyboard(gender, lang_code))
+        await state.set_state(Registration.orientation)
 
 # Обработка кастомного гендера
 @registration_router.message(StateFilter(Registration.custom_gender))
 async def set_custom_gender(message: types.Message, state: FSMContext, bot: Bot):
     await safe_send_user_message(message, state)
-    user = await get_user_by_id(message.from_user.id)
-    if user:
-        lang_code = user['lang']
+    lang_code = await get_registration_lang(state)
 
-        custom_gender = message.text
-        await update_user_custom_gender(message.from_user.id, custom_gender)
-        await update_user_gender(message.from_user.id, 'Other')
+    custom_gender = message.text
+    await update_registration_profile(state, gender='Other', custom_gender=custom_gender)
 
-        await safe_send_message(message, translate('gender_saved_custom', lang_code).format(custom_gender=custom_gender), state, reply_markup=types.ReplyKeyboardRemove())
-        await safe_send_message(message, translate('choose_orientation', lang_code), state, reply_markup=get_orientation_keyboard('Other', lang_code))
-        await state.set_state(Registration.orientation)
+    await safe_send_message(message, translate('gender_saved_custom', lang_code).format(custom_gender=custom_gender), state, reply_markup=types.ReplyKeyboardRemove())
+    await safe_send_message(message, translate('choose_orientation', lang_code), state, reply_markup=get_orientation_keyboard('Other', lang_code))
+    await state.set_state(Registration.orientation)
 
 # Клавиатура для выбора ориентации
+@cached_keyboard
 def get_orientation_keyboard(gender, lang_code):
     if gender == 'Male':
         orientation_buttons = [
@@ -290,54 +236,35 @@ def get_orientation_keyboard(gender, lang_code):
 @registration_router.message(StateFilter(Registration.orientation))
 async def set_orientation(message: types.Message, state: FSMContext, bot: Bot):
     await safe_send_user_message(message, state)
-    user = await get_user_by_id(message.from_user.id)
-    if user:
-        lang_code = user['lang']
-        
-        orientation_map = {
-            translate('orientation_heterosexual', lang_code): 'Heterosexual',
-            translate('orientation_homosexual', lang_code): 'Homosexual',
-            translate('orientation_bisexual', lang_code): 'Bisexual',
-            translate('orientation_pansexual', lang_code): 'Pansexual',
-            translate('orientation_asexual', lang_code): 'Asexual',
-            translate('orientation_lesbian', lang_code): 'Lesbian'
-        }
-        orientation = orientation_map.get(message.text)
-
-        if not orientation:
-            await safe_send_message(message, translate('invalid_orientation', lang_code), state)
-            return
+    lang_code = await get_registration_lang(state)
 
-        await update_user_orientation(message.from_user.id, orientation)
-        await safe_send_message(message, translate('orientation_saved', lang_code), state, reply_markup=types.ReplyKeyboardRemove())
-        await safe_send_message(message, translate('choose_interests', lang_code), state, reply_markup=get_interests_keyboard(lang_code))
-        await state.set_state(Registration.interests)
+    orientation = lookup_orientation(message.text, lang_code)
+
+    if not orientation:
+        await safe_send_message(message, translate('invalid_orientation', lang_code), state)
+        return
+
+    await update_registration_profile(state, orientation=orientation)
+    await safe_send_message(message, translate('orientation_saved', lang_code), state, reply_markup=types.ReplyKeyboardRemove())
+    await safe_send_message(message, translate('choose_interests', lang_code), state, reply_markup=get_interests_keyboard(lang_code))
+    await state.set_state(Registration.interests)
 
 # Клавиатура для выбора интересов с 40 пунктами
+@cached_keyboard
 def get_interests_keyboard(lang_code):
+    message_keys = list(INTEREST_MESSAGE_KEYS.values())
     interests_buttons = [
-        [types.KeyboardButton(text=translate('music', lang_code)), types.KeyboardButton(text=translate('cinema', lang_code))],
-        [types.KeyboardButton(text=translate('sport', lang_code)), types.KeyboardButton(text=translate('technology', lang_code))],
-        [types.KeyboardButton(text=translate('travel', lang_code)), types.KeyboardButton(text=translate('food', lang_code))],
-        [types.KeyboardButton(text=translate('fashion', lang_code)), types.KeyboardButton(text=translate('reading', lang_code))],
-        [types.KeyboardButton(text=translate('programming', lang_code)), types.KeyboardButton(text=translate('games', lang_code))],
-        [types.KeyboardButton(text=translate('photography', lang_code)), types.KeyboardButton(text=translate('dancing', lang_code))],
-        [types.KeyboardButton(text=translate('yoga', lang_code)), types.KeyboardButton(text=translate('meditation', lang_code))],
-        [types.KeyboardButton(text=translate('cooking', lang_code)), types.KeyboardButton(text=translate('crossfit', lang_code))],
-        [types.KeyboardButton(text=translate('art', lang_code)), types.KeyboardButton(text=translate('drawing', lang_code))],
-        [types.KeyboardButton(text=translate('music_playing', lang_code)), types.KeyboardButton(text=translate('singing', lang_code))],
-        [types.KeyboardButton(text=translate('psychology', lang_code)), types.KeyboardButton(text=translate('science', lang_code))],
-        [types.KeyboardButton(text=translate('cars', lang_code)), types.KeyboardButton(text=translate('motorcycles', lang_code))],
-        [types.KeyboardButton(text=translate('extreme_sports', lang_code)), types.KeyboardButton(text=translate('outdoor_cooking', lang_code))],
-        [types.KeyboardButton(text=translate('camping', lang_code)), types.KeyboardButton(text=translate('movies', lang_code))]
+        [types.KeyboardButton(text=translate(message_key, lang_code)) for message_key in message_keys[i:i + 2]]
+        for i in range(0, len(message_keys), 2)
     ]
     markup = types.ReplyKeyboardMarkup(keyboard=interests_buttons, resize_keyboard=True)
     return markup
 
 # Клавиатура с кнопкой "Готово", когда выбрано минимум 3 интереса
+@cached_keyboard
 def get_interests_keyboard_with_done(lang_code):
-    interests_buttons = get_interests_keyboard(lang_code).keyboard
-    interests_buttons.insert(0, [types.KeyboardButton(text=translate('done', lang_code))])  # Добавляем кнопку "Готово" в начало
+    # Новый список строк: клавиатура интересов общая и не должна меняться
+    interests_buttons = [[types.KeyboardButton(text=translate('done', lang_code))]] + get_interests_keyboard(lang_code).keyboard
     markup = types.ReplyKeyboardMarkup(keyboard=interests_buttons, resize_keyboard=True)
     return markup
 
@@ -347,26 +274,21 @@ async def set_interests(message: types.Message, state: FSMContext, bot: Bot):
     await safe_send_user_message(message, state)
     data = await state.get_data()
     user_interests = data.get('user_interests', [])
-    user = await get_user_by_id(message.from_user.id)
-    lang_code = user['lang']
+    lang_code = data.get('profile', {}).get('lang', 'en')
 
     if message.text == translate('done', lang_code):
         if len(user_interests) < 3:
             await safe_send_message(message, translate('interests_minimum', lang_code), state)
         else:
-            english_interests = [INTERESTS_MAP.get(interest, {}).get('en', interest) for interest in user_interests]
-            await update_user_interests(message.from_user.id, english_interests)
+            await state.update_data(interests=user_interests)
             await safe_send_message(message, translate('registration_completed', lang_code), state, reply_markup=types.ReplyKeyboardRemove())
             await safe_send_message(message, translate('ask_add_photo', lang_code), state, reply_markup=get_yes_no_keyboard(lang_code))
             await state.set_state(Registration.add_photo_choice)
     else:
-        english_interest = next(
-            (interest for interest, translations in INTERESTS_MAP.items() if translations.get(lang_code) == message.text),
-            None
-        )
+        interest = lookup_interest(message.text, lang_code)
 
-        if english_interest and english_interest not in user_interests:
-            user_interests.append(english_interest)
+        if interest and interest not in user_interests:
+            user_interests.append(interest)
             await state.update_data(user_interests=user_interests)
             await safe_send_message(message, f"{message.text} {translate('interest_added', lang_code)}", state)
 
@@ -376,6 +298,7 @@ async def set_interests(message: types.Message, state: FSMContext, bot: Bot):
             await safe_send_message(message, translate('choose_more_interests', lang_code), state)
 
 # Клавиатура с кнопками "Да" и "Нет"
+@cached_keyboard
 def get_yes_no_keyboard(lang_code):
     buttons = [
         [types.KeyboardButton(text=translate('yes', lang_code))],
@@ -387,8 +310,7 @@ def get_yes_no_keyboard(lang_code):
 @registration_router.message(StateFilter(Registration.add_photo_choice))
 async def add_photo_choice(message: types.Message, state: FSMContext, bot: Bot):
     await safe_send_user_message(message, state)
-    user = await get_user_by_id(message.from_user.id)
-    lang_code = user['lang']
+    lang_code = await get_registration_lang(state)
 
     if message.text == translate('yes', lang_code):
         await safe_send_message(message, translate('send_profile_photo', lang_code), state, reply_markup=types.ReplyKeyboardRemove())
@@ -403,57 +325,36 @@ async def add_photo_choice(message: types.Message, state: FSMContext, bot: Bot):
 @registration_router.message(StateFilter(Registration.profile_photo), F.photo | F.video | F.animation)
 async def process_profile_media(message: types.Message, state: FSMContext, bot: Bot):
     await safe_send_user_message(message, state)
-    user = await get_user_by_id(message.from_user.id)
-    if user:
-        lang_code = user['lang']
-
-        media = None
-        media_type = None
-        if message.photo:
-            media = message.photo[-1]
-            media_type = 'photo'
-        elif message.video:
-            media = message.video
-            media_type = 'video'
-        elif message.animation:
-            media = message.animation
-            media_type = 'animation'
-
-        if not media:
-            await safe_send_message(message, translate('invalid_media', lang_code), state)
-            return
-
-        try:
-            if media_type == 'photo':
-                file_path = await save_profile_photo(bot, media, message.from_user.id)
-            else:
-                file_path = await save_profile_video_or_gif(bot, media, message.from_user.id, media_type)
-            
-            await update_user_photo(message.from_user.id, file_path)
-            await safe_send_message(message, translate('media_saved', lang_code), state, reply_markup=types.ReplyKeyboardRemove())
-            await safe_send_message(message, translate('share_location_prompt', lang_code), state, reply_markup=request_location_keyboard(lang_code))
-            await state.set_state(Registration.location)
-        except Exception as e:
-            await safe_send_message(message, translate('media_save_error', lang_code), state)
-            logging.error(f"Ошибка при сохранении медиа: {e}")
-
-# Функция для сохранения видео или GIF
-async def save_profile_video_or_gif(bot: Bot, media: types.Video | types.Animation, user_id: int, media_type: str):
-    # Получаем информацию о файле с помощью API Telegram
-    file_info = await bot.get_file(media.file_id)
-    file_extension = 'mp4' if media_type == 'video' else 'gif'
-    file_name = f"{user_id}.{file_extension}"
-
-    # Путь для сохранения видео или GIF
-    media_path = os.path.join(PHOTO_PATH, file_name)
-
-    # Сохраняем файл локально
-    await bot.download_file(file_info.file_path, media_path)
+    lang_code = await get_registration_lang(state)
+
+    media = None
+    media_type = None
+    if message.photo:
+        media = message.photo[-1]
+        media_type = 'photo'
+    elif message.video:
+        media = message.video
+        media_type = 'video'
+    elif message.animation:
+        media = message.animation
+        media_type = 'animation'
+
+    if not media:
+        await safe_send_message(message, translate('invalid_media', lang_code), state)
+        return
 
-    # Возвращаем путь к видео или GIF
-    return media_path
+    try:
+        file_path = await store_media(bot, media.file_id, media.file_unique_id, media_type)
+        await update_registration_profile(state, profile_photo=file_path)
+        await safe_send_message(message, translate('media_saved', lang_code), state, reply_markup=types.ReplyKeyboardRemove())
+        await safe_send_message(message, translate('share_location_prompt', lang_code), state, reply_markup=request_location_keyboard(lang_code))
+        await state.set_state(Registration.location)
+    except Exception as e:
+        await safe_send_message(message, translate('media_save_error', lang_code), state)
+        logging.error(f"Ошибка при сохранении медиа: {e}")
 
 # Клавиатура для запроса геолокации
+@cached_keyboard
 def request_location_keyboard(lang_code):
     buttons = [
         [types.KeyboardButton(text=translate('share_location', lang_code), request_location=True)]
@@ -464,40 +365,42 @@ def request_location_keyboard(lang_code):
 @registration_router.message(StateFilter(Registration.location), F.location)
 async def process_location(message: types.Message, state: FSMContext, bot: Bot):
     await safe_send_user_message(message, state)  # Сохранение сообщения с локацией
-    user = await get_user_by_id(message.from_user.id)
-    if user:
-        lang_code = user['lang']
-
-        if message.location:
-            latitude = message.location.latitude
-            longitude = message.location.longitude
+    data = await state.get_data()
+    profile = data.get('profile', {})
+    lang_code = profile.get('lang', 'en')
 
-            await update_user_location(message.from_user.id, f"{latitude}, {longitude}")
-            await safe_send_message(message, translate('location_saved', lang_code), state, reply_markup=types.ReplyKeyboardRemove())
+    if message.location:
+        latitude = message.location.latitude
+        longitude = message.location.longitude
 
-            # После завершения регистрации и локации показываем профиль и удаляем все сообщения
-            await safe_send_message(message, translate('registration_completed', lang_code), state)
-            await show_profile(message, bot)
-            await message.answer("", reply_markup=initial_keyboard())
-            await delete_registration_messages(message, state)  # Удаление сообщений
-            await state.clear()  # Очистка состояния
-        else:
-            await message.answer(translate('location_error', lang_code))
+        # Весь профиль и интересы сохраняются одной транзакцией
+        profile.update(lat=latitude, lon=longitude)
+        if not await save_registration(message.from_user.id, profile, data.get('interests', [])):
+            await ask_nickname_again(message, state, resume_location=True)
+            return
+        await safe_send_message(message, translate('location_saved', lang_code), state, reply_markup=types.ReplyKeyboardRemove())
+
+        # После завершения регистрации и локации показываем профиль и удаляем все сообщения
+        await safe_send_message(message, translate('registration_completed', lang_code), state)
+        await show_profile(message, bot)
+        await message.answer("", reply_markup=initial_keyboard())
+        await delete_registration_messages(message, state)  # Удаление сообщений
+        await state.clear()  # Очистка состояния
+    else:
+        await message.answer(translate('location_error', lang_code))
 
 # Показ профиля
 async def show_profile(message: types.Message, bot: Bot):
     user = await get_user_by_id(message.from_user.id)
     if user:
         user_lang = await get_user_language(message.from_user.id)
-        gender_key = GENDER_MAP.get(user.get('gender', 'Other'), 'gender_other')
-        gender = translate(gender_key, user_lang)
-        orientation_key = ORIENTATION_MAP.get(user.get('orientation', 'Heterosexual'), 'orientation_heterosexual')
-        orientation = translate(orientation_key, user_lang)
+        gender = gender_label(user.get('gender', 'Other'), user_lang)
+        orientation = orientation_label(user.get('orientation', 'Heterosexual'), user_lang)
         nickname = user.get('username', 'N/A')
         interests_list = await get_user_interests(message.from_user.id)
 
         if interests_list:
-            interests_str = ', '.join([translate(interest.lower(), user_lang) for interest in interests_list])
+            interests_str = ', '.join([interest_label(interest, user_lang) for interest in interests_list])
         else:
             interests_str = translate('no_interests', user_lang)
 
@@ -512,13 +415,8 @@ async def show_profile(message: types.Message, bot: Bot):
         media_path = user.get('profile_photo')
         if media_path:
             try:
-                input_file = FSInputFile(media_path)
-                if media_path.endswith('.mp4'):
-                    await bot.send_video(message.chat.id, input_file, caption=profile_info)
-                elif media_path.endswith('.gif'):
-                    await bot.send_animation(message.chat.id, input_file, caption=profile_info)
-                else:
-                    await bot.send_photo(message.chat.id, input_file, caption=profile_info)
+                # Повторный показ профиля идет по file_id, файл загружается только в первый раз
+                await send_profile_media(bot, message.chat.id, media_path, profile_info)
             except Exception as e:
                 await message.answer(f"Ошибка при отправке медиа: {e}")
                 logging.error(f"Media send error: {e}")
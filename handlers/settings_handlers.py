@@ -4,10 +4,14 @@ from aiogram.fsm.state import StatesGroup, State
 from database import (
     get_user_by_id, get_user_interests, update_user_photo, update_user_orientation, update_user_interests, update_search_radius, get_blocked_users, unblock_user
 )
-from handlers.registration_handlers import INTERESTS_MAP, get_interests_keyboard, get_orientation_keyboard, save_profile_photo
+from handlers.registration_handlers import get_interests_keyboard, get_orientation_keyboard
+from interests import interest_key
+import localization
 from localization import translate
+from media_store import release_media, store_media
 from aiogram.filters import StateFilter
-from keyboards import initial_keyboard
+from keyboards import cached_keyboard, initial_keyboard
+from vocabulary import INTERESTS, interest_label, lookup_interest, lookup_orientation
 
 settings_router = Router()
 
@@ -29,6 +33,7 @@ async def settings_menu(message: types.Message, state: FSMContext):
         await message.answer(translate('choose_setting', lang_code), reply_markup=settings_keyboard(lang_code))
 
 # Клавиатура настроек с кнопкой "Вернуться в главное меню"
+@cached_keyboard
 def settings_keyboard(lang_code):
     buttons = [
         [types.KeyboardButton(text='📷 Изменить фото'), types.KeyboardButton(text='🎯 Изменить ориентацию'), types.KeyboardButton(text='📚 Изменить интересы')],
@@ -51,8 +56,13 @@ async def change_photo(message: types.Message, state: FSMContext):
 @settings_router.message(StateFilter(Settings.photo), F.photo)
 async def save_new_photo(message: types.Message, state: FSMContext, bot: Bot):
     user_id = message.from_user.id
-    file_path = await save_profile_photo(bot, message.photo[-1], user_id)
+    user = await get_user_by_id(user_id)
+    photo = message.photo[-1]
+    file_path = await store_media(bot, photo.file_id, photo.file_unique_id, 'photo')
     await update_user_photo(user_id, file_path)
+    # Старое фото удаляется с диска, когда на него больше никто не ссылается
+    if user and user['profile_photo'] and user['profile_photo'] != file_path:
+        await release_media(user['profile_photo'])
     await message.answer("Фото успешно обновлено!", reply_markup=initial_keyboard())
     await state.clear()
 
@@ -68,15 +78,7 @@ async def change_orientation(message: types.Message, state: FSMContext):
 async def set_new_orientation(message: types.Message, state: FSMContext):
     user = await get_user_by_id(message.from_user.id)
     lang_code = user['lang']
-    orientation_map = {
-        translate('orientation_heterosexual', lang_code): 'Heterosexual',
-        translate('orientation_homosexual', lang_code): 'Homosexual',
-        translate('orientation_bisexual', lang_code): 'Bisexual',
-        translate('orientation_pansexual', lang_code): 'Pansexual',
-        translate('orientation_asexual', lang_code): 'Asexual',
-        translate('orientation_lesbian', lang_code): 'Lesbian'
-    }
-    orientation = orientation_map.get(message.text)
+    orientation = lookup_orientation(message.text, lang_code)
     if orientation:
         await update_user_orientation(message.from_user.id, orientation)
         await message.answer("Ориентация обновлена!", reply_markup=initial_keyboard())
@@ -84,76 +86,34 @@ async def set_new_orientation(message: types.Message, state: FSMContext):
     else:
         await message.answer("Неверная ориентация. Попробуйте снова.")
 
-# Пример собственного списка интересов
-CUSTOM_INTERESTS_LIST = {
-    "Music": {"en": "Music", "ru": "Музыка"},
-    "Cinema": {"en": "Cinema", "ru": "Кино"},
-    "Sport": {"en": "Sport", "ru": "Спорт"},
-    "Technology": {"en": "Technology", "ru": "Технологии"},
-    "Travel": {"en": "Travel", "ru": "Путешествия"},
-    "Food": {"en": "Food", "ru": "Еда"},
-    "Fashion": {"en": "Fashion", "ru": "Мода"},
-    "Reading": {"en": "Reading", "ru": "Чтение"},
-    "Programming": {"en": "Programming", "ru": "Программирование"},
-    "Games": {"en": "Games", "ru": "Игры"},
-    "Photography": {"en": "Photography", "ru": "Фотография"},
-    "Dancing": {"en": "Dancing", "ru": "Танцы"},
-    "Yoga": {"en": "Yoga", "ru": "Йога"},
-    "Meditation": {"en": "Meditation", "ru": "Медитация"},
-    "Cooking": {"en": "Cooking", "ru": "Кулинария"},
-    "Crossfit": {"en": "Crossfit", "ru": "Кроссфит"},
-    "Art": {"en": "Art", "ru": "Искусство"},
-    "Drawing": {"en": "Drawing", "ru": "Рисование"},
-    "Playing Music": {"en": "Playing Music", "ru": "Игра на музыкальных инструментах"},
-    "Singing": {"en": "Singing", "ru": "Пение"},
-    "Psychology": {"en": "Psychology", "ru": "Психология"},
-    "Science": {"en": "Science", "ru": "Наука"},
-    "Cars": {"en": "Cars", "ru": "Автомобили"},
-    "Motorcycles": {"en": "Motorcycles", "ru": "Мотоциклы"},
-    "Extreme_Sports": {"en": "Extreme Sports", "ru": "Экстремальные виды спорта"},
-    "Outdoor_Cooking": {"en": "Outdoor Cooking", "ru": "Готовка на открытом воздухе"},
-    "Camping": {"en": "Camping", "ru": "Кемпинг"},
-    "Movies": {"en": "Movies", "ru": "Фильмы"},
-    "BDSM": {"en": "BDSM", "ru": "БДСМ"},
-    "Role_Playing": {"en": "Role-Playing", "ru": "Ролевые игры"},
-    "Foot_Fetish": {"en": "Foot Fetish", "ru": "Фут-фетиш"},
-    "Anal_Sex": {"en": "Anal Sex", "ru": "Анальный секс"},
-    "Group_Sex": {"en": "Group Sex", "ru": "Групповой секс"},
-    "Orgasm_Control": {"en": "Orgasm Control", "ru": "Контроль оргазма"},
-    "Bondage": {"en": "Bondage", "ru": "Бондаж"},
-    "Exhibitionism": {"en": "Exhibitionism", "ru": "Эксгибиционизм"},
-    "Erotic_Humiliation": {"en": "Erotic Humiliation", "ru": "Эротическое унижение"},
-    "Dominance_and_Submission": {"en": "Dominance and Submission", "ru": "Доминирование и подчинение"},
-    "Urophilia": {"en": "Urophilia", "ru": "Урофилия"},
-    "Sadism_Masochism": {"en": "Sadism and Masochism", "ru": "Садизм и мазохизм"},
-    "Wax_play": {"en": "Wax play", "ru": "Игра с воском"},
-    "Quirofilia": {"en": "Quirofilia", "ru": "Кирофилия"},
-    "Electrostimulation": {"en": "Electrostimulation", "ru": "Электростимуляция"}
-
-}
-
-# Таблица интересов
+# Кнопки таблицы интересов по языку: язык -> (версия каталогов переводов, кнопки, кнопка "Готово").
+# Это не клавиатура, поэтому не cached_keyboard; после перезагрузки переводов кнопки строятся заново
+_interests_table_buttons = {}
+
+# Готовые кнопки таблицы интересов для языка: (ключ, кнопка ✅, кнопка ❌) и кнопка "Готово"
+def get_interests_table_buttons(lang_code):
+    cached = _interests_table_buttons.get(lang_code)
+    if cached is not None and cached[0] == localization.catalogs_version:
+        return cached[1], cached[2]
+    buttons = []
+    for key in INTERESTS:
+        interest_name = interest_label(key, lang_code)
+        buttons.append((key, types.KeyboardButton(text=f"✅ {interest_name}"), types.KeyboardButton(text=f"❌ {interest_name}")))
+    done_button = types.KeyboardButton(text=translate('done', lang_code))
+    # Версия читается после построения: первый translate мог загрузить каталоги
+    _interests_table_buttons[lang_code] = (localization.catalogs_version, buttons, done_button)
+    return buttons, done_button
+
+# Таблица интересов: собирается из готовых кнопок, меняется только выбор ✅/❌
 def get_interests_table(user_interests, lang_code):
-    table = []
-    current_row = []
-    for interest_key, translations in CUSTOM_INTERESTS_LIST.items():
-        interest_name = translations.get(lang_code, translations['en'])
-        if interest_key in user_interests:
-            button_text = f"✅ {interest_name}"
-        else:
-            button_text = f"❌ {interest_name}"
-        current_row.append(types.KeyboardButton(text=button_text))
-        
-        if len(current_row) == 3:  # По два интереса в строке
-            table.append(current_row)
-            current_row = []
-    
-    if current_row:
-        table.append(current_row)
-    
+    buttons, done_button = get_interests_table_buttons(lang_code)
+    selected = {interest_key(interest) for interest in user_interests}
+    cells = [checked if key in selected else unchecked for key, checked, unchecked in buttons]
+    table = [cells[i:i + 3] for i in range(0, len(cells), 3)]  # По три интереса в строке
+
     # Кнопка "Готово" внизу
-    table.append([types.KeyboardButton(text=translate('done', lang_code))])
-    
+    table.append([done_button])
+
     return types.ReplyKeyboardMarkup(keyboard=table, resize_keyboard=True)
 
 # Обновление интересов с таблицей
@@ -161,8 +121,10 @@ def get_interests_table(user_interests, lang_code):
 async def change_interests(message: types.Message, state: FSMContext):
     user = await get_user_by_id(message.from_user.id)
     lang_code = user['lang']
-    user_interests = await get_user_interests(message.from_user.id)
-    
+    # Выбор переключается от текущих интересов; в базе могут быть старые английские названия
+    user_interests = [interest_key(interest) or interest for interest in await get_user_interests(message.from_user.id)]
+    await state.update_data(user_interests=user_interests)
+
     await message.answer(translate('choose_interests', lang_code), 
                          reply_markup=get_interests_table(user_interests, lang_code))
     await state.set_state(Settings.interests)
@@ -183,7 +145,7 @@ async def update_interests(message: types.Message, state: FSMContext):
             await state.clear()
     else:
         interest_text = message.text[2:].strip()  # Убираем символы ✅/❌ и пробелы
-        english_interest = next((key for key, value in CUSTOM_INTERESTS_LIST.items() if value.get(lang_code, value['en']) == interest_text), None)
+        english_interest = lookup_interest(interest_text, lang_code)
 
         if english_interest:
             if english_interest in user_interests:
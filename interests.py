@@ -0,0 +1,175 @@
+# Каталог интересов для битовой маски.
+# Номер бита = позиция в списке, поэтому порядок менять нельзя:
+# новые интересы добавляются только в конец (не более 64 для BIGINT UNSIGNED).
+INTEREST_BITS = (
+    ("Music", "Music"),
+    ("Cinema", "Cinema"),
+    ("Sport", "Sport"),
+    ("Technology", "Technology"),
+    ("Travel", "Travel"),
+    ("Food", "Food"),
+    ("Fashion", "Fashion"),
+    ("Reading", "Reading"),
+    ("Programming", "Programming"),
+    ("Games", "Games"),
+    ("Photography", "Photography"),
+    ("Dancing", "Dancing"),
+    ("Yoga", "Yoga"),
+    ("Meditation", "Meditation"),
+    ("Cooking", "Cooking"),
+    ("Crossfit", "Crossfit"),
+    ("Art", "Art"),
+    ("Drawing", "Drawing"),
+    ("Playing Music", "Playing Music"),
+    ("Singing", "Singing"),
+    ("Psychology", "Psychology"),
+    ("Science", "Science"),
+    ("Cars", "Cars"),
+    ("Motorcycles", "Motorcycles"),
+    ("Extreme_Sports", "Extreme Sports"),
+    ("Outdoor_Cooking", "Outdoor Cooking"),
+    ("Camping", "Camping"),
+    ("Movies", "Movies"),
+    ("BDSM", "BDSM"),
+    ("Role_Playing", "Role-Playing"),
+    ("Foot_Fetish", "Foot Fetish"),
+    ("Anal_Sex", "Anal Sex"),
+    ("Group_Sex", "Group Sex"),
+    ("Orgasm_Control", "Orgasm Control"),
+    ("Bondage", "Bondage"),
+    ("Exhibitionism", "Exhibitionism"),
+    ("Erotic_Humiliation", "Erotic Humiliation"),
+    ("Dominance_and_Submission", "Dominance and Submission"),
+    ("Urophilia", "Urophilia"),
+    ("Sadism_Masochism", "Sadism and Masochism"),
+    ("Wax_play", "Wax play"),
+    ("Quirofilia", "Quirofilia"),
+    ("Electrostimulation", "Electrostimulation"),
+)
+
+
+# Названия интересов на других языках; английское - второе поле INTEREST_BITS
+INTEREST_LABELS = {
+    "Music": {"ru": "Музыка", "kz": "Музыка"},
+    "Cinema": {"ru": "Кино", "kz": "Кино"},
+    "Sport": {"ru": "Спорт", "kz": "Спорт"},
+    "Technology": {"ru": "Технологии", "kz": "Технологиялар"},
+    "Travel": {"ru": "Путешествия", "kz": "Саяхат"},
+    "Food": {"ru": "Еда", "kz": "Тамақ"},
+    "Fashion": {"ru": "Мода", "kz": "Сән"},
+    "Reading": {"ru": "Чтение", "kz": "Оқу"},
+    "Programming": {"ru": "Программирование", "kz": "Бағдарламалау"},
+    "Games": {"ru": "Игры", "kz": "Ойындар"},
+    "Photography": {"ru": "Фотография", "kz": "Фотосурет"},
+    "Dancing": {"ru": "Танцы", "kz": "Би"},
+    "Yoga": {"ru": "Йога", "kz": "Йога"},
+    "Meditation": {"ru": "Медитация", "kz": "Медитация"},
+    "Cooking": {"ru": "Кулинария", "kz": "Аспаздық"},
+    "Crossfit": {"ru": "Кроссфит", "kz": "Кроссфит"},
+    "Art": {"ru": "Искусство", "kz": "Өнер"},
+    "Drawing": {"ru": "Рисование", "kz": "Сурет салу"},
+    "Playing Music": {"ru": "Игра на музыкальных инструментах", "kz": "Музыкалық аспаптарда ойнау"},
+    "Singing": {"ru": "Пение", "kz": "Ән айту"},
+    "Psychology": {"ru": "Психология", "kz": "Психология"},
+    "Science": {"ru": "Наука", "kz": "Ғылым"},
+    "Cars": {"ru": "Автомобили", "kz": "Көліктер"},
+    "Motorcycles": {"ru": "Мотоциклы", "kz": "Мотоциклдер"},
+    "Extreme_Sports": {"ru": "Экстремальные виды спорта", "kz": "Экстремалды спорт түрлері"},
+    "Outdoor_Cooking": {"ru": "Готовка на открытом воздухе", "kz": "Ашық аспан астындағы аспаздық"},
+    "Camping": {"ru": "Кемпинг", "kz": "Кемпинг"},
+    "Movies": {"ru": "Фильмы", "kz": "Фильмдер"},
+    "BDSM": {"ru": "БДСМ"},
+    "Role_Playing": {"ru": "Ролевые игры"},
+    "Foot_Fetish": {"ru": "Фут-фетиш"},
+    "Anal_Sex": {"ru": "Анальный секс"},
+    "Group_Sex": {"ru": "Групповой секс"},
+    "Orgasm_Control": {"ru": "Контроль оргазма"},
+    "Bondage": {"ru": "Бондаж"},
+    "Exhibitionism": {"ru": "Эксгибиционизм"},
+    "Erotic_Humiliation": {"ru": "Эротическое унижение"},
+    "Dominance_and_Submission": {"ru": "Доминирование и подчинение"},
+    "Urophilia": {"ru": "Урофилия"},
+    "Sadism_Masochism": {"ru": "Садизм и мазохизм"},
+    "Wax_play": {"ru": "Игра с воском"},
+    "Quirofilia": {"ru": "Кирофилия"},
+    "Electrostimulation": {"ru": "Электростимуляция"},
+}
+
+# Интересы клавиатуры регистрации и ключи их подписей в каталогах переводов (порядок кнопок)
+INTEREST_MESSAGE_KEYS = {
+    "Music": "music",
+    "Cinema": "cinema",
+    "Sport": "sport",
+    "Technology": "technology",
+    "Travel": "travel",
+    "Food": "food",
+    "Fashion": "fashion",
+    "Reading": "reading",
+    "Programming": "programming",
+    "Games": "games",
+    "Photography": "photography",
+    "Dancing": "dancing",
+    "Yoga": "yoga",
+    "Meditation": "meditation",
+    "Cooking": "cooking",
+    "Crossfit": "crossfit",
+    "Art": "art",
+    "Drawing": "drawing",
+    "Playing Music": "music_playing",
+    "Singing": "singing",
+    "Psychology": "psychology",
+    "Science": "science",
+    "Cars": "cars",
+    "Motorcycles": "motorcycles",
+    "Extreme_Sports": "extreme_sports",
+    "Outdoor_Cooking": "outdoor_cooking",
+    "Camping": "camping",
+    "Movies": "movies",
+}
+
+
+# Нормализация названия: регистр, пробелы, дефисы и подчеркивания не важны
+def _normalize(name):
+    return ''.join(ch for ch in name.lower() if ch.isalnum())
+
+
+# Раньше регистрация хранила английские названия, настройки - ключи; оба варианта дают один бит
+_BIT_BY_NAME = {}
+for _bit, (_key, _label) in enumerate(INTEREST_BITS):
+    _BIT_BY_NAME[_normalize(_key)] = _bit
+    _BIT_BY_NAME[_normalize(_label)] = _bit
+
+
+# Номер бита интереса или None, если интереса нет в каталоге
+def interest_bit(name):
+    return _BIT_BY_NAME.get(_normalize(name))
+
+
+# Канонический ключ интереса (как в INTEREST_BITS) или None
+def interest_key(name):
+    bit = interest_bit(name)
+    return None if bit is None else INTEREST_BITS[bit][0]
+
+
+# Маска из списка интересов или строки "Music, Cinema"
+def interests_to_mask(interests):
+    if not interests:
+        return 0
+    if isinstance(interests, str):
+        interests = interests.split(',')
+    mask = 0
+    for interest in interests:
+        bit = interest_bit(interest.strip())
+        if bit is not None:
+            mask |= 1 << bit
+    return mask
+
+
+# Ключи интересов, закодированных в маске
+def mask_to_interests(mask):
+    return [key for bit, (key, _) in enumerate(INTEREST_BITS) if mask >> bit & 1]
+
+
+# Количество общих интересов (popcount от AND масок)
+def common_interests_count(mask_a, mask_b):
+    return (mask_a & mask_b).bit_count()
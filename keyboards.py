@@ -1,7 +1,30 @@
+import functools
+
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
+import localization
 from localization import set_language, translate
 
+_keyboards = {}  # (функция, аргументы) -> (версия каталогов переводов, готовая клавиатура)
+
+
+# Клавиатура строится один раз на набор аргументов (язык, пол) и дальше отдается общим экземпляром.
+# Экземпляры общие для всех апдейтов - изменять их нельзя; после перезагрузки переводов строятся заново
+def cached_keyboard(builder):
+    @functools.wraps(builder)
+    def wrapper(*args):
+        key = (builder.__module__, builder.__qualname__, args)
+        cached = _keyboards.get(key)
+        if cached is not None and cached[0] == localization.catalogs_version:
+            return cached[1]
+        keyboard = builder(*args)
+        # Версия читается после построения: первый translate мог загрузить каталоги
+        _keyboards[key] = (localization.catalogs_version, keyboard)
+        return keyboard
+    return wrapper
+
+
 # Первоначальная клавиатура (когда поиск еще не начат)
+@cached_keyboard
 def initial_keyboard():
     keyboard = [
         [KeyboardButton(text='🔍 Поиск'), KeyboardButton(text='📜 История'), KeyboardButton(text='👤 Показать профиль'), KeyboardButton(text='⚙️ Настройки')]
@@ -9,6 +32,7 @@ def initial_keyboard():
     return ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
 
 # Клавиатура во время поиска
+@cached_keyboard
 def search_keyboard():
     keyboard = [
         [KeyboardButton(text='🚪 Покинуть поиск')]
@@ -16,6 +40,7 @@ def search_keyboard():
     return ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
 
 # Клавиатура при нахождении совпадения
+@cached_keyboard
 def match_keyboard():
     keyboard = [
         [KeyboardButton(text='❌ Выйти из чата'), KeyboardButton(text='🚫 Заблокировать')]
@@ -1,21 +1,78 @@
-from babel.support import Translations
+from babel.support import NullTranslations, Translations
+import asyncio
 import os
 import logging
 # Путь к локалям
 LOCALES_DIR = os.path.join(os.path.dirname(__file__), 'locale')
+# Язык, в который уходят ключи, отсутствующие в каталоге пользователя
+DEFAULT_LANG = 'en'
+# Интервал проверки .mo файлов на изменения (сек), 0 - без горячей перезагрузки
+LOCALES_RELOAD_INTERVAL = float(os.getenv('LOCALES_RELOAD_INTERVAL', 0))
 
-# Функция для загрузки переводов по языковому коду
+# Каталоги всех языков из locale/, загружаются один раз; перевод берется из памяти
+_catalogs = {}  # lang_code -> Translations
+_mtimes = {}  # lang_code -> mtime файла messages.mo
+# Растет при каждой загрузке каталогов; по нему сбрасываются кэши переведенных клавиатур
+catalogs_version = 0
+
+
+def _mo_path(lang_code):
+    return os.path.join(LOCALES_DIR, lang_code, 'LC_MESSAGES', 'messages.mo')
+
+
+def _mo_mtimes():
+    return {
+        lang_code: os.path.getmtime(_mo_path(lang_code))
+        for lang_code in sorted(os.listdir(LOCALES_DIR)) if os.path.isfile(_mo_path(lang_code))
+    }
+
+
+# Загрузка (или перезагрузка) всех каталогов; реестр подменяется целиком
+def load_catalogs():
+    global _catalogs, _mtimes, catalogs_version
+    mtimes = _mo_mtimes()
+    catalogs = {}
+    for lang_code in mtimes:
+        with open(_mo_path(lang_code), 'rb') as file:
+            catalogs[lang_code] = Translations(file)
+    default = catalogs.get(DEFAULT_LANG)
+    if default is not None:
+        for lang_code, catalog in catalogs.items():
+            if lang_code != DEFAULT_LANG:
+                catalog.add_fallback(default)
+    _catalogs, _mtimes = catalogs, mtimes
+    catalogs_version += 1
+    logging.info(f"Загружены каталоги переводов: {', '.join(catalogs) or 'нет'}")
+    return catalogs
+
+
+# Перезагрузка, если какой-то .mo файл добавили, удалили или изменили
+def reload_changed_catalogs():
+    if _mo_mtimes() == _mtimes:
+        return False
+    load_catalogs()
+    return True
+
+
+async def watch_catalogs(interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            reload_changed_catalogs()
+        except Exception as e:
+            logging.error(f"Ошибка перезагрузки каталогов переводов: {e}")
+
+
+# Каталог по языковому коду; неизвестный язык получает английский
 def get_translations(lang_code):
-    try:
-        translations = Translations.load(LOCALES_DIR, [lang_code])
-        return translations
-    except FileNotFoundError:
-        return Translations.load(LOCALES_DIR, ['en'])
+    if not _catalogs:
+        load_catalogs()
+    catalog = _catalogs.get(lang_code) or _catalogs.get(DEFAULT_LANG)
+    return catalog if catalog is not None else NullTranslations()
 
 
 def translate(message_key, lang_code):
-    translations = get_translations(lang_code)
-    return translations.gettext(message_key)
+    return get_translations(lang_code).gettext(message_key)
 
 
 # Функция для создания клавиатуры выбора языка
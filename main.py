@@ -6,7 +6,7 @@ from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.client.bot import DefaultBotProperties
 from aiogram.fsm.storage.memory import MemoryStorage
 from dotenv import load_dotenv
-from database import check_db_connection, init_db, close_db  # Импорт функций работы с базой данных
+from database import ACTIVE_CHATS_CHECK_INTERVAL, ACTIVE_CHATS_SYNC_INTERVAL, DB_POOL_STATS_INTERVAL, MATCH_MODE, WAITING_INDEX_REFRESH_INTERVAL, check_db_connection, init_db, close_db, load_active_chats, load_waiting_index, log_pool_stats, run_active_chats_check, run_active_chats_sync, run_waiting_index_refresh, prewarm_pool, run_migrations, start_message_writer, verify_indexes  # Импорт функций работы с базой данных
 from handlers.user_handlers import user_router
 from handlers.admin_handlers import admin_router
 from handlers.operator_handlers import operator_router
@@ -15,6 +15,11 @@ from handlers.registration_handlers import registration_router
 from handlers.history_handlers import history_router
 from handlers.matchmaking_handlers import matchmaking_router
 from handlers.settings_handlers import settings_router
+from matcher import run_matcher
+from media_archive import run_media_archive
+from media_store import MEDIA_STORE_STATS_INTERVAL, log_media_store_stats
+from outbound import OUTBOUND_STATS_INTERVAL, log_outbound_stats, outbound_scheduler
+from localization import LOCALES_RELOAD_INTERVAL, load_catalogs, watch_catalogs
 
 # Настройка логирования
 logging.basicConfig(
@@ -30,6 +35,8 @@ API_TOKEN = os.getenv('BOT_TOKEN')
 
 # Создание бота и диспетчера
 bot = Bot(token=API_TOKEN, session=AiohttpSession(), default=DefaultBotProperties(parse_mode='HTML'))
+# Все отправки идут через планировщик с лимитами Telegram и повтором после RetryAfter
+bot.session.middleware(outbound_scheduler)
 dp = Dispatcher(storage=MemoryStorage())
 
 # Подключение маршрутизаторов (routers)
@@ -70,8 +77,65 @@ async def main():
         # Добавьте логирование состояния db
         logging.info(f"Current db state: {db}")
 
+        # Соединения пула открываются до первых апдейтов
+        await prewarm_pool()
+
+        # Миграции схемы и проверка индексов горячих запросов; без индексов бот не запускается
+        await run_migrations()
+        await verify_indexes()
+
+        # Каталоги переводов читаются с диска один раз
+        load_catalogs()
+
+        # Загрузка списка ожидания в индекс поиска
+        await load_waiting_index()
+
+        # Карта маршрутов активных чатов для пересылки сообщений без запросов к базе
+        await load_active_chats()
+
+        # Отложенная запись сообщений чата; буфер дописывается в close_db
+        start_message_writer()
+
+        # Фоновый подбор пар из списка ожидания
+        background_tasks = [asyncio.create_task(run_matcher(bot))]
+
+        # Фоновое скачивание пересланных медиа в архив
+        background_tasks.append(asyncio.create_task(run_media_archive(bot)))
+
+        # Метрики пула соединений в лог
+        if DB_POOL_STATS_INTERVAL > 0:
+            background_tasks.append(asyncio.create_task(log_pool_stats(DB_POOL_STATS_INTERVAL)))
+
+        # Метрики очереди отправки в лог
+        if OUTBOUND_STATS_INTERVAL > 0:
+            background_tasks.append(asyncio.create_task(log_outbound_stats(OUTBOUND_STATS_INTERVAL)))
+
+        # Метрики хранилища медиа: экономия от дедупликации, скачивания и загрузки
+        if MEDIA_STORE_STATS_INTERVAL > 0:
+            background_tasks.append(asyncio.create_task(log_media_store_stats(MEDIA_STORE_STATS_INTERVAL)))
+
+        # Горячая перезагрузка переводов при изменении .mo файлов
+        if LOCALES_RELOAD_INTERVAL > 0:
+            background_tasks.append(asyncio.create_task(watch_catalogs(LOCALES_RELOAD_INTERVAL)))
+
+        # Догрузка очереди, которую меняют другие процессы бота
+        if MATCH_MODE == 'index' and WAITING_INDEX_REFRESH_INTERVAL > 0:
+            background_tasks.append(asyncio.create_task(run_waiting_index_refresh(WAITING_INDEX_REFRESH_INTERVAL)))
+
+        # Снятие маршрутов чатов, завершенных в других процессах
+        if ACTIVE_CHATS_SYNC_INTERVAL > 0:
+            background_tasks.append(asyncio.create_task(run_active_chats_sync(ACTIVE_CHATS_SYNC_INTERVAL)))
+
+        # Сверка карты активных чатов с таблицей
+        if ACTIVE_CHATS_CHECK_INTERVAL > 0:
+            background_tasks.append(asyncio.create_task(run_active_chats_check(ACTIVE_CHATS_CHECK_INTERVAL)))
+
         # Запуск polling
-        await dp.start_polling(bot)
+        try:
+            await dp.start_polling(bot)
+        finally:
+            for task in background_tasks:
+                task.cancel()
     except Exception as e:
         logging.error(f"An error occurred: {e}")
     finally:
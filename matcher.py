@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+from aiogram import Bot
+
+from database import MATCH_MODE, get_user_by_id
+from handlers.matchmaking_handlers import claim_best_match, notify_match
+from matchmaking_index import waiting_index
+
+# Интервал между раундами подбора (сек) и максимум пар за раунд
+MATCHER_INTERVAL = float(os.getenv('MATCHER_INTERVAL', 3))
+MATCHER_BATCH_SIZE = int(os.getenv('MATCHER_BATCH_SIZE', 500))
+# В режиме sql каждый поиск - отдельный MATCH_QUERY, поэтому за раунд ищем не больше стольких пользователей
+MATCHER_SQL_SEARCHES = int(os.getenv('MATCHER_SQL_SEARCHES', 50))
+# Интервал вывода метрик подбора в лог (сек), независимо от числа пар
+MATCHER_STATS_INTERVAL = float(os.getenv('MATCHER_STATS_INTERVAL', 60))
+
+# Метрики фонового подбора
+matcher_metrics = {
+    'rounds': 0,
+    'pairs': 0,
+    'queue_length': 0,
+    'oldest_wait': 0.0,
+    'last_round_ms': 0.0,
+}
+# Время ожидания (сек) последних подобранных пользователей
+wait_times = deque(maxlen=1000)
+# Время постановки в очередь последнего просмотренного в режиме sql; следующий раунд продолжает после него
+_last_searched_at = 0.0
+
+
+def _percentile(values, percent):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+# Снимок метрик: длина очереди, время ожидания, пары
+def matcher_stats():
+    stats = dict(matcher_metrics)
+    stats['wait_p50'] = _percentile(wait_times, 50)
+    stats['wait_p95'] = _percentile(wait_times, 95)
+    return stats
+
+
+# Один раунд: проходим очередь от самых давно ждущих и подбираем им пару
+async def run_matching_round(bot: Bot):
+    global _last_searched_at
+    started = time.perf_counter()
+    now = time.time()
+    queue = sorted(waiting_index.entries(), key=lambda entry: entry['queued_at'])
+    matcher_metrics['queue_length'] = len(queue)
+    matcher_metrics['oldest_wait'] = now - queue[0]['queued_at'] if queue else 0.0
+    queued = {entry['user_id']: entry for entry in queue}
+
+    searches_left = None
+    if MATCH_MODE == 'sql':
+        # Очередь обходим по кругу, чтобы неподобранные старые заявки не забирали весь лимит каждый раунд
+        searches_left = MATCHER_SQL_SEARCHES
+        split = next((i for i, entry in enumerate(queue) if entry['queued_at'] > _last_searched_at), len(queue))
+        queue = queue[split:] + queue[:split]
+
+    pairs = 0
+    for entry in queue:
+        if pairs >= MATCHER_BATCH_SIZE:
+            break
+        if searches_left is not None:
+            if searches_left <= 0:
+                break
+            searches_left -= 1
+            _last_searched_at = entry['queued_at']
+        user_id = entry['user_id']
+        # Пользователь мог быть уже подобран в этом раунде
+        if user_id not in waiting_index:
+            continue
+
+        # Захват атомарный, поэтому подбор безопасен рядом с кнопкой поиска и другими процессами
+        match_user_id, _ = await claim_best_match(
+            user_id, entry['gender'], entry['orientation'], entry['interests'], entry['lat'], entry['lon']
+        )
+        if not match_user_id:
+            continue
+
+        pairs += 1
+        wait_times.append(now - entry['queued_at'])
+        match_entry = queued.get(match_user_id)
+        if match_entry:
+            wait_times.append(now - match_entry['queued_at'])
+
+        # Ошибка уведомления одной пары не должна оставлять без уведомления остальные пары раунда
+        try:
+            user = await get_user_by_id(user_id)
+            match_user = await get_user_by_id(match_user_id)
+            if user and match_user:
+                await notify_match(bot, user, match_user)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Фоновый подбор: не удалось уведомить пару {user_id} и {match_user_id}: {e}")
+
+    matcher_metrics['rounds'] += 1
+    matcher_metrics['pairs'] += pairs
+    matcher_metrics['last_round_ms'] = (time.perf_counter() - started) * 1000
+    return pairs
+
+
+# Бесконечный цикл подбора, запускается из main.main
+async def run_matcher(bot: Bot):
+    logging.info(f"Фоновый подбор запущен, интервал {MATCHER_INTERVAL} с")
+    stats_logged_at = time.monotonic()
+    while True:
+        try:
+            await run_matching_round(bot)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Ошибка в раунде фонового подбора: {e}")
+        if MATCHER_STATS_INTERVAL > 0 and time.monotonic() - stats_logged_at >= MATCHER_STATS_INTERVAL:
+            stats_logged_at = time.monotonic()
+            logging.info(f"Метрики фонового подбора: {matcher_stats()}")
+        await asyncio.sleep(MATCHER_INTERVAL)
@@ -0,0 +1,133 @@
+import heapq
+import math
+
+import numpy as np
+
+from interests import common_interests_count
+from utils import bounding_box, bounding_box_mask, calculate_distances
+
+# Размер ячейки сетки в градусах (~11 км по широте)
+CELL_SIZE_DEG = 0.1
+
+
+# Индекс кандидатов из списка ожидания, разбитых по ячейкам сетки широта/долгота
+class WaitingIndex:
+    def __init__(self, cell_size=CELL_SIZE_DEG):
+        self.cell_size = cell_size
+        self.columns = int(round(360 / cell_size))
+        self._cells = {}  # (row, col) -> {user_id: entry}
+        self._entries = {}  # user_id -> (row, col)
+        # Сколько поисков выполнено и сколько кандидатов просмотрено в ячейках
+        self.stats = {'searches': 0, 'scanned': 0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, user_id):
+        return user_id in self._entries
+
+    def _cell(self, lat, lon):
+        row = math.floor(lat / self.cell_size)
+        col = math.floor(lon / self.cell_size) % self.columns
+        return row, col
+
+    # Добавление (или перемещение) кандидата в индексе
+    def add(self, entry):
+        user_id = entry['user_id']
+        self.remove(user_id)
+        cell = self._cell(entry['lat'], entry['lon'])
+        self._cells.setdefault(cell, {})[user_id] = entry
+        self._entries[user_id] = cell
+
+    def remove(self, user_id):
+        cell = self._entries.pop(user_id, None)
+        if cell is None:
+            return None
+        bucket = self._cells[cell]
+        entry = bucket.pop(user_id)
+        if not bucket:
+            del self._cells[cell]
+        return entry
+
+    def get(self, user_id):
+        cell = self._entries.get(user_id)
+        if cell is None:
+            return None
+        return self._cells[cell][user_id]
+
+    def user_ids(self):
+        return list(self._entries)
+
+    # Все кандидаты индекса
+    def entries(self):
+        return [entry for bucket in self._cells.values() for entry in bucket.values()]
+
+    def clear(self):
+        self._cells.clear()
+        self._entries.clear()
+
+    # Ячейки, которые пересекаются с кругом радиуса radius_km вокруг точки
+    def _cells_in_radius(self, lat, lon, radius_km):
+        lat_lo, lat_hi, lon_lo, lon_hi = bounding_box(lat, lon, radius_km)
+        row_lo = math.floor(lat_lo / self.cell_size)
+        row_hi = math.floor(lat_hi / self.cell_size)
+
+        if lon_hi - lon_lo >= 360.0:
+            cols = None  # Радиус охватывает весь круг широты
+            col_count = self.columns
+        else:
+            col_lo = math.floor(lon_lo / self.cell_size)
+            col_hi = math.floor(lon_hi / self.cell_size)
+            cols = {col % self.columns for col in range(col_lo, col_hi + 1)}
+            col_count = len(cols)
+
+        rows = range(row_lo, row_hi + 1)
+        # Если ячеек в круге больше, чем занятых, проще пройти по занятым
+        if len(rows) * col_count > len(self._cells):
+            return [
+                cell for cell in self._cells
+                if row_lo <= cell[0] <= row_hi and (cols is None or cell[1] in cols)
+            ]
+        return [(row, col) for row in rows for col in cols] if cols is not None else [
+            (row, col) for row in rows for col in range(self.columns)
+        ]
+
+    # Кандидаты в радиусе radius_km: список пар (entry, distance)
+    def nearby(self, lat, lon, radius_km):
+        candidates = []
+        for cell in self._cells_in_radius(lat, lon, radius_km):
+            bucket = self._cells.get(cell)
+            if bucket:
+                candidates.extend(bucket.values())
+        self.stats['searches'] += 1
+        self.stats['scanned'] += len(candidates)
+        if not candidates:
+            return []
+
+        # Отсекаем прямоугольником, затем считаем расстояния одним пакетом
+        coords = np.array([(entry['lat'], entry['lon']) for entry in candidates], dtype=np.float64)
+        selected = np.flatnonzero(bounding_box_mask(lat, lon, radius_km, coords))
+        distances = calculate_distances(lat, lon, coords[selected])
+        return [
+            (candidates[i], float(distance))
+            for i, distance in zip(selected, distances)
+            if distance <= radius_km
+        ]
+
+    # Лучшие limit кандидатов в радиусе: больше общих интересов, затем ближе.
+    # Результат - список (entry, common_interests, distance)
+    def rank(self, user_id, lat, lon, radius_km, interests_mask, search_gender=None, exclusions=(), limit=1):
+        ranked = []
+        for entry, distance in self.nearby(lat, lon, radius_km):
+            candidate_id = entry['user_id']
+            if candidate_id == user_id or candidate_id in exclusions:
+                continue
+            if search_gender and entry['gender'] != search_gender:
+                continue
+            common = common_interests_count(interests_mask, entry['interests_mask'])
+            ranked.append((-common, distance, candidate_id, entry))
+        return [(entry, -neg_common, distance) for neg_common, distance, _, entry in heapq.nsmallest(limit, ranked)]
+
+
+# Индекс текущего процесса, синхронизируется с таблицей waiting_list
+waiting_index = WaitingIndex()
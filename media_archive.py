@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import os
+
+from aiogram import Bot
+
+from database import add_media_job, complete_media_job, fail_media_job, lease_media_jobs, save_chat_message_to_db
+from media_store import store_media
+
+# Параллельные скачивания, попытки и задержка повтора (сек, удваивается с каждой попыткой)
+MEDIA_WORKERS = int(os.getenv('MEDIA_WORKERS', 4))
+MEDIA_MAX_ATTEMPTS = int(os.getenv('MEDIA_MAX_ATTEMPTS', 5))
+MEDIA_RETRY_DELAY = int(os.getenv('MEDIA_RETRY_DELAY', 30))
+# Как часто забирать из media_jobs отложенные и оставшиеся после перезапуска задания
+MEDIA_POLL_INTERVAL = float(os.getenv('MEDIA_POLL_INTERVAL', 10))
+MEDIA_QUEUE_SIZE = int(os.getenv('MEDIA_QUEUE_SIZE', 1000))
+# Аренда задания (сек): столько задание принадлежит взявшему его процессу, потом его может забрать другой
+MEDIA_JOB_LEASE = int(os.getenv('MEDIA_JOB_LEASE', 600))
+
+media_metrics = {'queued': 0, 'downloaded': 0, 'linked': 0, 'retried': 0, 'failed': 0}
+
+_jobs = None  # Очередь заданий для воркеров, создается в run_media_archive
+_in_flight = set()  # id заданий в очереди или в работе
+
+
+# Архивирование пересланного медиа: сообщение пишется сразу с file_id,
+# скачивание ставится в постоянную очередь и не задерживает пересылку
+async def archive_media(sender_id, receiver_id, message_id, file_id, file_unique_id, file_type):
+    await save_chat_message_to_db(sender_id, receiver_id, message_id, None, file_type, file_id=file_id)
+    job = await add_media_job(sender_id, receiver_id, message_id, file_id, file_unique_id, file_type, MEDIA_JOB_LEASE)
+    media_metrics['queued'] += 1
+    _submit(job)
+
+
+def _submit(job):
+    if _jobs is None or job['id'] in _in_flight:
+        return
+    try:
+        _jobs.put_nowait(job)
+    except asyncio.QueueFull:
+        return  # Задание останется в media_jobs, его заберет опрос после истечения аренды
+    _in_flight.add(job['id'])
+
+
+async def _process(bot: Bot, job):
+    try:
+        local_path = job['local_path']
+        if not local_path:
+            # Повторяющиеся стикеры и GIF хранилище не скачивает второй раз
+            local_path = await store_media(
+                bot, job['file_id'], job['file_unique_id'] or job['file_id'], job['type'], job_id=job['id']
+            )
+            media_metrics['downloaded'] += 1
+    except Exception as e:
+        delay = MEDIA_RETRY_DELAY * 2 ** job['attempts']
+        status = await fail_media_job(job, e, delay, MEDIA_MAX_ATTEMPTS)
+        media_metrics['failed' if status == 'failed' else 'retried'] += 1
+        logging.warning(f"Не удалось скачать медиа {job['file_id']} (задание {job['id']}, {status}): {e}")
+        return
+
+    if await complete_media_job(job, local_path, MEDIA_RETRY_DELAY, MEDIA_MAX_ATTEMPTS):
+        media_metrics['linked'] += 1
+
+
+async def _worker(bot: Bot):
+    while True:
+        job = await _jobs.get()
+        try:
+            await _process(bot, job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Ошибка обработки задания архивирования {job['id']}: {e}")
+        finally:
+            _in_flight.discard(job['id'])
+
+
+# Воркеры скачивания и опрос media_jobs; запускается из main.main
+async def run_media_archive(bot: Bot):
+    global _jobs
+    _jobs = asyncio.Queue(maxsize=MEDIA_QUEUE_SIZE)
+    workers = [asyncio.create_task(_worker(bot)) for _ in range(MEDIA_WORKERS)]
+    logging.info(f"Архивирование медиа запущено: {MEDIA_WORKERS} воркеров")
+    try:
+        while True:
+            try:
+                # Берем не больше, чем есть места в очереди: арендованное задание должно попасть к воркеру
+                free = MEDIA_QUEUE_SIZE - _jobs.qsize()
+                if free > 0:
+                    for job in await lease_media_jobs(free, MEDIA_JOB_LEASE):
+                        _submit(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Ошибка опроса очереди архивирования: {e}")
+            await asyncio.sleep(MEDIA_POLL_INTERVAL)
+    finally:
+        for worker in workers:
+            worker.cancel()
@@ -0,0 +1,212 @@
+import asyncio
+import hashlib
+import logging
+import os
+import uuid
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile
+
+from database import (
+    add_media_reference, delete_media_file_id, get_media_by_unique_id, get_media_file_id,
+    get_media_store_totals, release_media_reference, set_media_file_id
+)
+from utils import LRUCache
+
+# Корень хранилища: файлы лежат в media_files/ab/cd/<sha256>.<ext>
+MEDIA_STORE_PATH = os.getenv('MEDIA_STORE_PATH', 'media_files/')
+_TMP_PATH = os.path.join(MEDIA_STORE_PATH, 'tmp')
+os.makedirs(_TMP_PATH, exist_ok=True)
+
+# Расширение файла по типу медиа
+MEDIA_EXTENSIONS = {
+    'photo': 'jpg',
+    'video': 'mp4',
+    'audio': 'mp3',
+    'voice': 'ogg',  # Голосовые сохраняем как .ogg
+    'animation': 'gif',
+    'video_note': 'mp4',
+}
+
+HASH_CHUNK_SIZE = 1 << 20
+
+# Интервал вывода метрик хранилища в лог (сек); 0 - не выводить
+MEDIA_STORE_STATS_INTERVAL = int(os.getenv('MEDIA_STORE_STATS_INTERVAL', 300))
+
+# Сколько раз файл нашелся без скачивания: по file_unique_id или по совпадению содержимого;
+# сколько отправок обошлись file_id без загрузки файла и сколько файлов пришлось загрузить
+store_metrics = {
+    'unique_id_hits': 0, 'content_hits': 0, 'downloads': 0, 'downloaded_bytes': 0,
+    'file_id_sends': 0, 'uploads': 0, 'uploaded_bytes': 0,
+}
+
+# file_id Telegram по локальному пути; копия таблицы media_file_ids в памяти
+FILE_ID_CACHE_SIZE = int(os.getenv('FILE_ID_CACHE_SIZE', 10000))
+file_id_cache = LRUCache(maxsize=FILE_ID_CACHE_SIZE)
+
+
+def media_path(sha256, extension):
+    return os.path.join(MEDIA_STORE_PATH, sha256[:2], sha256[2:4], f"{sha256}.{extension}")
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest(), os.path.getsize(path)
+
+
+# Сохранение медиа Telegram в хранилище; возвращает путь к файлу.
+# Уже известный file_unique_id не скачивается повторно, одинаковое содержимое хранится одним файлом.
+# Наличие файла проверяется в транзакции добавления ссылки, под блокировкой строки блоба.
+# С job_id ссылка принадлежит заданию архивирования и при повторе задания не добавляется второй раз
+async def store_media(bot: Bot, file_id, file_unique_id, file_type, job_id=None):
+    blob = await get_media_by_unique_id(file_unique_id) if file_unique_id else None
+    if blob:
+        path = await add_media_reference(
+            blob['sha256'], blob['path'], blob['size'], place_file=os.path.exists, job_id=job_id
+        )
+        if path:
+            await remember_file_id(path, file_id)
+            store_metrics['unique_id_hits'] += 1
+            return path
+
+    file_info = await bot.get_file(file_id)
+    tmp_path = os.path.join(_TMP_PATH, f"{uuid.uuid4().hex}.part")
+    try:
+        await bot.download_file(file_info.file_path, tmp_path)
+        # Хэш большого видео считается в потоке, чтобы не останавливать цикл событий
+        sha256, size = await asyncio.to_thread(_hash_file, tmp_path)
+        store_metrics['downloads'] += 1
+        store_metrics['downloaded_bytes'] += size
+
+        extension = MEDIA_EXTENSIONS.get(file_type) or os.path.splitext(file_info.file_path)[1].lstrip('.') or 'bin'
+
+        placed = []
+
+        # Файл с тем же содержимым уже лежит в хранилище - скачанная копия не нужна
+        def place_file(stored_path):
+            if os.path.exists(stored_path):
+                store_metrics['content_hits'] += 1
+            else:
+                os.makedirs(os.path.dirname(stored_path), exist_ok=True)
+                os.replace(tmp_path, stored_path)
+                placed.append(stored_path)
+            return True
+
+        try:
+            path = await add_media_reference(sha256, media_path(sha256, extension), size, file_unique_id, place_file, job_id)
+        except Exception:
+            # Транзакция откатилась - положенный файл остался бы на диске без строки в media_blobs
+            for stored_path in placed:
+                _remove_file(stored_path)
+            raise
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    # Файл пришел из Telegram, значит повторно его можно отправлять по file_id
+    await remember_file_id(path, file_id)
+    return path
+
+
+# Запомнить file_id, под которым Telegram уже хранит локальный файл
+async def remember_file_id(path, file_id):
+    if not path or not file_id or file_id_cache.peek(path) == file_id:
+        return
+    file_id_cache.set(path, file_id)
+    await set_media_file_id(path, file_id)
+
+
+async def forget_file_id(path):
+    file_id_cache.pop(path)
+    await delete_media_file_id(path)
+
+
+async def cached_file_id(path):
+    if not path:
+        return None
+    file_id = file_id_cache.get(path)
+    if file_id is None:
+        file_id = await get_media_file_id(path)
+        if file_id:
+            file_id_cache.set(path, file_id)
+    return file_id
+
+
+# file_id из отправленного сообщения (у фото - самый большой размер)
+def sent_file_id(message, media_type):
+    if media_type == 'photo':
+        return message.photo[-1].file_id if message.photo else None
+    media = getattr(message, media_type, None)
+    return media.file_id if media else None
+
+
+# Отправка локального файла: по известному file_id без передачи байтов, иначе загрузка файла
+# с запоминанием полученного file_id. send(media) - корутина отправки, например
+# lambda media: bot.send_photo(chat_id, media, caption=caption)
+async def send_media(send, path, media_type, file_id=None):
+    file_id = file_id or await cached_file_id(path)
+    if file_id:
+        try:
+            message = await send(file_id)
+            store_metrics['file_id_sends'] += 1
+            return message
+        except TelegramBadRequest as e:
+            if not path or not os.path.exists(path):
+                raise
+            # file_id больше не принимается - загружаем файл заново
+            logging.warning(f"file_id для {path} не принят, файл будет загружен: {e}")
+            await forget_file_id(path)
+
+    message = await send(FSInputFile(path))
+    store_metrics['uploads'] += 1
+    store_metrics['uploaded_bytes'] += os.path.getsize(path)
+    await remember_file_id(path, sent_file_id(message, media_type))
+    return message
+
+
+# Медиа профиля: тип по расширению файла (видео, GIF или фото)
+async def send_profile_media(bot: Bot, chat_id, path, caption):
+    if path.endswith('.mp4'):
+        return await send_media(lambda media: bot.send_video(chat_id, media, caption=caption), path, 'video')
+    if path.endswith('.gif'):
+        return await send_media(lambda media: bot.send_animation(chat_id, media, caption=caption), path, 'animation')
+    return await send_media(lambda media: bot.send_photo(chat_id, media, caption=caption), path, 'photo')
+
+
+# Снятие ссылки (например, при смене фото профиля); файл удаляется, когда ссылок не осталось.
+# Пути вне хранилища (старые photos/ и media_files/) не трогаются
+async def release_media(path):
+    if not path:
+        return
+    remaining = await release_media_reference(path, remove_file=_remove_file)
+    if remaining == 0:
+        await forget_file_id(path)
+        logging.info(f"Удален файл без ссылок: {path}")
+
+
+def _remove_file(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+# Экономия диска от дедупликации и счетчики процесса
+async def media_store_stats():
+    stats = await get_media_store_totals()
+    stats.update(store_metrics)
+    return stats
+
+
+# Периодический вывод метрик хранилища в лог, запускается из main.main
+async def log_media_store_stats(interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            logging.info(f"Метрики хранилища медиа: {await media_store_stats()}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Не удалось получить метрики хранилища медиа: {e}")
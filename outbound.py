@@ -0,0 +1,206 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+from utils import Histogram
+
+# Лимиты Telegram: около 30 сообщений в секунду на бота и около одного в секунду в чат
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', 25))
+OUTBOUND_GLOBAL_BURST = int(os.getenv('OUTBOUND_GLOBAL_BURST', 25))
+OUTBOUND_CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', 1))
+OUTBOUND_CHAT_BURST = int(os.getenv('OUTBOUND_CHAT_BURST', 3))
+# Сколько корзин чатов держать, прежде чем выбросить простаивающие
+OUTBOUND_CHAT_BUCKETS_MAX = int(os.getenv('OUTBOUND_CHAT_BUCKETS_MAX', 10000))
+# Сколько раз повторять отправку после TelegramRetryAfter
+OUTBOUND_MAX_RETRIES = int(os.getenv('OUTBOUND_MAX_RETRIES', 3))
+# Интервал вывода метрик отправки в лог (сек), 0 - не выводить
+OUTBOUND_STATS_INTERVAL = int(os.getenv('OUTBOUND_STATS_INTERVAL', 300))
+
+# Классы приоритета: меньше - раньше
+PRIORITY_LIVE = 0  # Пересылка сообщений собеседнику
+PRIORITY_NORMAL = 1  # Ответы пользователю и уведомления о паре
+PRIORITY_BULK = 2  # Повтор истории и рассылки
+PRIORITY_NAMES = {PRIORITY_LIVE: 'live', PRIORITY_NORMAL: 'normal', PRIORITY_BULK: 'bulk'}
+
+# Методы, которые пишут в чат и попадают под лимиты
+THROTTLED_METHODS = {
+    'sendMessage', 'sendPhoto', 'sendVideo', 'sendAudio', 'sendVoice', 'sendAnimation', 'sendVideoNote',
+    'sendDocument', 'sendSticker', 'sendMediaGroup', 'sendLocation', 'sendContact', 'sendPoll', 'sendDice',
+    'forwardMessage', 'forwardMessages', 'copyMessage', 'copyMessages',
+}
+
+_priority = contextvars.ContextVar('outbound_priority', default=PRIORITY_NORMAL)
+
+
+# Приоритет отправок внутри блока; вне блока действует PRIORITY_NORMAL
+@contextmanager
+def send_priority(level):
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+# Приоритет до конца обработки текущего апдейта (каждый апдейт обрабатывается в своей задаче)
+def set_send_priority(level):
+    _priority.set(level)
+
+
+# Корзина токенов с очередью ожидающих по приоритету, внутри приоритета - по порядку прихода
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._waiters = []  # (priority, seq, future)
+        self._seq = itertools.count()
+        self._timer = None
+
+    def __len__(self):
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    def _refill(self):
+        now = time.monotonic()
+        # updated в будущем - корзина на паузе после retry_after
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    # Свободна ли корзина полностью; такие корзины чатов можно выбросить
+    def idle(self):
+        self._refill()
+        return not self._waiters and self.tokens >= self.burst
+
+    async def acquire(self, priority=PRIORITY_NORMAL):
+        self._refill()
+        if not self._waiters and self.tokens >= 1:
+            self.tokens -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        self._schedule()
+        await future
+
+    # Пауза после ответа 429: токены обнуляются до истечения retry_after
+    def pause(self, seconds):
+        self.tokens = 0.0
+        self.updated = max(self.updated, time.monotonic() + seconds)
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._schedule()
+
+    def _schedule(self):
+        if self._timer is not None or not self._waiters:
+            return
+        delay = max(self.updated - time.monotonic(), 0) + max(1 - self.tokens, 0) / self.rate
+        self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+    def _dispatch(self):
+        self._timer = None
+        self._refill()
+        while self._waiters and self.tokens >= 1:
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue  # Отправку отменили, пока она ждала
+            self.tokens -= 1
+            future.set_result(None)
+        # Отмененные в голове очереди не должны держать таймер
+        while self._waiters and self._waiters[0][2].done():
+            heapq.heappop(self._waiters)
+        self._schedule()
+
+
+# Планировщик исходящих запросов: middleware сессии бота, через него проходят все send_* и message.answer.
+# Порядок: корзина чата, затем общая корзина; разные чаты отправляются параллельно
+class OutboundScheduler(BaseRequestMiddleware):
+    def __init__(self, global_rate=OUTBOUND_GLOBAL_RATE, global_burst=OUTBOUND_GLOBAL_BURST,
+                 chat_rate=OUTBOUND_CHAT_RATE, chat_burst=OUTBOUND_CHAT_BURST, max_retries=OUTBOUND_MAX_RETRIES):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chats = {}  # chat_id -> TokenBucket
+        self.metrics = {'sent': 0, 'failed': 0, 'retry_after': 0, 'retry_after_seconds': 0}
+        self.pending = {name: 0 for name in PRIORITY_NAMES.values()}
+        self.latency = {name: Histogram() for name in PRIORITY_NAMES.values()}
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= OUTBOUND_CHAT_BUCKETS_MAX:
+                for idle_id in [key for key, value in self._chats.items() if value.idle()]:
+                    del self._chats[idle_id]
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None or method.__api_method__ not in THROTTLED_METHODS:
+            return await make_request(bot, method)
+
+        priority = _priority.get()
+        name = PRIORITY_NAMES.get(priority, 'normal')
+        started = time.monotonic()
+        self.pending[name] += 1
+        try:
+            for attempt in range(self.max_retries + 1):
+                bucket = self._chat_bucket(chat_id)
+                await bucket.acquire(priority)
+                await self.global_bucket.acquire(priority)
+                try:
+                    response = await make_request(bot, method)
+                except TelegramRetryAfter as e:
+                    self.metrics['retry_after'] += 1
+                    self.metrics['retry_after_seconds'] += e.retry_after
+                    if attempt == self.max_retries:
+                        raise
+                    logging.warning(f"Флуд-лимит для чата {chat_id}: повтор {method.__api_method__} через {e.retry_after} сек")
+                    # 429 означает общий флуд-лимит бота, поэтому ждут и остальные чаты, а не только этот
+                    bucket.pause(e.retry_after)
+                    self.global_bucket.pause(e.retry_after)
+                    continue
+                self.metrics['sent'] += 1
+                # Задержка от постановки в очередь до ответа Telegram, вместе с ожиданием токенов
+                self.latency[name].observe((time.monotonic() - started) * 1000)
+                return response
+        except Exception:
+            self.metrics['failed'] += 1
+            raise
+        finally:
+            self.pending[name] -= 1
+
+    def stats(self):
+        return {
+            'pending': dict(self.pending),
+            'waiting_global': len(self.global_bucket),
+            'waiting_chats': sum(len(bucket) for bucket in self._chats.values()),
+            'chats': len(self._chats),
+            **self.metrics,
+            'latency_ms': {name: histogram.snapshot() for name, histogram in self.latency.items()},
+        }
+
+
+# Планировщик процесса; подключается к сессии бота в main
+outbound_scheduler = OutboundScheduler()
+
+
+def outbound_stats():
+    return outbound_scheduler.stats()
+
+
+# Периодический вывод метрик отправки в лог
+async def log_outbound_stats(interval):
+    while True:
+        await asyncio.sleep(interval)
+        logging.info(f"Метрики отправки: {outbound_stats()}")
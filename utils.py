@@ -1,8 +1,19 @@
-from math import radians, sin, cos, sqrt, atan2
+import bisect
+import time
+from collections import OrderedDict
+from math import pi, radians, sin, cos, sqrt, atan2
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0
+# Градус широты на той же сфере, что и в формуле гаверсинуса; иначе прямоугольник меньше круга
+KM_PER_DEG_LAT = pi * EARTH_RADIUS_KM / 180
+# Запас прямоугольника (градусы) на погрешность вычислений: точки ровно на радиусе не отсекаются
+BOX_EPSILON_DEG = 1e-6
 
 # Функция для расчета расстояния между двумя координатами (широта, долгота) в километрах
 def calculate_distance(lat1, lon1, lat2, lon2):
-    R = 6371.0  # Радиус Земли в километрах
+    R = EARTH_RADIUS_KM  # Радиус Земли в километрах
 
     lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
 
@@ -14,3 +25,146 @@ def calculate_distance(lat1, lon1, lat2, lon2):
 
     distance = R * c
     return distance
+
+# Разбор строки местоположения "lat, lon" в пару чисел
+def parse_location(location):
+    lat, lon = location.split(',')
+    return float(lat), float(lon)
+
+# Строка местоположения "lat, lon" из пары чисел
+def format_location(lat, lon):
+    return f"{lat}, {lon}"
+
+# Пакетный расчет расстояний (км) от точки до массива координат формы (N, 2) за один проход NumPy
+def calculate_distances(lat, lon, coords):
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    lat1, lon1 = radians(lat), radians(lon)
+    lat2 = np.radians(coords[:, 0])
+    lon2 = np.radians(coords[:, 1])
+
+    a = np.sin((lat2 - lat1) / 2)**2 + cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return EARTH_RADIUS_KM * c
+
+# Границы прямоугольника (lat_min, lat_max, lon_min, lon_max), описанного вокруг круга радиуса radius_km
+def bounding_box(lat, lon, radius_km):
+    dlat = radius_km / KM_PER_DEG_LAT + BOX_EPSILON_DEG
+    lat_min, lat_max = max(lat - dlat, -90.0), min(lat + dlat, 90.0)
+    max_abs_lat = max(abs(lat_min), abs(lat_max))
+    if max_abs_lat >= 90.0:
+        return lat_min, lat_max, -180.0, 180.0
+    dlon = radius_km / (KM_PER_DEG_LAT * cos(radians(max_abs_lat))) + BOX_EPSILON_DEG
+    if dlon >= 180.0:
+        return lat_min, lat_max, -180.0, 180.0
+    return lat_min, lat_max, lon - dlon, lon + dlon
+
+# Дешевый префильтр: маска координат, попадающих в описанный прямоугольник (с учетом перехода через 180-й меридиан)
+def bounding_box_mask(lat, lon, radius_km, coords):
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    lat_min, lat_max, lon_min, lon_max = bounding_box(lat, lon, radius_km)
+    mask = (coords[:, 0] >= lat_min) & (coords[:, 0] <= lat_max)
+    if lon_max - lon_min < 360.0:
+        dlon = np.abs((coords[:, 1] - lon + 180.0) % 360.0 - 180.0)
+        mask &= dlon <= (lon_max - lon_min) / 2
+    return mask
+
+# Ограниченный LRU-кэш с необязательным временем жизни записей (ttl в секундах)
+class LRUCache:
+    _MISSING = object()
+
+    def __init__(self, maxsize=10000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self._lookup(key) is not self._MISSING
+
+    def _lookup(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return self._MISSING
+        expires_at, value = item
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._data[key]
+            return self._MISSING
+        return value
+
+    def get(self, key, default=None):
+        value = self._lookup(key)
+        if value is self._MISSING:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    # Значение без учета в статистике и без обновления порядка
+    def peek(self, key, default=None):
+        value = self._lookup(key)
+        return default if value is self._MISSING else value
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data)}
+
+# Границы корзин гистограммы задержек, мс
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# Гистограмма с фиксированными корзинами: счетчики без хранения отдельных значений
+class Histogram:
+    def __init__(self, bounds=LATENCY_BUCKETS_MS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)  # Последняя корзина - больше верхней границы
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    # Оценка перцентиля сверху: граница корзины, в которую он попадает
+    def percentile(self, percent):
+        if not self.count:
+            return 0.0
+        rank = self.count * percent / 100
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        buckets = {f"<={bound}": count for bound, count in zip(self.bounds, self.counts)}
+        buckets[f">{self.bounds[-1]}"] = self.counts[-1]
+        return {
+            'count': self.count,
+            'avg': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': self.max,
+            'buckets': buckets,
+        }
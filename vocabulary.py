@@ -0,0 +1,85 @@
+import localization
+from interests import INTEREST_BITS, INTEREST_LABELS, INTEREST_MESSAGE_KEYS, interest_key
+from localization import translate
+
+# Канонические значения, которые хранятся в базе, и ключи перевода их подписей
+GENDERS = {
+    'Male': 'gender_male',
+    'Female': 'gender_female',
+    'Other': 'gender_other',
+}
+
+ORIENTATIONS = {
+    'Heterosexual': 'orientation_heterosexual',
+    'Homosexual': 'orientation_homosexual',
+    'Bisexual': 'orientation_bisexual',
+    'Pansexual': 'orientation_pansexual',
+    'Asexual': 'orientation_asexual',
+    'Lesbian': 'orientation_lesbian',
+}
+
+# Женские подписи из клавиатуры ориентации, которые означают то же значение
+ORIENTATION_ALIASES = {
+    'orientation_heterosexual_female': 'Heterosexual',
+    'orientation_bisexual_female': 'Bisexual',
+    'orientation_pansexual_female': 'Pansexual',
+    'orientation_asexual_female': 'Asexual',
+}
+
+INTERESTS = tuple(key for key, _ in INTEREST_BITS)
+_INTEREST_NAMES = dict(INTEREST_BITS)
+
+_label_maps = {}  # lang_code -> (версия каталогов переводов, {'gender'|'orientation'|'interest': {подпись: значение}})
+
+
+def gender_label(gender, lang_code):
+    return translate(GENDERS.get(gender, 'gender_other'), lang_code)
+
+
+def orientation_label(orientation, lang_code):
+    return translate(ORIENTATIONS.get(orientation, 'orientation_heterosexual'), lang_code)
+
+
+# Название интереса на языке пользователя; принимает и старые английские названия из базы
+def interest_label(interest, lang_code):
+    key = interest_key(interest)
+    if key is None:
+        return interest
+    return INTEREST_LABELS.get(key, {}).get(lang_code) or _INTEREST_NAMES[key]
+
+
+# Обратные словари подписей кнопок для языка: все подписи, которые бот показывает, ведут к каноническому значению
+def _build_label_maps(lang_code):
+    genders = {translate(message_key, lang_code): gender for gender, message_key in GENDERS.items()}
+    orientations = {translate(message_key, lang_code): orientation for message_key, orientation in ORIENTATION_ALIASES.items()}
+    orientations.update((translate(message_key, lang_code), orientation) for orientation, message_key in ORIENTATIONS.items())
+    interests = {}
+    for key in INTERESTS:
+        interests[interest_label(key, lang_code)] = key
+        # Клавиатура регистрации подписана из каталога переводов, подпись может отличаться от таблицы настроек
+        message_key = INTEREST_MESSAGE_KEYS.get(key)
+        if message_key:
+            interests.setdefault(translate(message_key, lang_code), key)
+    return {'gender': genders, 'orientation': orientations, 'interest': interests}
+
+
+# Словари строятся один раз на язык и заново после перезагрузки переводов
+def label_maps(lang_code):
+    cached = _label_maps.get(lang_code)
+    if cached is not None and cached[0] == localization.catalogs_version:
+        return cached[1]
+    maps = _build_label_maps(lang_code)
+    _label_maps[lang_code] = (localization.catalogs_version, maps)
+    return maps
+
+
+def lookup_gender(label, lang_code):
+    return label_maps(lang_code)['gender'].get(label)
+
+
+def lookup_orientation(label, lang_code):
+    return label_maps(lang_code)['orientation'].get(label)
+
+
+def lookup_interest(label, lang_code):
+    return label_maps(lang_code)['interest'].get(label)